@@ -184,6 +184,12 @@ class Context(object):
     def get_endpoint_info(self):
         return self.endpoint_info
 
+    def get_response_header(self, name):
+        """
+        Return the value of the header name sent with the last response, or None
+        """
+        return getattr(self._requester, 'response_headers', {}).get(name.lower(), None)
+
     def get(self, path, args=None):
         if args:
             query = '&'.join(map(lambda (k, v): "%s=%s" % (k, urllib.quote(v)), args.iteritems()))
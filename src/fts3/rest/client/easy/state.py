@@ -34,6 +34,26 @@ def list_jobs(context, user_dn=None, vo=None, source_se=None, dest_se=None, dele
     return inquirer.get_job_list(user_dn, vo, source_se, dest_se, delegation_id, state_in)
 
 
+def iter_jobs(context, user_dn=None, vo=None, source_se=None, dest_se=None, delegation_id=None, state_in=None,
+              page_size=500):
+    """
+    Iterate over all the jobs matching the filters, retrieving them in pages
+
+    Args:
+        context:       fts3.rest.client.context.Context instance
+        user_dn:       Filter by user dn. Can be left empty
+        vo:            Filter by vo. Can be left empty
+        delegation_id: Filter by delegation ID. Mandatory for state_in
+        state_in:      Filter by job state. An iterable is expected (i.e. ['SUBMITTED', 'ACTIVE']
+        page_size:     How many jobs to retrieve per request
+
+    Returns:
+        A generator of decoded jobs
+    """
+    inquirer = Inquirer(context)
+    return inquirer.iter_job_list(user_dn, vo, source_se, dest_se, delegation_id, state_in, page_size)
+
+
 def get_job_status(context, job_id, list_files=False):
     """
     Get a job status
@@ -19,7 +19,9 @@ try:
     import simplejson as json
 except:
     import json
+import re
 import urllib
+import urlparse
 
 from exceptions import *
 
@@ -63,8 +65,8 @@ class Inquirer(object):
         except NotFound:
             raise NotFound(job_ids)
 
-    def get_job_list(self, user_dn=None, vo_name=None, source_se=None, dest_se=None, delegation_id=None, state_in=None):
-        url = "/jobs?"
+    @staticmethod
+    def _job_list_args(user_dn, vo_name, source_se, dest_se, delegation_id, state_in):
         args = {}
         if user_dn:
             args['user_dn'] = user_dn
@@ -78,12 +80,49 @@ class Inquirer(object):
             args['dlg_id'] = delegation_id
         if state_in:
             args['state_in'] = ','.join(state_in)
+        return args
 
-        query = '&'.join(map(lambda (k, v): "%s=%s" % (k, urllib.quote(v, '')),
+    @staticmethod
+    def _list_url(base, args):
+        query = '&'.join(map(lambda (k, v): "%s=%s" % (k, urllib.quote(str(v), '')),
                              args.iteritems()))
-        url += query
+        return base + '?' + query
+
+    def _next_cursor(self):
+        """
+        Extract the cursor of the next page from the Link header of the last response
+        """
+        link = self.context.get_response_header('Link')
+        if not link:
+            return None
+        for entry in link.split(','):
+            match = re.match(r'\s*<([^>]*)>\s*;\s*rel="?next"?', entry)
+            if match:
+                cursor = urlparse.parse_qs(urlparse.urlparse(match.group(1)).query).get('cursor', None)
+                if cursor:
+                    return cursor[0]
+        return None
 
-        return json.loads(self.context.get(url))
+    def get_job_list(self, user_dn=None, vo_name=None, source_se=None, dest_se=None, delegation_id=None, state_in=None):
+        args = self._job_list_args(user_dn, vo_name, source_se, dest_se, delegation_id, state_in)
+        return json.loads(self.context.get(self._list_url("/jobs", args)))
+
+    def iter_job_list(self, user_dn=None, vo_name=None, source_se=None, dest_se=None, delegation_id=None,
+                      state_in=None, page_size=500):
+        """
+        Iterate over all the jobs matching the filters, following the pagination cursors
+        returned by the server, so each request retrieves at most page_size jobs
+        """
+        args = self._job_list_args(user_dn, vo_name, source_se, dest_se, delegation_id, state_in)
+        args['limit'] = page_size
+        while True:
+            page = json.loads(self.context.get(self._list_url("/jobs", args)))
+            for job in page:
+                yield job
+            cursor = self._next_cursor()
+            if not cursor:
+                break
+            args['cursor'] = cursor
 
     def whoami(self):
         return json.loads(self.context.get("/whoami"))
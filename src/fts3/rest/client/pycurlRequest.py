@@ -68,6 +68,8 @@ class PycurlRequest(object):
         self.verify = verify
         self.connectTimeout = connectTimeout
         self.timeout = timeout
+        # Headers of the last response
+        self.response_headers = {}
 
         if capath:
             self.capath = capath
@@ -118,6 +120,18 @@ class PycurlRequest(object):
         elif code >= 500:
             raise ServerError(str(code))
 
+    @staticmethod
+    def _parse_headers(raw_headers):
+        headers = {}
+        for line in raw_headers.splitlines():
+            # Intermediate responses (i.e. 100 Continue) are followed by the final one
+            if line.startswith('HTTP/'):
+                headers = {}
+            elif ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+        return headers
+
     def method(self, method, url, body=None, headers=None):
         self.curl_handle.setopt(pycurl.CUSTOMREQUEST, method)
         if method == 'GET':
@@ -143,6 +157,8 @@ class PycurlRequest(object):
         # Callback methods produce leaks in EL6, so better avoid them
         response_file = tempfile.TemporaryFile()
         self.curl_handle.setopt(pycurl.WRITEDATA, response_file)
+        header_file = tempfile.TemporaryFile()
+        self.curl_handle.setopt(pycurl.WRITEHEADER, header_file)
 
         if body is not None:
             input_file = tempfile.TemporaryFile()
@@ -159,6 +175,8 @@ class PycurlRequest(object):
         response_file.seek(0)
         response_str = response_file.read()
         #log.debug(response_str)
+        header_file.seek(0)
+        self.response_headers = self._parse_headers(header_file.read())
 
         self._handle_error(url, self.curl_handle.getinfo(pycurl.HTTP_CODE), response_str)
 
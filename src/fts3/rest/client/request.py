@@ -39,6 +39,8 @@ class Request(object):
 
         self.connectTimeout = connectTimeout
         self.timeout = timeout
+        # Headers of the last response
+        self.response_headers = {}
 
     def _handle_error(self, url, code, response_body=None):
         # Try parsing the response, maybe we can get the error message
@@ -110,6 +112,7 @@ class Request(object):
 
         #log.debug(response.text)
 
+        self.response_headers = dict((k.lower(), v) for k, v in response.headers.iteritems())
         self._handle_error(url, response.status_code, response.text)
 
         return str(response.text)
@@ -33,7 +33,7 @@ from sqlalchemy import engine_from_config, event
 import fts3rest.lib.app_globals as app_globals
 import fts3rest.lib.helpers
 from fts3.util.config import fts3_config_load
-from fts3rest.lib.helpers.connection_validator import connection_validator, connection_set_sqlmode
+from fts3rest.lib.helpers.connection_validator import connection_validator, connection_set_sqlmode, MeasuredQueuePool
 from fts3rest.config.routing import make_map
 from fts3rest.model import init_model
 
@@ -82,6 +82,8 @@ def load_environment(global_conf, app_conf):
     if config['sqlalchemy.url'].startswith('mysql://'):
         import MySQLdb.cursors
         kwargs['connect_args'] = {'cursorclass': MySQLdb.cursors.SSCursor}
+    if not config['sqlalchemy.url'].startswith('sqlite'):
+        kwargs['poolclass'] = MeasuredQueuePool
     engine = engine_from_config(config, 'sqlalchemy.', pool_recycle=7200, **kwargs)
     init_model(engine)
 
@@ -91,8 +93,9 @@ def load_environment(global_conf, app_conf):
         def do_connect(dbapi_connection, connection_record):
             dbapi_connection.isolation_level = None
 
-    # Catch dead connections
-    event.listens_for(engine, 'checkout')(connection_validator)
+    # Catch dead connections, checking only those idle for a while
+    connection_validator.idle_threshold = int(config.get('fts3.DbPingIdleThreshold', 60))
+    connection_validator.register(engine)
     event.listens_for(engine, 'connect')(connection_set_sqlmode)
 
     # Mako templating
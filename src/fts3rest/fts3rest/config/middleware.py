@@ -26,8 +26,11 @@ from pylons.wsgiapp import PylonsApp
 from routes.middleware import RoutesMiddleware
 
 from fts3rest.lib.heartbeat import Heartbeat
+from fts3rest.lib.gfal2_wrapper import configure_gfal2_pool
+from fts3rest.lib.keypool import configure_key_pool
 from fts3rest.lib.openidconnect import oidc_manager
-from fts3rest.lib.IAMTokenRefresher import IAMTokenRefresher
+from fts3rest.lib.proxycache import configure_proxy_cache
+from fts3rest.lib.IAMTokenRefresher import configure_token_refresher
 from fts3rest.lib.middleware.fts3auth import FTS3AuthMiddleware
 from fts3rest.lib.middleware.error_as_json import ErrorAsJson
 from fts3rest.lib.middleware.request_logger import RequestLogger
@@ -101,10 +104,15 @@ def make_app(global_conf, full_stack=True, static_files=True, **app_conf):
 
     # Heartbeat thread
     Heartbeat('fts_rest', int(config.get('fts3.HeartBeatInterval', 60))).start()
+    # Pre-generated keys for the delegation requests
+    configure_key_pool(config)
+    # Pooled processes for the data management operations
+    configure_gfal2_pool(config)
+    configure_proxy_cache(config)
     # Start OIDC clients
     if "fts3.Providers" in app.config and app.config["fts3.Providers"]:
         oidc_manager.setup(app.config)
-        IAMTokenRefresher("fts_token_refresh_daemon", app.config).start()
+        configure_token_refresher(app.config)
         log.info("OpenID Connect support enabled.")
     else:
         log.info("OpenID Connect support disabled. Providers not found in config")
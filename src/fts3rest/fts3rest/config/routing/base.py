@@ -70,6 +70,8 @@ def do_connect(config, map):
                 conditions=dict(method=['GET']))
     map.connect('/jobs/{job_id_list}', controller='jobs', action='cancel',
                 conditions=dict(method=['DELETE']))
+    map.connect('/jobs/bulk', controller='jobs', action='submit_bulk',
+                conditions=dict(method=['POST']))
     map.connect('/jobs/{job_id_list}', controller='jobs', action='modify',
                 conditions=dict(method=['POST']))
     map.connect('/jobs', controller='jobs', action='submit',
@@ -207,6 +209,12 @@ def do_connect(config, map):
                 conditions=dict(method=['POST']))
     map.connect('/dm/rename', controller='datamanagement', action='rename',
                 conditions=dict(method=['POST']))
+    map.connect('/dm/batch/stat', controller='datamanagement', action='stat_batch',
+                conditions=dict(method=['POST']))
+    map.connect('/dm/batch/list', controller='datamanagement', action='list_batch',
+                conditions=dict(method=['POST']))
+    map.connect('/dm/batch/unlink', controller='datamanagement', action='unlink_batch',
+                conditions=dict(method=['POST']))
 
     # Banning
     map.connect('/ban/se', controller='banning', action='ban_se',
@@ -238,3 +246,7 @@ def do_connect(config, map):
     # State check
     map.connect('/status/hosts', controller='serverstatus', action='hosts_activity',
                 conditions=dict(method=['GET']))
+    map.connect('/status/db', controller='serverstatus', action='db_pool',
+                conditions=dict(method=['GET']))
+    map.connect('/status/token-refresher', controller='serverstatus', action='token_refresher',
+                conditions=dict(method=['GET']))
@@ -20,14 +20,16 @@ except:
     import json
 import logging
 from datetime import datetime
-from pylons import request
-from sqlalchemy import distinct, func, and_
+from pylons import config, request
+from sqlalchemy import case, func
 
-from fts3.model import BannedDN, BannedSE, Job, File, JobActiveStates, FileActiveStates
+from fts3.model import BannedDN, BannedSE, Job, File, FileActiveStates, FileTerminalStates
 from fts3rest.lib.api import doc
 from fts3rest.lib.base import BaseController, Session
 from fts3rest.lib.helpers import jsonify
 from fts3rest.lib.http_exceptions import *
+from fts3rest.lib.banning import ban_index
+from fts3rest.lib.cancellation import cancel_user_jobs, iter_chunks
 from fts3rest.lib.middleware.fts3auth import authorize
 from fts3rest.lib.middleware.fts3auth.constants import *
 
@@ -55,6 +57,7 @@ def _ban_se(storage, vo_name, allow_submit, status, message):
     except Exception:
         Session.rollback()
         raise
+    ban_index.invalidate()
 
 
 def _ban_dn(dn, message):
@@ -73,6 +76,44 @@ def _ban_dn(dn, message):
     except Exception:
         Session.rollback()
         raise
+    ban_index.invalidate()
+
+
+def _storage_filter(query, storage, vo_name):
+    """
+    Restrict the query to the files with the given storage either in source or destination,
+    and belonging to the given VO
+    """
+    query = query.filter((File.source_se == storage) | (File.dest_se == storage))
+    if vo_name and vo_name != '*':
+        query = query.filter(File.vo_name == vo_name)
+    return query
+
+
+def _get_chunk_size():
+    return int(config.get('fts3.BanChunkSize', 1000))
+
+
+def _finish_jobs(job_ids, now, chunk_size):
+    """
+    Set to CANCELED the jobs from job_ids that have all their files in a terminal state.
+    The caller commits, together with the cancellation of the files.
+    """
+    job_ids = list(job_ids)
+    for i in xrange(0, len(job_ids), chunk_size):
+        chunk = job_ids[i:i + chunk_size]
+        counts = Session.query(
+            File.job_id,
+            func.count(File.file_id),
+            func.sum(case([(File.file_state.in_(FileTerminalStates), 1)], else_=0))
+        ).filter(File.job_id.in_(chunk)).group_by(File.job_id)
+        finished = [job_id for job_id, n_files, n_terminal in counts if n_files == n_terminal]
+        if finished:
+            Session.query(Job).filter(Job.job_id.in_(finished)).update({
+                'job_state': 'CANCELED',
+                'job_finished': now,
+                'reason': None
+            }, synchronize_session=False)
 
 
 def _cancel_transfers(storage=None, vo_name=None):
@@ -81,71 +122,50 @@ def _cancel_transfers(storage=None, vo_name=None):
     and belong to the given VO.
     Returns the list of affected jobs ids.
     """
+    chunk_size = _get_chunk_size()
     affected_job_ids = set()
-    files = Session.query(File.file_id).filter(
-        and_(
-            (File.source_se == storage) | (File.dest_se == storage),
-            File.file_state.in_(FileActiveStates + ['NOT_USED'])
-        )
-    )
-    if vo_name and vo_name != '*':
-        files = files.filter(File.vo_name == vo_name)
+    files = _storage_filter(
+        Session.query(File.file_id, File.job_id, File.file_index, File.file_state),
+        storage, vo_name
+    ).filter(File.file_state.in_(FileActiveStates + ['NOT_USED']))
 
     now = datetime.utcnow()
 
     try:
-        for row in files:
-            file_id = row[0]
-            job_id, file_index = Session.query(File.job_id, File.file_index).filter(File.file_id == file_id).one()
-            affected_job_ids.add(job_id)
-            # Cancel the affected file
-            Session.query(File).filter(File.file_id == file_id)\
+        for rows in iter_chunks(files, File.file_id, chunk_size):
+            job_ids = set(row.job_id for row in rows)
+            affected_job_ids.update(job_ids)
+
+            # Cancel the affected files
+            _storage_filter(Session.query(File), storage, vo_name)\
+                .filter(File.file_state.in_(FileActiveStates + ['NOT_USED']))\
+                .filter(File.file_id.between(rows[0].file_id, rows[-1].file_id))\
                 .update({
                     'file_state': 'CANCELED', 'reason': 'Storage banned',
                     'finish_time': now, 'dest_surl_uuid': None
                 }, synchronize_session=False)
-            # If there are alternatives, enable them
-            if Session.bind.dialect.name == 'mysql':
-                limit = " LIMIT 1"
-            else:
-                limit = ''
-            Session.execute(
-                "UPDATE t_file SET"
-                "   file_state = 'SUBMITTED' "
-                "WHERE"
-                "  job_id = :job_id AND file_index = :file_index AND file_state = 'NOT_USED' " + limit,
-                dict(job_id=job_id, file_index=file_index)
-            )
 
-        Session.commit()
-        Session.expire_all()
-    except Exception:
-        Session.rollback()
-        raise
+            # If there are alternatives to the canceled active transfers, enable one of each
+            canceled = set((row.job_id, row.file_index) for row in rows if row.file_state != 'NOT_USED')
+            alternatives = Session.query(File.file_id, File.job_id, File.file_index)\
+                .filter(File.job_id.in_(job_ids), File.file_state == 'NOT_USED')\
+                .filter(File.source_se != storage, File.dest_se != storage)\
+                .order_by(File.file_id)
+            enable = dict()
+            for file_id, job_id, file_index in alternatives:
+                if (job_id, file_index) in canceled and (job_id, file_index) not in enable:
+                    enable[(job_id, file_index)] = file_id
+            if enable:
+                Session.query(File).filter(File.file_id.in_(enable.values()))\
+                    .update({'file_state': 'SUBMITTED'}, synchronize_session=False)
+
+            # Set each job terminal state if needed, in the same transaction, so an interrupted
+            # ban does not leave behind active jobs without active files
+            _finish_jobs(job_ids, now, chunk_size)
 
-    # Set each job terminal state if needed
-    try:
-        for job_id in affected_job_ids:
-            n_files = Session.query(func.count(distinct(File.file_id))).filter(File.job_id == job_id).all()[0][0]
-            n_canceled = Session.query(func.count(distinct(File.file_id)))\
-                .filter(File.job_id == job_id).filter(File.file_state == 'CANCELED').all()[0][0]
-            n_finished = Session.query(func.count(distinct(File.file_id)))\
-                .filter(File.job_id == job_id).filter(File.file_state == 'FINISHED').all()[0][0]
-            n_failed = Session.query(func.count(distinct(File.file_id)))\
-                .filter(File.job_id == job_id).filter(File.file_state == 'FAILED').all()[0][0]
-
-            n_terminal = n_canceled + n_finished + n_failed
-
-            # Job finished!
-            if n_terminal == n_files:
-                reason = None
-                Session.query(Job).filter(Job.job_id == job_id).update({
-                    'job_state': 'CANCELED',
-                    'job_finished': now,
-                    'reason': reason
-                })
+            Session.commit()
 
-        Session.commit()
+        Session.expire_all()
     except Exception:
         Session.rollback()
         raise
@@ -157,49 +177,28 @@ def _cancel_jobs(dn):
     Cancel all jobs that belong to dn.
     Returns the list of affected jobs ids.
     """
-    jobs = Session.query(Job.job_id).filter(
-        Job.job_state.in_(JobActiveStates), Job.user_dn == dn, Job.job_finished == None
-    )
-    job_ids = map(lambda j: j[0], jobs)
-
-    try:
-        now = datetime.utcnow()
-        for job_id in job_ids:
-            Session.query(File).filter(File.job_id == job_id).filter(File.file_state.in_(FileActiveStates))\
-                .update({
-                    'file_state': 'CANCELED', 'reason': 'User banned',
-                    'finish_time': now
-                }, synchronize_session=False)
-            Session.query(Job).filter(Job.job_id == job_id)\
-                .update({
-                    'job_state': 'CANCELED', 'reason': 'User banned',
-                    'job_finished': now
-                }, synchronize_session=False)
-        Session.commit()
-        Session.expire_all()
-        return job_ids
-    except Exception:
-        Session.rollback()
-        raise
+    job_ids = []
+    for chunk in cancel_user_jobs(dn, 'User banned', _get_chunk_size()):
+        job_ids.extend(chunk)
+    return job_ids
 
 
-def _set_to_wait_helper(storage, vo_name, from_state, to_state):
+def _move_files(storage, vo_name, from_states, to_state):
     """
-    Helper for _set_to_wait
+    Move the files with the given storage either in source or destination,
+    and belonging to the given VO, from one of from_states to to_state.
+    Returns the set of affected job ids.
     """
-    file_ids = Session.query(File.file_id).filter(
-        and_(
-            File.file_state == from_state),
-        (File.source_se == storage) | (File.dest_se == storage)
-    )
-    if vo_name and vo_name != '*':
-        file_ids = file_ids.filter(File.vo_name == vo_name)
-
-    file_ids = map(lambda j: j[0], file_ids.all())
     job_ids = set()
-    for file_id in file_ids:
-        Session.query(File).filter(File.file_id == file_id).update({'file_state': to_state}, synchronize_session=False)
-        job_ids.add(Session.query(File).get(file_id).job_id)
+    files = _storage_filter(Session.query(File.file_id, File.job_id), storage, vo_name)\
+        .filter(File.file_state.in_(from_states))
+    for rows in iter_chunks(files, File.file_id, _get_chunk_size()):
+        job_ids.update(row.job_id for row in rows)
+        _storage_filter(Session.query(File), storage, vo_name)\
+            .filter(File.file_state.in_(from_states))\
+            .filter(File.file_id.between(rows[0].file_id, rows[-1].file_id))\
+            .update({'file_state': to_state}, synchronize_session=False)
+        Session.commit()
     return job_ids
 
 
@@ -209,37 +208,28 @@ def _set_to_wait(storage, vo_name):
     and belong to the given VO.
     """
     try:
-        job_ids = _set_to_wait_helper(storage, vo_name, 'SUBMITTED', 'ON_HOLD')
-        job_ids.update(_set_to_wait_helper(storage, vo_name, 'STAGING', 'ON_HOLD_STAGING'))
-        Session.commit()
+        job_ids = _move_files(storage, vo_name, ['SUBMITTED'], 'ON_HOLD')
+        job_ids.update(_move_files(storage, vo_name, ['STAGING'], 'ON_HOLD_STAGING'))
         Session.expire_all()
     except Exception:
         Session.rollback()
         raise
     return job_ids
 
+
 def _reenter_queue(storage, vo_name):
     """
     Resets to SUBMITTED or STAGING those transfers that were set ON_HOLD with a previous banning
     Returns the list of affects job ids.
     """
-    job_ids = Session.query(distinct(File.job_id))\
-        .filter((File.source_se == storage) | (File.dest_se == storage)).filter(File.file_state.in_(['ON_HOLD', 'ON_HOLD_STAGING']))
-    if vo_name and vo_name != '*':
-        job_ids = job_ids.filter(File.vo_name == vo_name)
-    job_ids = map(lambda j: j[0], job_ids.all())
-
     try:
-        for job_id in job_ids:
-            Session.query(File).filter(File.job_id == job_id, File.file_state == 'ON_HOLD_STAGING')\
-                .update({'file_state': 'STAGING'}, synchronize_session=False)
-            Session.query(File).filter(File.job_id == job_id, File.file_state == 'ON_HOLD')\
-                .update({'file_state': 'SUBMITTED'}, synchronize_session=False)
+        job_ids = _move_files(storage, vo_name, ['ON_HOLD_STAGING'], 'STAGING')
+        job_ids.update(_move_files(storage, vo_name, ['ON_HOLD'], 'SUBMITTED'))
     except Exception:
         Session.rollback()
         raise
 
-    return job_ids
+    return list(job_ids)
 
 
 class BanningController(BaseController):
@@ -362,6 +352,7 @@ class BanningController(BaseController):
         except Exception:
             Session.rollback()
             raise HTTPBadRequest('Storage not found')
+        ban_index.invalidate()
         log.warn("Storage %s unbanned" % storage)
         audit_configuration('unban-se', "Storage %s unbanned" % storage)
         start_response('204 No Content', [])
@@ -388,6 +379,7 @@ class BanningController(BaseController):
                 Session.commit()
             except Exception:
                 Session.rollback()
+            ban_index.invalidate()
             log.warn("User %s unbanned" % dn)
         else:
             log.warn("Unban of user %s without effect" % dn)
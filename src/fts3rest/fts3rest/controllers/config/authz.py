@@ -29,7 +29,7 @@ from fts3rest.lib.api import doc
 from fts3rest.lib.base import BaseController, Session
 from fts3rest.lib.helpers import jsonify, accept, get_input_as_dict
 from fts3rest.lib.http_exceptions import *
-from fts3rest.lib.middleware.fts3auth import authorize, require_certificate
+from fts3rest.lib.middleware.fts3auth import authorize, require_certificate, invalidate_auth_cache
 from fts3rest.lib.middleware.fts3auth.constants import CONFIG
 from fts3rest.controllers.config import audit_configuration
 
@@ -67,6 +67,7 @@ class AuthzConfigController(BaseController):
         except:
             Session.rollback()
             raise
+        invalidate_auth_cache()
 
         return authz
 
@@ -119,6 +120,7 @@ class AuthzConfigController(BaseController):
         except:
             Session.rollback()
             raise
+        invalidate_auth_cache()
 
         start_response('204 No Content', [])
         return ['']
@@ -16,14 +16,16 @@
 #   limitations under the License.
 
 from datetime import datetime
-from pylons import request
+from pylons import config, request, response
 from pylons.controllers.util import abort
 from webob.exc import HTTPBadRequest
+import Queue
+import collections
 import errno
+import itertools
 import logging
-import os
 import stat
-import tempfile
+import threading
 import urlparse
 import urllib
 try:
@@ -34,11 +36,12 @@ except:
 from fts3.model import Credential
 from fts3rest.lib.api import doc
 from fts3rest.lib.base import BaseController, Session
-from fts3rest.lib.helpers import jsonify
+from fts3rest.lib.helpers import jsonify, jsonify_lines, stream_object_response
 from fts3rest.lib.http_exceptions import HTTPAuthenticationTimeout
-from fts3rest.lib.gfal2_wrapper import Gfal2Wrapper, Gfal2Error
+from fts3rest.lib.gfal2_wrapper import Gfal2Wrapper, Gfal2Error, GError, HEARTBEAT
 from fts3rest.lib.middleware.fts3auth import authorize
 from fts3rest.lib.middleware.fts3auth.constants import DATAMANAGEMENT
+from fts3rest.lib.proxycache import proxy_cache
 
 log = logging.getLogger(__name__)
 
@@ -51,16 +54,42 @@ except ImportError, e:
     log.warning(str(e))
 
 
-def _get_valid_surl():
-    surl = request.params.get('surl')
-    if not surl:
-        raise HTTPBadRequest('Missing surl parameter')
+def _validate_surl(surl):
     parsed = urlparse.urlparse(surl)
     if parsed.scheme in ['file']:
         raise HTTPBadRequest('Forbiden SURL scheme')
     return str(surl)
 
 
+def _get_valid_surl():
+    surl = request.params.get('surl')
+    if not surl:
+        raise HTTPBadRequest('Missing surl parameter')
+    return _validate_surl(surl)
+
+
+def _get_valid_surl_list():
+    """
+    Returns the list of SURLs sent in the body of a batch request
+    """
+    if request.content_type == 'application/json':
+        unencoded_body = request.body
+    else:
+        unencoded_body = urllib.unquote_plus(request.body)
+    try:
+        surls = json.loads(unencoded_body)['surls']
+    except (ValueError, TypeError, KeyError), e:
+        raise HTTPBadRequest('Malformed request: %s' % str(e))
+    if not isinstance(surls, list) or not surls:
+        raise HTTPBadRequest('surls must be a non empty list')
+    max_size = int(config.get('fts3.DmBatchMaxSize', 10000))
+    if len(surls) > max_size:
+        raise HTTPBadRequest('Too many SURLs in the request (%d > %d)' % (len(surls), max_size))
+    if not all(isinstance(surl, basestring) and surl for surl in surls):
+        raise HTTPBadRequest('Invalid SURL in the list')
+    return map(_validate_surl, surls)
+
+
 def _get_credentials():
     user = request.environ['fts3.User.Credentials']
     cred = Session.query(Credential).get((user.delegation_id, user.user_dn))
@@ -71,17 +100,19 @@ def _get_credentials():
         if cred.termination_time <= datetime.utcnow():
             raise HTTPAuthenticationTimeout('Delegated proxy expired (%s)' % user.delegation_id)
 
-        tmp_file = tempfile.NamedTemporaryFile(mode='w', suffix='.pem', prefix='rest-proxy-', delete=False)
-        tmp_file.write(cred.proxy)
-        tmp_file.flush()
-        os.fsync(tmp_file.fileno())
-        return tmp_file
+        return proxy_cache.acquire(cred.dlg_id, cred.termination_time, cred.proxy)
     else:
         if cred.termination_time <= datetime.utcnow():
             raise HTTPAuthenticationTimeout('Token with delegationId (%s), has expired' % user.delegation_id)
         return cred.proxy
 
 
+def _release_credentials(cred):
+    # Give back the proxy file if we are using a certificate based auth method
+    if not isinstance(cred, basestring):
+        proxy_cache.release(cred)
+
+
 def _http_status_from_errno(err_code):
     if err_code in (errno.EPERM, errno.EACCES):
         return 403
@@ -89,7 +120,7 @@ def _http_status_from_errno(err_code):
         return 404
     elif err_code in (errno.EAGAIN, errno.EBUSY, errno.ETIMEDOUT):
         return 503
-    elif err_code in (errno.ENOTDIR, errno.EPROTONOSUPPORT):
+    elif err_code in (errno.ENOTDIR, errno.EPROTONOSUPPORT, errno.EINVAL):
         return 400
     else:
         return 500
@@ -103,17 +134,22 @@ def _is_dropbox(uri):
     return uri.startswith("dropbox") and dropbox_available
 
 
-def _set_dropbox_headers(context):
-    # getting the tokens and add them to the context
+def _get_dropbox_options(uri):
+    """
+    Returns the gfal2 options with the Dropbox tokens of the user, if uri is a Dropbox one
+    """
+    if not _is_dropbox(str(uri)):
+        return []
     user = request.environ['fts3.User.Credentials']
-    dropbox_con = DropboxConnector(user.user_dn,"dropbox")
+    dropbox_con = DropboxConnector(user.user_dn, "dropbox")
     dropbox_info = dropbox_con._get_dropbox_info()
-    dropbox_user_info = dropbox_con._get_dropbox_user_info();
-    context.set_opt_string("DROPBOX", "APP_KEY", dropbox_info.app_key)
-    context.set_opt_string("DROPBOX", "APP_SECRET", dropbox_info.app_secret)
-    context.set_opt_string("DROPBOX", "ACCESS_TOKEN", dropbox_user_info.access_token)
-    context.set_opt_string("DROPBOX", "ACCESS_TOKEN_SECRET", dropbox_user_info.access_token_secret)
-    return context
+    dropbox_user_info = dropbox_con._get_dropbox_user_info()
+    return [
+        ("DROPBOX", "APP_KEY", dropbox_info.app_key),
+        ("DROPBOX", "APP_SECRET", dropbox_info.app_secret),
+        ("DROPBOX", "ACCESS_TOKEN", dropbox_user_info.access_token),
+        ("DROPBOX", "ACCESS_TOKEN_SECRET", dropbox_user_info.access_token_secret)
+    ]
 
 
 def _stat_impl(context, surl):
@@ -128,21 +164,201 @@ def _stat_impl(context, surl):
     }
 
 
-def _list_impl(context, surl):
+def _iter_list_impl(context, surl, marker=None, limit=None):
+    """
+    Generates a pair (name, attributes) per entry of the directory, in the order
+    given by the storage, as they are read.
+    If marker is given, the entries up to, and including, marker are skipped. While
+    skipping, a heartbeat is sent every _LIST_HEARTBEAT entries, so the worker timeout
+    applies to the time without progress. If marker is not found (i.e. it has been removed),
+    the listing fails, instead of looking like the end of the listing.
+    At most limit entries are generated, if given
+    """
     dir_handle = context.opendir(surl)
-    listing = {}
     (entry, st_stat) = dir_handle.readpp()
-    while entry:
+    if marker:
+        marker = marker.rstrip('/')
+        skipped = 0
+        while entry and entry.d_name != marker:
+            (entry, st_stat) = dir_handle.readpp()
+            skipped += 1
+            if skipped % _LIST_HEARTBEAT == 0:
+                yield HEARTBEAT
+        if not entry:
+            raise Gfal2Error(errno.EINVAL, 'Marker not found: %s' % marker)
+        (entry, st_stat) = dir_handle.readpp()
+    count = 0
+    while entry and (limit is None or count < limit):
         d_name = entry.d_name
         if stat.S_ISDIR(st_stat.st_mode):
             d_name += '/'
-        listing[d_name] = {
+        yield d_name, {
             'size': st_stat.st_size,
             'mode': st_stat.st_mode,
             'mtime': st_stat.st_mtime
         }
+        count += 1
         (entry, st_stat) = dir_handle.readpp()
-    return listing
+
+
+def _list_impl(context, surl):
+    return dict(_iter_list_impl(context, surl))
+
+
+# Entries skipped between heartbeats when looking for the marker
+_LIST_HEARTBEAT = 1000
+
+
+def _unlink_surl_impl(context, surl):
+    return context.unlink(surl)
+
+
+def _get_storage(surl):
+    parsed = urlparse.urlparse(surl)
+    return "%s://%s" % (parsed.scheme, parsed.hostname)
+
+
+def _batch_entry(context, operation, surl):
+    try:
+        return dict(surl=surl, result=operation(context, surl))
+    except GError, e:
+        return dict(surl=surl, error=dict(code=e.code, message=e.message))
+    except Exception, e:
+        return dict(surl=surl, error=dict(code=errno.EIO, message=str(e)))
+
+
+def _batch_impl(context, surls, operation, concurrency, per_storage):
+    """
+    Run operation for each surl, with up to concurrency operations running at the same
+    time, but no more than per_storage against the same storage.
+    A thread only takes a SURL whose storage has a free slot, so a busy storage does not
+    hold the slots the others could use.
+    Generates the result, or the error, of each entry as soon as it is available
+    """
+    pending = dict()
+    for surl in surls:
+        pending.setdefault(_get_storage(surl), collections.deque()).append(surl)
+    running = dict((storage, 0) for storage in pending)
+    condition = threading.Condition()
+    results = Queue.Queue()
+
+    def take():
+        """
+        Returns (storage, surl) for the next SURL that can run, waiting if all the storages
+        with pending SURLs are busy, or (None, None) once there is nothing left
+        """
+        with condition:
+            while pending:
+                for storage, queue in pending.iteritems():
+                    if running[storage] < per_storage:
+                        surl = queue.popleft()
+                        if not queue:
+                            del pending[storage]
+                        running[storage] += 1
+                        return storage, surl
+                condition.wait()
+            return None, None
+
+    def run():
+        while True:
+            storage, surl = take()
+            if surl is None:
+                return
+            try:
+                results.put(_batch_entry(context, operation, surl))
+            finally:
+                with condition:
+                    running[storage] -= 1
+                    condition.notify_all()
+
+    for _ in xrange(min(concurrency, len(surls))):
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+    for _ in surls:
+        yield results.get()
+
+
+def _stream_batch(entries, cred):
+    """
+    The status has already been sent when the worker fails (i.e. timeout), so the
+    error is sent as a last entry, without surl
+    The credentials are released once the batch is done.
+    """
+    try:
+        for entry in entries:
+            yield entry
+    except Gfal2Error, e:
+        yield dict(error=dict(code=e.errno, message=e.message))
+    finally:
+        _release_credentials(cred)
+
+
+def _run_batch(operation):
+    """
+    Run operation for each one of the SURLs in the request, in a single gfal2 worker
+    """
+    surls = _get_valid_surl_list()
+    cred = _get_credentials()
+    try:
+        dropbox_surls = filter(_is_dropbox, surls)
+        options = _get_dropbox_options(dropbox_surls[0]) if dropbox_surls else []
+        m = Gfal2Wrapper(cred, _batch_impl, options)
+        entries = m.stream(
+            surls, operation,
+            int(config.get('fts3.DmBatchConcurrency', 20)), int(config.get('fts3.DmBatchPerStorage', 5))
+        )
+    except:
+        _release_credentials(cred)
+        raise
+    return _stream_batch(entries, cred)
+
+
+def _get_list_limit():
+    limit = request.params.get('limit')
+    if not limit:
+        return None
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise HTTPBadRequest('Invalid limit %s' % limit)
+    if limit <= 0:
+        raise HTTPBadRequest('The limit must be greater than 0')
+    return limit
+
+
+def _wants_ndjson():
+    try:
+        best_match = request.accept.best_match(
+            [('application/json', 1.1), ('application/x-ndjson', 1)], default_match='application/json'
+        )
+    except:
+        best_match = 'application/json'
+    return best_match == 'application/x-ndjson'
+
+
+def _stream_listing(entries, cred, ndjson):
+    """
+    Send the entries as they come from the worker, one JSON document per line, or
+    as a single JSON object, depending on ndjson.
+    The status has already been sent when the worker fails, so the error is sent as a
+    last line; for a JSON object, the output is left unterminated.
+    The credentials are released once the listing is done.
+    """
+    try:
+        if ndjson:
+            for d_name, attributes in entries:
+                attributes['name'] = d_name
+                yield json.dumps(attributes) + '\n'
+        else:
+            for chunk in stream_object_response(entries):
+                yield chunk
+    except Gfal2Error, e:
+        log.error('Listing interrupted: [%d] %s' % (e.errno, e.message))
+        if ndjson:
+            yield json.dumps(dict(error=dict(code=e.errno, message=e.message))) + '\n'
+    finally:
+        _release_credentials(cred)
 
 
 def _rename_impl(context, rename_dict):
@@ -152,9 +368,6 @@ def _rename_impl(context, rename_dict):
     old_path = rename_dict['old']
     new_path = rename_dict['new']
 
-    if _is_dropbox(str(old_path)):
-        context = _set_dropbox_headers(context)
-
     return context.rename(str(old_path), str(new_path))
 
 
@@ -164,9 +377,6 @@ def _unlink_impl(context, unlink_dict):
 
     path = unlink_dict['surl']
 
-    if _is_dropbox(str(path)):
-        context = _set_dropbox_headers(context)
-
     return context.unlink(str(path))
 
 
@@ -176,9 +386,6 @@ def _rmdir_impl(context, rmdir_dict):
 
     path = rmdir_dict['surl']
 
-    if _is_dropbox(str(path)):
-        context = _set_dropbox_headers(context)
-
     return context.rmdir(str(path))
 
 
@@ -188,9 +395,6 @@ def _mkdir_impl(context, mkdir_dict):
 
     path = mkdir_dict['surl']
 
-    if _is_dropbox(str(path)):
-        context = _set_dropbox_headers(context)
-
     return context.mkdir(str(path), 0775)
 
 
@@ -200,30 +404,49 @@ class DatamanagementController(BaseController):
     """
 
     @doc.query_arg('surl', 'Remote SURL', required=True)
-    @doc.response(400, 'Protocol not supported OR the SURL is not a directory')
+    @doc.query_arg('marker', 'Start after this entry')
+    @doc.query_arg('limit', 'Maximum number of entries to return')
+    @doc.response(400, 'Protocol not supported OR the SURL is not a directory OR the marker was not found')
     @doc.response(403, 'Permission denied')
     @doc.response(404, 'The SURL does not exist')
     @doc.response(419, 'The credentials need to be re-delegated')
     @doc.response(503, 'Try again later')
     @doc.response(500, 'Internal error')
     @authorize(DATAMANAGEMENT)
-    @jsonify
     def list(self):
         """
         List the content of a remote directory
+        The entries are sent as they are read, as a JSON object, or one JSON document per
+        line if application/x-ndjson is accepted. To get the next page, pass the name of
+        the last entry received as marker. If the marker is not in the directory anymore,
+        the listing fails, and has to be restarted from the beginning
         """
         surl = _get_valid_surl()
+        marker = request.params.get('marker') or None
+        limit = _get_list_limit()
+        ndjson = _wants_ndjson()
         cred = _get_credentials()
 
-        m = Gfal2Wrapper(cred, _list_impl)
+        entries = None
         try:
-            return m(surl)
-        except Gfal2Error, e:
-            _http_error_from_gfal2_error(e)
-        finally:
-            # Delete the temp file if we are using a certificate based auth method
-            if not isinstance(cred, basestring):
-                os.unlink(cred.name)
+            m = Gfal2Wrapper(cred, _iter_list_impl)
+            entries = m.stream(surl, marker, limit)
+            # Wait for the first entry, so errors opening the directory get their status code
+            try:
+                first = list(itertools.islice(entries, 1))
+            except Gfal2Error, e:
+                _http_error_from_gfal2_error(e)
+        except:
+            if entries is not None:
+                entries.close()
+            _release_credentials(cred)
+            raise
+
+        if ndjson:
+            response.headers['Content-Type'] = 'application/x-ndjson'
+        else:
+            response.headers['Content-Type'] = 'application/json'
+        return _stream_listing(itertools.chain(first, entries), cred, ndjson)
 
     @doc.query_arg('surl', 'Remote SURL', required=True)
     @doc.response(400, 'Protocol not supported OR the SURL is not a directory')
@@ -247,9 +470,7 @@ class DatamanagementController(BaseController):
         except Gfal2Error, e:
             _http_error_from_gfal2_error(e)
         finally:
-            # Delete the temp file if we are using a certificate based auth method
-            if not isinstance(cred, basestring):
-                os.unlink(cred.name)
+            _release_credentials(cred)
 
     @doc.query_arg('old', 'Old SURL name', required=True)
     @doc.query_arg('new', 'New SURL name', required=True)
@@ -279,7 +500,7 @@ class DatamanagementController(BaseController):
 
             rename_dict = json.loads(unencoded_body)
 
-            m = Gfal2Wrapper(cred, _rename_impl)
+            m = Gfal2Wrapper(cred, _rename_impl, _get_dropbox_options(rename_dict['old']))
             try:
                 return m(rename_dict)
             except Gfal2Error, e:
@@ -292,9 +513,7 @@ class DatamanagementController(BaseController):
         except KeyError, e:
             raise HTTPBadRequest('Missing parameter: %s' % str(e))
         finally:
-            # Delete the temp file if we are using a certificate based auth method
-            if not isinstance(cred, basestring):
-                os.unlink(cred.name)
+            _release_credentials(cred)
 
     @doc.query_arg('surl', 'Remote SURL', required=True)
     @doc.response(400, 'Protocol not supported OR the SURL is not a directory')
@@ -323,7 +542,7 @@ class DatamanagementController(BaseController):
 
             unlink_dict = json.loads(unencoded_body)
 
-            m = Gfal2Wrapper(cred, _unlink_impl)
+            m = Gfal2Wrapper(cred, _unlink_impl, _get_dropbox_options(unlink_dict['surl']))
             try:
                 return m(unlink_dict)
             except Gfal2Error, e:
@@ -336,9 +555,7 @@ class DatamanagementController(BaseController):
         except KeyError, e:
             raise HTTPBadRequest('Missing parameter: %s' % str(e))
         finally:
-            # Delete the temp file if we are using a certificate based auth method
-            if not isinstance(cred, basestring):
-                os.unlink(cred.name)
+            _release_credentials(cred)
 
     @doc.query_arg('surl', 'Remote SURL', required=True)
     @doc.response(400, 'Protocol not supported OR the SURL is not a directory')
@@ -366,7 +583,7 @@ class DatamanagementController(BaseController):
 
             rmdir_dict = json.loads(unencoded_body)
 
-            m = Gfal2Wrapper(cred, _rmdir_impl)
+            m = Gfal2Wrapper(cred, _rmdir_impl, _get_dropbox_options(rmdir_dict['surl']))
             try:
                 return m(rmdir_dict)
             except Gfal2Error, e:
@@ -379,9 +596,7 @@ class DatamanagementController(BaseController):
         except KeyError, e:
             raise HTTPBadRequest('Missing parameter: %s' % str(e))
         finally:
-            # Delete the temp file if we are using a certificate based auth method
-            if not isinstance(cred, basestring):
-                os.unlink(cred.name)
+            _release_credentials(cred)
 
     @doc.query_arg('surl', 'Remote SURL', required=True)
     @doc.response(400, 'Protocol not supported OR the SURL is not a directory')
@@ -408,7 +623,7 @@ class DatamanagementController(BaseController):
                 raise HTTPBadRequest('Unsupported method %s' % request.method)
 
             mkdir_dict = json.loads(unencoded_body)
-            m = Gfal2Wrapper(cred, _mkdir_impl)
+            m = Gfal2Wrapper(cred, _mkdir_impl, _get_dropbox_options(mkdir_dict['surl']))
             try:
                 return m(mkdir_dict)
             except Gfal2Error, e:
@@ -420,6 +635,37 @@ class DatamanagementController(BaseController):
         except KeyError, e:
             raise HTTPBadRequest('Missing parameter: %s' % str(e))
         finally:
-            #Delete the temp file if we are using a certificate based auth method
-            if not isinstance(cred, basestring):
-                os.unlink(cred.name)
+            _release_credentials(cred)
+
+    @doc.response(400, 'Malformed request, or too many SURLs')
+    @doc.response(419, 'The credentials need to be re-delegated')
+    @authorize(DATAMANAGEMENT)
+    @jsonify_lines
+    def stat_batch(self):
+        """
+        Stat a list of remote files, sent as {"surls": [...]}
+        Each result, or error, is sent in its own line, in completion order
+        """
+        return _run_batch(_stat_impl)
+
+    @doc.response(400, 'Malformed request, or too many SURLs')
+    @doc.response(419, 'The credentials need to be re-delegated')
+    @authorize(DATAMANAGEMENT)
+    @jsonify_lines
+    def list_batch(self):
+        """
+        List the content of a list of remote directories, sent as {"surls": [...]}
+        Each result, or error, is sent in its own line, in completion order
+        """
+        return _run_batch(_list_impl)
+
+    @doc.response(400, 'Malformed request, or too many SURLs')
+    @doc.response(419, 'The credentials need to be re-delegated')
+    @authorize(DATAMANAGEMENT)
+    @jsonify_lines
+    def unlink_batch(self):
+        """
+        Remove a list of remote files, sent as {"surls": [...]}
+        Each result, or error, is sent in its own line, in completion order
+        """
+        return _run_batch(_unlink_surl_impl)
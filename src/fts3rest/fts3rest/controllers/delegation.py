@@ -27,7 +27,7 @@ import M2Crypto.threading
 
 from datetime import datetime
 from webob.exc import HTTPBadRequest, HTTPForbidden, HTTPNotFound
-from M2Crypto import X509, RSA, EVP, BIO
+from M2Crypto import X509, EVP, BIO
 from pylons import config, request, response
 from pylons.templating import render_mako as render
 
@@ -38,7 +38,9 @@ from fts3rest.lib.helpers import jsonify
 from fts3rest.lib.helpers import voms
 from fts3rest.lib.http_exceptions import HTTPMethodFailure
 from fts3rest.lib.middleware.fts3auth import require_certificate
+from fts3rest.lib.oauth2provider import invalidate_validated_tokens
 from fts3rest.lib.JobBuilder import get_base_id, get_vo_id
+from fts3rest.lib.keypool import key_pool
 
 log = logging.getLogger(__name__)
 
@@ -68,6 +70,7 @@ def _populated_x509_name(components):
 def _generate_proxy_request(key_len=2048):
     """
     Generates a X509 proxy request.
+    The key pair is taken from the key pool, if available.
     
     Args:
         key_len: Length of the RSA key in bits
@@ -75,7 +78,7 @@ def _generate_proxy_request(key_len=2048):
     Returns:
         A tuple (X509 request, generated private key)
     """
-    key_pair = RSA.gen_key(key_len, 65537, callback=_mute_callback)
+    key_pair = key_pool.get_key(key_len)
     pkey = EVP.PKey()
     pkey.assign_rsa(key_pair)
     x509_request = X509.Request()
@@ -264,6 +267,7 @@ class DelegationController(BaseController):
             except Exception:
                 Session.rollback()
                 raise
+            invalidate_validated_tokens(dlg_id)
             start_response('204 No Content', [])
             return ['']
 
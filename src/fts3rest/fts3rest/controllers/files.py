@@ -28,6 +28,7 @@ from fts3rest.lib.api import doc
 from fts3rest.lib.base import BaseController, Session
 from fts3rest.lib.JobBuilder import get_storage_element
 from fts3rest.lib.helpers import jsonify
+from fts3rest.lib.helpers.cursor import encode_cursor, decode_cursor, set_next_link
 from fts3rest.lib.middleware.fts3auth import authorize
 from fts3rest.lib.middleware.fts3auth.constants import *
 from fts3rest.lib.http_exceptions import *
@@ -48,6 +49,7 @@ class FilesController(BaseController):
     @doc.query_arg('dest_surl', 'Destination SURL')
     @doc.query_arg('limit', 'Limit the number of results')
     @doc.query_arg('time_window', 'For terminal states, limit results to hours[:minutes] into the past')
+    @doc.query_arg('cursor', 'Continue from the page pointed by the Link header of a previous response')
     @doc.response(403, 'Operation forbidden')
     @doc.response(400, 'DN and delegation ID do not match')
     @doc.return_type(array_of=File)
@@ -56,6 +58,9 @@ class FilesController(BaseController):
     def index(self):
         """
         Get a list of active jobs, or those that match the filter requirements
+
+        If there are more results than 'limit', the response will have a Link header
+        pointing to the next page.
         """
         user = request.environ['fts3.User.Credentials']
 
@@ -64,6 +69,7 @@ class FilesController(BaseController):
         filter_source = request.params.get('source_se', None)
         filter_dest = request.params.get('dest_se', None)
         filter_dest_surl = request.params.get('dest_surl', None)
+        filter_cursor = request.params.get('cursor', None)
 
         try:
             filter_limit = max(1, min(int(request.params['limit']), 1000))
@@ -104,5 +110,12 @@ class FilesController(BaseController):
             files = files.filter(File.job_finished >= filter_not_before)
         else:
             files = files.filter(File.finish_time == None)
+        if filter_cursor:
+            last_file_id, = decode_cursor(filter_cursor, int)
+            files = files.filter(File.file_id > last_file_id)
 
-        return files[:filter_limit]
+        files = files.order_by(File.file_id)[:filter_limit + 1]
+        if len(files) > filter_limit:
+            files = files[:filter_limit]
+            set_next_link(encode_cursor(files[-1].file_id))
+        return files
@@ -15,13 +15,18 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import collections
+import itertools
+import pylons
+
 from datetime import datetime, timedelta
 from pylons import request
 from requests.exceptions import HTTPError
+from sqlalchemy import and_, case, or_
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import noload
+from sqlalchemy.orm import class_mapper, noload
 
-from fts3rest.lib.helpers.msgbus import submit_state_change
+from fts3rest.lib.helpers.msgbus import monitoring_enabled, submit_state_changes
 
 try:
     import simplejson as json
@@ -32,10 +37,12 @@ import logging
 from fts3.model import Job, File, JobActiveStates, FileActiveStates
 from fts3.model import DataManagement, DataManagementActiveStates
 from fts3.model import Credential, FileRetryLog
-from fts3rest.lib.JobBuilder import JobBuilder
+from fts3rest.lib.JobBuilder import JobBuilder, get_banned_ses
 from fts3rest.lib.api import doc
+from fts3rest.lib.cancellation import cancel_active
 from fts3rest.lib.base import BaseController, Session
 from fts3rest.lib.helpers import jsonify, get_input_as_dict
+from fts3rest.lib.helpers.cursor import encode_cursor, decode_cursor, set_next_link
 from fts3rest.lib.http_exceptions import *
 from fts3rest.lib.middleware.fts3auth import authorize, authorized
 from fts3rest.lib.middleware.fts3auth.constants import *
@@ -64,14 +71,144 @@ def _multistatus(responses, start_response, expecting_multistatus=False):
     return responses
 
 
+def _get_columns(cls, fields):
+    """
+    Map a list of field names to the columns of the mapped class cls, so
+    the query can be projected and only those are retrieved from the database.
+    Raises HTTPBadRequest if any of the fields is not a column.
+    """
+    attributes = class_mapper(cls).column_attrs
+    unknown = [field for field in fields if field not in attributes]
+    if unknown:
+        raise HTTPBadRequest('Unknown fields: %s' % ', '.join(unknown))
+    return [getattr(cls, field) for field in fields]
+
+
+def _project(rows, fields):
+    """
+    Convert the rows returned by a projected query into dictionaries
+    with the requested fields
+    """
+    for row in rows:
+        yield dict((field, getattr(row, field)) for field in fields)
+
+
+def _with_files(statuses, groups, fields):
+    """
+    Generates the statuses, setting on each job the files of its group.
+    groups must come in the same order as the first occurrence of each job. Each group is
+    consumed while its job is serialized, before moving to the next one, so only the files
+    of one job are in memory at a time. The files of a job requested more than once are
+    kept, so they can be sent again.
+    """
+    repeated = set(job_id for job_id, count in collections.Counter(
+        status.job_id for status in statuses if isinstance(status, Job)
+    ).iteritems() if count > 1)
+    kept = dict()
+    group_id, group = next(groups, (None, None))
+    for status in statuses:
+        if isinstance(status, Job):
+            if status.job_id in kept:
+                status.__dict__['files'] = kept[status.job_id]
+            elif status.job_id == group_id:
+                files = _project(group, fields)
+                if group_id in repeated:
+                    files = kept[group_id] = list(files)
+                status.__dict__['files'] = files
+                yield status
+                group_id, group = next(groups, (None, None))
+                continue
+            else:
+                status.__dict__['files'] = []
+        yield status
+
+
+def _get_cancel_chunk_size():
+    return int(pylons.config.get('fts3.CancelChunkSize', 1000))
+
+
+def _insert_jobs(populated_list):
+    """
+    Insert the jobs, transfers and data management operations built by
+    the given JobBuilder instances, using one multi-row insert per table
+    """
+    Session.execute(Job.__table__.insert(), [populated.job for populated in populated_list])
+    files = list(itertools.chain(*[populated.files for populated in populated_list]))
+    if len(files):
+        Session.execute(File.__table__.insert(), files)
+    datamanagement = list(itertools.chain(*[populated.datamanagement for populated in populated_list]))
+    if len(datamanagement):
+        Session.execute(DataManagement.__table__.insert(), datamanagement)
+
+
+def _fetch_file_ids(populated_list):
+    """
+    Set the file_id of the in-memory transfers of the given, already inserted, jobs.
+    Only the ids are queried: within a job, they are generated in insertion order,
+    so sorted they match the order of populated.files
+    """
+    jobs = dict([(populated.job_id, populated) for populated in populated_list if len(populated.files)])
+    if not jobs:
+        return
+    file_ids = dict([(job_id, list()) for job_id in jobs.keys()])
+    for job_id, file_id in Session.query(File.job_id, File.file_id)\
+            .filter(File.job_id.in_(jobs.keys())).order_by(File.file_id):
+        file_ids[job_id].append(file_id)
+    for job_id, populated in jobs.iteritems():
+        if len(file_ids[job_id]) != len(populated.files):
+            log.warning("Expected %d file ids for %s, got %d" % (
+                len(populated.files), job_id, len(file_ids[job_id])
+            ))
+            continue
+        for transfer, file_id in zip(populated.files, file_ids[job_id]):
+            transfer['file_id'] = file_id
+
+
+def _send_submit_messages(populated_list):
+    """
+    Write the monitoring messages for the transfers of the given,
+    already inserted, jobs
+    """
+    if not monitoring_enabled():
+        return
+    _fetch_file_ids(populated_list)
+    for populated in populated_list:
+        transfers = [transfer for transfer in populated.files if 'file_id' in transfer]
+        if not transfers:
+            continue
+        try:
+            submit_state_changes(populated.job, transfers, populated.files[0]['file_state'])
+        except Exception, e:
+            log.warning("Failed to write state messages to disk: %s" % e.message)
+
+
 class JobsController(BaseController):
     """
     Operations on jobs and transfers
     """
 
     @staticmethod
-    def _get_job(job_id, env=None):
-        job = Session.query(Job).get(job_id)
+    def _check_delegation(user):
+        """
+        Make sure the user has a valid delegated credential to submit with
+        """
+        credential = Session.query(Credential).get((user.delegation_id, user.user_dn))
+        if credential is None:
+            raise HTTPAuthenticationTimeout('No delegation found for "%s"' % user.user_dn)
+        if credential.expired():
+            remaining = credential.remaining()
+            seconds = abs(remaining.seconds + remaining.days * 24 * 3600)
+            raise HTTPAuthenticationTimeout(
+                'The delegated credentials expired %d seconds ago (%s)' % (seconds, user.delegation_id)
+            )
+        if user.method != 'oauth2' and credential.remaining() < timedelta(hours=1):
+            raise HTTPAuthenticationTimeout(
+                'The delegated credentials has less than one hour left (%s)' % user.delegation_id
+            )
+        return credential
+
+    @staticmethod
+    def _check_job(job, job_id, env=None):
         if job is None:
             raise HTTPNotFound('No job with the id "%s" has been found' % job_id)
         if not authorized(TRANSFER,
@@ -80,6 +217,10 @@ class JobsController(BaseController):
             raise HTTPForbidden('Not enough permissions to check the job "%s"' % job_id)
         return job
 
+    @staticmethod
+    def _get_job(job_id, env=None):
+        return JobsController._check_job(Session.query(Job).get(job_id), job_id, env)
+
     @doc.query_arg('user_dn', 'Filter by user DN')
     @doc.query_arg('vo_name', 'Filter by VO')
     @doc.query_arg('dlg_id', 'Filter by delegation ID')
@@ -88,9 +229,10 @@ class JobsController(BaseController):
     @doc.query_arg('dest_se', 'Destination storage element')
     @doc.query_arg('limit', 'Limit the number of results')
     @doc.query_arg('time_window', 'For terminal states, limit results to hours[:minutes] into the past')
-    @doc.query_arg('fields', 'Return only a subset of the fields')
+    @doc.query_arg('cursor', 'Continue from the page pointed by the Link header of a previous response')
+    @doc.query_arg('fields', 'Comma separated list of job fields to retrieve in this query')
     @doc.response(403, 'Operation forbidden')
-    @doc.response(400, 'DN and delegation ID do not match')
+    @doc.response(400, 'DN and delegation ID do not match, or unknown fields requested')
     @doc.return_type(array_of=Job)
     @authorize(TRANSFER)
     @jsonify
@@ -100,11 +242,12 @@ class JobsController(BaseController):
 
         To prevent heavy queries, only non-terminal (e.g.: ACTIVE) jobs are listed.
         If 'state_in' argument is requested, make sure to also provide either 'limit' or 'time_window' to get completed jobs
+
+        When 'limit' is given, and there are more results, the response will have a Link header
+        pointing to the next page.
         """
         user = request.environ['fts3.User.Credentials']
 
-        jobs = Session.query(Job)
-
         filter_dn = request.params.get('user_dn', None)
         filter_vo = request.params.get('vo_name', None)
         filter_dlg_id = request.params.get('dlg_id', None)
@@ -112,10 +255,13 @@ class JobsController(BaseController):
         filter_source = request.params.get('source_se', None)
         filter_dest = request.params.get('dest_se', None)
         filter_fields = request.params.get('fields', None)
+        if filter_fields:
+            filter_fields = filter(len, filter_fields.split(','))
+        filter_cursor = request.params.get('cursor', None)
         try:
             filter_limit = int(request.params['limit'])
         except:
-            filter_limit = None
+            filter_limit = 500 if filter_cursor else None
         try:
             components = request.params['time_window'].split(':')
             hours = components[0]
@@ -140,6 +286,16 @@ class JobsController(BaseController):
         elif granted_level == NONE:
             raise HTTPForbidden('User not allowed to list jobs')
 
+        if filter_fields:
+            columns = _get_columns(Job, filter_fields)
+            # Needed to build the cursor
+            for field in ('submit_time', 'job_id'):
+                if field not in filter_fields:
+                    columns.append(getattr(Job, field))
+            jobs = Session.query(*columns)
+        else:
+            jobs = Session.query(Job)
+
         if filter_state:
             filter_state = filter_state.split(',')
             jobs = jobs.filter(Job.job_state.in_(filter_state))
@@ -164,29 +320,28 @@ class JobsController(BaseController):
             jobs = jobs.filter(Job.dest_se == filter_dest)
 
         if filter_limit:
-            jobs = jobs.order_by(Job.submit_time.desc())[:filter_limit]
+            if filter_cursor:
+                last_submit_time, last_job_id = decode_cursor(filter_cursor, datetime, basestring)
+                jobs = jobs.filter(or_(
+                    Job.submit_time < last_submit_time,
+                    and_(Job.submit_time == last_submit_time, Job.job_id < last_job_id)
+                ))
+            jobs = jobs.order_by(Job.submit_time.desc(), Job.job_id.desc())[:filter_limit + 1]
+            if len(jobs) > filter_limit:
+                jobs = jobs[:filter_limit]
+                set_next_link(encode_cursor(jobs[-1].submit_time, jobs[-1].job_id))
         else:
             jobs = jobs.yield_per(100).enable_eagerloads(False)
 
         if filter_fields:
-            original_jobs = jobs
-
-            def _field_subset():
-                fields = filter_fields.split(',')
-                for job in original_jobs:
-                    entry = dict()
-                    for field in fields:
-                        if hasattr(job, field):
-                            entry[field] = getattr(job, field)
-                    yield entry
-
-            jobs = _field_subset()
+            jobs = _project(jobs, filter_fields)
 
         return jobs
 
     @doc.query_arg('files', 'Comma separated list of file fields to retrieve in this query')
     @doc.response(200, 'The jobs exist')
     @doc.response(207, 'Some job had an error')
+    @doc.response(400, 'Unknown file fields requested')
     @doc.response(403, 'The user doesn\'t have enough privileges')
     @doc.response(404, 'The job doesn\'t exist')
     @doc.return_type(Job)
@@ -201,31 +356,26 @@ class JobsController(BaseController):
         # request is not available inside the generator
         environ = request.environ
         if 'files' in request.GET:
-            file_fields = request.GET['files'].split(',')
+            file_fields = filter(len, request.GET['files'].split(','))
+            file_columns = _get_columns(File, file_fields)
         else:
-            file_fields = []
+            file_columns = []
+
+        # A job requested more than once gets one entry per request, but is loaded only once
+        requested_ids = filter(len, job_ids)
+        jobs = dict()
+        if requested_ids:
+            for job in Session.query(Job).filter(Job.job_id.in_(set(requested_ids))):
+                jobs[job.job_id] = job
 
         statuses = list()
-        for job_id in filter(len, job_ids):
+        allowed = list()
+        for job_id in requested_ids:
             try:
-                job = JobsController._get_job(job_id, env=environ)
-                if len(file_fields):
-                    class FileIterator(object):
-                        def __init__(self, job_id):
-                            self.job_id = job_id
-
-                        def __call__(self):
-                            for f in Session.query(File).filter(File.job_id == self.job_id):
-                                fd = dict()
-                                for field in file_fields:
-                                    try:
-                                        fd[field] = getattr(f, field)
-                                    except AttributeError:
-                                        pass
-                                yield fd
-                    job.__dict__['files'] = FileIterator(job.job_id)()
+                job = JobsController._check_job(jobs.get(job_id, None), job_id, env=environ)
                 setattr(job, 'http_status', '200 Ok')
                 statuses.append(job)
+                allowed.append(job)
             except HTTPError, e:
                 statuses.append(dict(
                     job_id=job_id,
@@ -234,14 +384,30 @@ class JobsController(BaseController):
                 ))
                 status_error_count += 1
 
+        if len(file_columns) and len(allowed):
+            # Get the files of all the jobs at once, in the order of the response, so
+            # each job gets its group of files as the response is serialized
+            if 'job_id' not in file_fields:
+                file_columns.append(File.job_id)
+            positions = dict()
+            for job in allowed:
+                positions.setdefault(job.job_id, len(positions))
+            files = Session.query(*file_columns)\
+                .filter(File.job_id.in_(positions.keys()))\
+                .order_by(case(positions, value=File.job_id), File.file_id)
+            groups = itertools.groupby(files.yield_per(1000), lambda f: f.job_id)
+            response = _with_files(statuses, groups, file_fields)
+        else:
+            response = iter(statuses)
+
         if len(job_ids) == 1:
             if status_error_count == 1:
                 start_response(statuses[0].get('http_status'), [('Content-Type', 'application/json')])
-            return statuses[0]
+            return response.next()
         elif status_error_count > 0:
             start_response('207 Multi-Status', [('Content-Type', 'application/json')])
 
-        return statuses
+        return response
 
     @doc.response(403, 'The user doesn\'t have enough privileges')
     @doc.response(404, 'The job or the field doesn\'t exist')
@@ -537,19 +703,7 @@ class JobsController(BaseController):
 
         # The auto-generated delegation id must be valid
         user = request.environ['fts3.User.Credentials']
-        credential = Session.query(Credential).get((user.delegation_id, user.user_dn))
-        if credential is None:
-            raise HTTPAuthenticationTimeout('No delegation found for "%s"' % user.user_dn)
-        if credential.expired():
-            remaining = credential.remaining()
-            seconds = abs(remaining.seconds + remaining.days * 24 * 3600)
-            raise HTTPAuthenticationTimeout(
-                'The delegated credentials expired %d seconds ago (%s)' % (seconds, user.delegation_id)
-            )
-        if user.method != 'oauth2' and credential.remaining() < timedelta(hours=1):
-            raise HTTPAuthenticationTimeout(
-                'The delegated credentials has less than one hour left (%s)' % user.delegation_id
-            )
+        JobsController._check_delegation(user)
 
         # Populate the job and files
         populated = JobBuilder(user, **submitted_dict)
@@ -576,13 +730,7 @@ class JobsController(BaseController):
             raise
 
         # Send messages
-        # Need to re-query so we get the file ids
-        job = Session.query(Job).get(populated.job_id)
-        for i in range(len(job.files)):
-            try:
-                submit_state_change(job, job.files[i], populated.files[0]['file_state'])
-            except Exception, e:
-                log.warning("Failed to write state message to disk: %s" % e.message)
+        _send_submit_messages([populated])
 
         if len(populated.files):
             log.info("Job %s submitted with %d transfers" % (populated.job_id, len(populated.files)))
@@ -593,6 +741,96 @@ class JobsController(BaseController):
 
         return {'job_id': populated.job_id}
 
+    @doc.input('Submission descriptions', '{"jobs": [SubmitSchema, ...]}')
+    @doc.response(207, 'Some of the jobs could not be submitted')
+    @doc.response(400, 'The submission request could not be understood')
+    @doc.response(403, 'The user doesn\'t have enough permissions to submit')
+    @doc.response(419, 'The credentials need to be re-delegated')
+    @doc.return_type('[{"job_id": <job id>, "http_status": <status>}, ...]')
+    @authorize(TRANSFER)
+    @jsonify
+    def submit_bulk(self, start_response):
+        """
+        Submits a list of new jobs
+
+        Each entry of "jobs" follows the same format as a single submission.
+        The credentials and banning are checked once for the whole list, and the jobs
+        are inserted in batches. The response contains one entry per submitted job,
+        in the same order.
+        """
+        submitted_dict = get_input_as_dict(request)
+        job_list = submitted_dict.get('jobs', None)
+        if not isinstance(job_list, list) or len(job_list) == 0:
+            raise HTTPBadRequest('Expecting a non empty list of jobs')
+        max_jobs = int(pylons.config.get('fts3.BulkSubmissionMaxJobs', 1000))
+        if len(job_list) > max_jobs:
+            raise HTTPBadRequest('Too many jobs in a single request (%d > %d)' % (len(job_list), max_jobs))
+
+        # The auto-generated delegation id must be valid
+        user = request.environ['fts3.User.Credentials']
+        JobsController._check_delegation(user)
+
+        log.info("%s (%s) is submitting %d transfer jobs" % (user.user_dn, user.vos[0], len(job_list)))
+
+        # Populate the jobs and files
+        banned_ses = get_banned_ses()
+        responses = [None] * len(job_list)
+        populated_list = list()
+        job_ids = set()
+        for index, job_dict in enumerate(job_list):
+            try:
+                if not isinstance(job_dict, dict):
+                    raise HTTPBadRequest('Expecting a dictionary')
+                populated = JobBuilder(user, banned_ses=banned_ses, **job_dict)
+                if populated.job_id in job_ids:
+                    raise HTTPConflict('The sid provided by the user is duplicated')
+                job_ids.add(populated.job_id)
+                populated_list.append((index, populated))
+            except HTTPClientError, e:
+                responses[index] = dict(
+                    job_id=None,
+                    http_status="%s %s" % (e.code, e.title),
+                    http_message=e.detail
+                )
+
+        # Insert the jobs
+        batch_size = int(pylons.config.get('fts3.BulkSubmissionBatchSize', 100))
+        for start in range(0, len(populated_list), batch_size):
+            batch = populated_list[start:start + batch_size]
+            try:
+                _insert_jobs([populated for index, populated in batch])
+                Session.commit()
+                inserted = batch
+            except IntegrityError:
+                Session.rollback()
+                # There is a duplicate within the batch, find out which one
+                inserted = list()
+                for index, populated in batch:
+                    try:
+                        _insert_jobs([populated])
+                        Session.commit()
+                        inserted.append((index, populated))
+                    except IntegrityError as err:
+                        Session.rollback()
+                        responses[index] = dict(
+                            job_id=populated.job_id,
+                            http_status='409 Conflict',
+                            http_message='The submission is duplicated ' + str(err)
+                        )
+            except:
+                Session.rollback()
+                raise
+
+            for index, populated in inserted:
+                responses[index] = dict(job_id=populated.job_id, http_status='200 Ok')
+                log.info("Job %s submitted with %d transfers and %d data management operations" % (
+                    populated.job_id, len(populated.files), len(populated.datamanagement)
+                ))
+
+            _send_submit_messages([populated for index, populated in inserted])
+
+        return _multistatus(responses, start_response, expecting_multistatus=True)
+
     @doc.response(403, 'The user doesn\'t have enough privileges')
     @doc.response(404, 'The job doesn\'t exist')
     @doc.response(409, 'The request could not be completed due to a conflict with the current state of the resource')
@@ -604,48 +842,16 @@ class JobsController(BaseController):
         """
         user = request.environ['fts3.User.Credentials']
 
-        now = datetime.utcnow()
         if not user.is_root:
             raise HTTPForbidden(
                 'User does not have root privileges'
             )
 
-        try:
-            # FTS3 daemon expects finish_time to be NULL in order to trigger the signal
-            # to fts_url_copy
-            file_count = Session.query(File).filter(File.vo_name == vo_name)\
-                .filter(File.file_state.in_(FileActiveStates))\
-                .update({
-                    'file_state': 'CANCELED', 'reason': 'Job canceled by the user', 'dest_surl_uuid':None,
-                    'finish_time': None
-                }, synchronize_session=False)
-
-            # However, for data management operations there is nothing to signal, so
-            # set job_finished
-            dm_count = Session.query(DataManagement).filter(DataManagement.vo_name == vo_name)\
-                .filter(DataManagement.file_state.in_(DataManagementActiveStates))\
-                .update({
-                    'file_state': 'CANCELED', 'reason': 'Job canceled by the user',
-                    'job_finished': now, 'finish_time': now
-                }, synchronize_session=False)
-
-            job_count = Session.query(Job).filter(Job.vo_name == vo_name)\
-                .filter(Job.job_state.in_(JobActiveStates))\
-                .update({
-                    'job_state': 'CANCELED', 'reason': 'Job canceled by the user',
-                    'job_finished': now
-                }, synchronize_session=False)
-            Session.commit()
-            Session.expire_all()
-            log.info("Active jobs for VO %s canceled" % vo_name)
-        except:
-            Session.rollback()
-            raise
-        return {
-            "affected_files": file_count,
-            "affected_dm": dm_count,
-            "affected_jobs": job_count
-        }
+        counts = dict(affected_files=0, affected_dm=0, affected_jobs=0)
+        for counts in cancel_active(vo_name=vo_name, chunk_size=_get_cancel_chunk_size()):
+            pass
+        log.info("Active jobs for VO %s canceled" % vo_name)
+        return counts
 
     @doc.response(403, 'The user doesn\'t have enough privileges')
     @doc.response(404, 'The job doesn\'t exist')
@@ -657,44 +863,13 @@ class JobsController(BaseController):
         """
         user = request.environ['fts3.User.Credentials']
 
-        now = datetime.utcnow()
         if not user.is_root:
             raise HTTPForbidden(
                 'User does not have root privileges'
             )
 
-        try:
-            # FTS3 daemon expects finish_time to be NULL in order to trigger the signal
-            # to fts_url_copy
-            file_count = Session.query(File).filter(File.file_state.in_(FileActiveStates))\
-                .update({
-                    'file_state': 'CANCELED', 'reason': 'Job canceled by the user',  'dest_surl_uuid':None,
-                    'finish_time': None
-                }, synchronize_session=False)
-
-            # However, for data management operations there is nothing to signal, so
-            # set job_finished
-            dm_count = Session.query(DataManagement)\
-                .filter(DataManagement.file_state.in_(DataManagementActiveStates))\
-                .update({
-                    'file_state': 'CANCELED', 'reason': 'Job canceled by the user',
-                    'job_finished': now, 'finish_time': now
-                }, synchronize_session=False)
-
-            job_count = Session.query(Job).filter(Job.job_state.in_(JobActiveStates))\
-                .update({
-                    'job_state': 'CANCELED', 'reason': 'Job canceled by the user', 
-                    'job_finished': now
-                }, synchronize_session=False)
-            Session.commit()
-            Session.expire_all()
-            log.info("Active jobs canceled")
-        except:
-            Session.rollback()
-            raise
-
-        return {
-            "affected_files": file_count,
-            "affected_dm": dm_count,
-            "affected_jobs": job_count
-        }
+        counts = dict(affected_files=0, affected_dm=0, affected_jobs=0)
+        for counts in cancel_active(chunk_size=_get_cancel_chunk_size()):
+            pass
+        log.info("Active jobs canceled")
+        return counts
@@ -13,11 +13,15 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+from webob.exc import HTTPNotFound
+
 from fts3.model import File
 from fts3rest.lib.base import BaseController, Session
 from fts3rest.lib.middleware.fts3auth import authorize, require_certificate
 from fts3rest.lib.middleware.fts3auth.constants import *
 from fts3rest.lib.helpers import jsonify
+from fts3rest.lib.helpers.connection_validator import connection_validator
+from fts3rest.lib import IAMTokenRefresher
 
 
 __controller__ = 'ServerStatusController'
@@ -57,3 +61,25 @@ class ServerStatusController(BaseController):
             response[host]['active'] = count
 
         return response
+
+    @require_certificate
+    @authorize(CONFIG)
+    @jsonify
+    def db_pool(self):
+        """
+        Statistics of the database connection pool of this process
+        """
+        stats = connection_validator.stats()
+        stats['pool'] = Session.bind.pool.status()
+        return stats
+
+    @require_certificate
+    @authorize(CONFIG)
+    @jsonify
+    def token_refresher(self):
+        """
+        Statistics of the token refresher thread of this process
+        """
+        if IAMTokenRefresher.token_refresher is None:
+            raise HTTPNotFound('The token refresher is not enabled')
+        return IAMTokenRefresher.token_refresher.stats()
@@ -17,23 +17,46 @@ import logging
 import socket
 import time
 import random
+from collections import defaultdict
 from datetime import datetime, timedelta
-from threading import Thread
+from multiprocessing.pool import ThreadPool
+from threading import BoundedSemaphore, Lock, Thread
 from thread import get_ident
 
+import jwt
 
 from fts3rest.lib.base import Session
 from fts3rest.lib.openidconnect import oidc_manager
 from fts3.model import Credential, Host
 
+from sqlalchemy import and_, bindparam, or_
 from sqlalchemy.exc import SQLAlchemyError
 
 log = logging.getLogger(__name__)
 
 
+class _TokenToRefresh(object):
+    """
+    Detached copy of a credential, so it can be refreshed outside the database session
+    """
+
+    def __init__(self, dlg_id, dn, proxy, termination_time):
+        self.dlg_id = dlg_id
+        self.dn = dn
+        self.proxy = proxy
+        self.termination_time = termination_time
+
+    @property
+    def issuer(self):
+        try:
+            return jwt.decode(self.proxy.split(':')[0], verify=False).get('iss')
+        except Exception:
+            return None
+
+
 class IAMTokenRefresher(Thread):
     """
-    Daemon thread that refreshes all access tokens in the DB at every interval.
+    Daemon thread that refreshes, at every interval, the access tokens in the DB that are about to expire.
 
     Keeps running on the background updating the DB, marking the process as alive.
     There should be ONLY ONE across all instances.
@@ -50,8 +73,23 @@ class IAMTokenRefresher(Thread):
         self.daemon = True  # The thread will immediately exit when the main thread exits
         self.tag = tag
         self.refresh_interval = int(config.get('fts3.TokenRefreshDaemonIntervalInSeconds', 600))
+        # Only tokens expiring within this many seconds are refreshed
+        self.refresh_horizon = int(config.get('fts3.TokenRefreshHorizonInSeconds', 2 * self.refresh_interval))
+        self.batch_size = int(config.get('fts3.TokenRefreshBatchSize', 100))
+        self.workers = int(config.get('fts3.TokenRefreshWorkers', 8))
+        self.per_issuer = int(config.get('fts3.TokenRefreshPerIssuer', 4))
+        self.max_retries = int(config.get('fts3.TokenRefreshMaxRetries', 3))
+        self.retry_backoff = float(config.get('fts3.TokenRefreshRetryBackoff', 1))
         self.config = config
 
+        self._issuer_lock = Lock()
+        self._issuer_semaphores = dict()
+        self._stats_lock = Lock()
+        self._stats = dict(
+            active=False, cycles=0, errors=0, last_cycle_start=None, last_cycle_duration=None,
+            backlog=0, refreshed=0, failed=0
+        )
+
     def _thread_is_inactive(self, thread):
         # The thread is considered inactive if it hasn't updated the DB for 3*refresh_interval
         log.debug('time since last beat {}'.format(datetime.utcnow() - thread.beat))
@@ -59,6 +97,138 @@ class IAMTokenRefresher(Thread):
             log.debug('thread is inactive! taking over, beat {}'.format(thread.beat))
         return (datetime.utcnow() - thread.beat) > timedelta(seconds=3 * self.refresh_interval)
 
+    def _get_issuer_semaphore(self, issuer):
+        with self._issuer_lock:
+            semaphore = self._issuer_semaphores.get(issuer)
+            if semaphore is None:
+                semaphore = BoundedSemaphore(self.per_issuer)
+                self._issuer_semaphores[issuer] = semaphore
+            return semaphore
+
+    def _refresh_token(self, token):
+        """
+        Refresh a single token, retrying with an exponential backoff.
+        Runs on the worker pool, so it must not touch the database.
+        :return: the refreshed token, or None if it could not be refreshed
+        """
+        semaphore = self._get_issuer_semaphore(token.issuer)
+        for attempt in xrange(self.max_retries + 1):
+            if attempt:
+                time.sleep(self.retry_backoff * (2 ** (attempt - 1)) * random.uniform(1, 1.5))
+            try:
+                with semaphore:
+                    oidc_manager.refresh_access_token(token)
+                log.debug('OK refresh_access_token (exp=%s)' % str(token.termination_time))
+                return token
+            except Exception as ex:
+                log.warning("Failed to refresh token for dn: %s because: %s (attempt %d)" % (
+                    str(token.dn), str(ex), attempt + 1
+                ))
+        return None
+
+    def _get_batches(self, horizon):
+        """
+        Generator of batches of credentials that expire before the horizon.
+        Each batch is read with a separate query, starting after the last key seen,
+        so the result set is never fully loaded in memory.
+        """
+        last = None
+        while True:
+            query = Session.query(
+                Credential.dlg_id, Credential.dn, Credential.proxy, Credential.termination_time
+            ).filter(Credential.proxy.notilike("%CERTIFICATE%"))\
+                .filter(Credential.termination_time < horizon)
+            if last:
+                query = query.filter(or_(
+                    Credential.dlg_id > last[0],
+                    and_(Credential.dlg_id == last[0], Credential.dn > last[1])
+                ))
+            rows = query.order_by(Credential.dlg_id, Credential.dn).limit(self.batch_size).all()
+            Session.commit()
+            if not rows:
+                break
+            yield [_TokenToRefresh(*row) for row in rows]
+            if len(rows) < self.batch_size:
+                break
+            last = (rows[-1].dlg_id, rows[-1].dn)
+
+    def _store_batch(self, tokens):
+        """
+        Store the refreshed tokens with a single statement and commit
+        :return: how many tokens have been stored
+        """
+        if not tokens:
+            return 0
+        update = Credential.__table__.update().where(and_(
+            Credential.__table__.c.dlg_id == bindparam('b_dlg_id'),
+            Credential.__table__.c.dn == bindparam('b_dn')
+        )).values(proxy=bindparam('b_proxy'), termination_time=bindparam('b_termination_time'))
+        try:
+            Session.execute(update, [
+                dict(b_dlg_id=t.dlg_id, b_dn=t.dn, b_proxy=t.proxy, b_termination_time=t.termination_time)
+                for t in tokens
+            ])
+            Session.commit()
+        except SQLAlchemyError as ex:
+            log.warning("Failed to store %d refreshed tokens: %s" % (len(tokens), str(ex)))
+            Session.rollback()
+            return 0
+        return len(tokens)
+
+    def refresh_tokens(self):
+        """
+        Run one refresh cycle: refresh all the tokens that expire within the refresh horizon.
+        Failures are isolated per token, and will be retried on the next cycle.
+        A database error ends the cycle, but not the thread: the next cycle starts over.
+        """
+        start = time.time()
+        horizon = datetime.utcnow() + timedelta(seconds=self.refresh_horizon)
+        backlog = refreshed = failed = errors = 0
+
+        pool = ThreadPool(self.workers)
+        try:
+            for batch in self._get_batches(horizon):
+                backlog += len(batch)
+                results = pool.map(self._refresh_token, batch)
+                succeeded = filter(None, results)
+                failed += len(results) - len(succeeded)
+                stored = self._store_batch(succeeded)
+                failed += len(succeeded) - stored
+                refreshed += stored
+        except SQLAlchemyError as ex:
+            log.warning("Token refresh cycle interrupted by a database error: %s" % str(ex))
+            Session.rollback()
+            errors = 1
+        finally:
+            pool.close()
+            pool.join()
+
+        duration = time.time() - start
+        with self._stats_lock:
+            self._stats['cycles'] += 1
+            self._stats['errors'] += errors
+            self._stats['last_cycle_start'] = datetime.utcfromtimestamp(start)
+            self._stats['last_cycle_duration'] = duration
+            self._stats['backlog'] = backlog
+            self._stats['refreshed'] = refreshed
+            self._stats['failed'] = failed
+        log.info('Token refresh cycle: %d to refresh, %d refreshed, %d failed in %.2f seconds' % (
+            backlog, refreshed, failed, duration
+        ))
+        if duration > self.refresh_interval:
+            log.warning('Token refresh cycle took longer than the refresh interval (%.2f > %d)' % (
+                duration, self.refresh_interval
+            ))
+        return duration
+
+    def stats(self):
+        """
+        Return whether this thread is the active refresher, the number of cycles and of cycles
+        interrupted by a database error, and the counters of the last refresh cycle
+        """
+        with self._stats_lock:
+            return dict(self._stats)
+
     def run(self):
         """
         Regularly check if there is another active IAMTokenRefresher in the DB. If not, become the active thread.
@@ -77,6 +247,8 @@ class IAMTokenRefresher(Thread):
             log.debug('refresher_threads {}, ID {}'.format(len(refresher_threads), get_ident()))
             if all(self._thread_is_inactive(thread) for thread in refresher_threads):
                 log.debug('Activating thread')
+                with self._stats_lock:
+                    self._stats['active'] = True
                 for thread in refresher_threads:
                     Session.delete(thread)
                     log.debug('delete thread')
@@ -94,21 +266,22 @@ class IAMTokenRefresher(Thread):
                         Session.rollback()
                         raise
 
-                    credentials = Session.query(Credential).filter(Credential.proxy.notilike("%CERTIFICATE%")).all()
-                    log.debug('{} credentials to refresh'.format(len(credentials)))
-                    for credential in credentials:
-                        try:
-                            credential = oidc_manager.refresh_access_token(credential)
-                            log.debug('OK refresh_access_token (exp=%s)' % str(credential.termination_time))
-                            Session.merge(credential)
-                            Session.commit()
-                        except Exception as ex:
-                            log.warning("Failed to refresh token for dn: %s because: %s" % (str(credential.dn),
-                                                                                            str(ex)))
-                            Session.rollback()
-                            raise
-                    time.sleep(self.refresh_interval)
+                    duration = self.refresh_tokens()
+                    time.sleep(max(0, self.refresh_interval - duration))
             else:
                 log.debug('THREAD ID: {}'.format(get_ident()))
                 log.debug('Another thread is active -- Going to sleep')
                 time.sleep(db_check_interval)
+
+
+# Refresher thread of this process, if OpenID Connect is enabled
+token_refresher = None
+
+
+def configure_token_refresher(config):
+    """
+    Start the refresher thread of this process
+    """
+    global token_refresher
+    token_refresher = IAMTokenRefresher("fts_token_refresh_daemon", config)
+    token_refresher.start()
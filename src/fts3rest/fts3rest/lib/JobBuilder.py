@@ -26,13 +26,14 @@ from datetime import datetime
 from urlparse import urlparse,parse_qsl, ParseResult
 from urllib import urlencode
 
-from fts3.model import File, BannedSE
+from fts3.model import File
+from fts3rest.lib.banning import ban_index
 from fts3rest.lib.base import Session
 from fts3rest.lib.http_exceptions import *
 
 from fts3rest.lib.scheduler.schd import Scheduler
 from fts3rest.lib.scheduler.db import Database
-from fts3rest.lib.scheduler.Cache import ThreadLocalCache
+from fts3rest.lib.scheduler.Cache import SharedCache
 
 
 log = logging.getLogger(__name__)
@@ -165,7 +166,7 @@ def _select_best_replica(files, vo_name, entry_state, strategy):
     user_filesize = files[0]['user_filesize']
 
     queue_provider = Database(Session)
-    cache_provider = ThreadLocalCache(queue_provider)
+    cache_provider = SharedCache(queue_provider)
     # s = Scheduler(queue_provider)
     s = Scheduler (cache_provider)
     source_se_list = map(lambda f: f['source_se'], files)
@@ -234,19 +235,25 @@ def _select_best_replica(files, vo_name, entry_state, strategy):
         files[best_index]['dest_surl_uuid'] = str(uuid.uuid5(BASE_ID, files[best_index]['dest_surl'].encode('utf-8'))) 
 
 
-def _apply_banning(files):
+def get_banned_ses():
+    """
+    Returns a dictionary se => (vo, status) with the banned storages
+    """
+    # Usually, banned SES will be in the order of ~100 max
+    # Files may be several thousands
+    # The ban index keeps them in memory, so we avoid querying the DB for each submission
+    return ban_index.get_banned_ses()
+
+
+def _apply_banning(files, banned_ses=None):
     """
     Query the banning information for all pairs, reject the job
     as soon as one SE can not submit.
     Update wait_timeout and wait_timestamp is there is a hit
+    banned_ses can be passed when already known (i.e. bulk submissions)
     """
-    # Usually, banned SES will be in the order of ~100 max
-    # Files may be several thousands
-    # We get all banned in memory so we avoid querying too many times the DB
-    # We then build a dictionary to make look up easy
-    banned_ses = dict()
-    for b in Session.query(BannedSE):
-        banned_ses[str(b.se)] = (b.vo, b.status)
+    if banned_ses is None:
+        banned_ses = get_banned_ses()
 
     for f in files:
         source_banned = banned_ses.get(str(f['source_se']), None)
@@ -731,9 +738,11 @@ class JobBuilder(object):
         else:
             self.params['job_metadata'] = {"auth_method": self.user.method}
 
-    def __init__(self, user, **kwargs):
+    def __init__(self, user, banned_ses=None, **kwargs):
         """
         Constructor
+        banned_ses can be given to avoid querying the banned storages again
+        when several jobs are built in a row (see get_banned_ses)
         """
         try:
             self.user = user
@@ -776,9 +785,9 @@ class JobBuilder(object):
             # If any SE does not accept submissions, reject the whole job
             # Update wait_timeout and wait_timestamp if WAIT_AS is set
             if self.files:
-                _apply_banning(self.files)
+                _apply_banning(self.files, banned_ses)
             if self.datamanagement:
-                _apply_banning(self.datamanagement)
+                _apply_banning(self.datamanagement, banned_ses)
 
         except ValueError, e:
             raise HTTPBadRequest('Invalid value within the request: %s' % str(e))
@@ -0,0 +1,110 @@
+#   Copyright notice:
+#   Copyright CERN, 2015.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import threading
+import time
+
+from sqlalchemy import func
+
+from fts3.model import BannedDN, BannedSE
+from fts3rest.lib.base import Session
+
+
+log = logging.getLogger(__name__)
+
+
+class BanIndex(object):
+    """
+    Process wide copy of the banned storages and users.
+    At most once every check_interval seconds, the number of bans and the latest addition
+    time are queried, and only if they changed the full list is reloaded.
+    Bans done by other processes are, then, seen at most check_interval seconds later.
+    Changes that keep both (i.e. the status or vo of an existing ban updated in place)
+    are not detected this way, so the full list is reloaded anyway every reload_interval
+    seconds, which bounds how long those remain stale.
+    """
+
+    def __init__(self, check_interval=5, reload_interval=60):
+        self.check_interval = check_interval
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._version = None
+        self._next_check = 0
+        self._next_reload = 0
+        self._banned_ses = dict()
+        self._banned_dns = frozenset()
+
+    @staticmethod
+    def _get_version():
+        ses = Session.query(func.count(BannedSE.se), func.max(BannedSE.addition_time)).one()
+        dns = Session.query(func.count(BannedDN.dn), func.max(BannedDN.addition_time)).one()
+        return tuple(ses) + tuple(dns)
+
+    def _load(self):
+        banned_ses = dict()
+        for b in Session.query(BannedSE):
+            banned_ses[str(b.se)] = (b.vo, b.status)
+        banned_dns = frozenset(dn for (dn,) in Session.query(BannedDN.dn))
+        self._banned_ses = banned_ses
+        self._banned_dns = banned_dns
+
+    def _refresh(self):
+        if time.time() < self._next_check:
+            return
+        with self._lock:
+            now = time.time()
+            if now < self._next_check:
+                return
+            version = BanIndex._get_version()
+            if version != self._version or now >= self._next_reload:
+                log.debug('Ban list changed or too old, reloading')
+                self._load()
+                self._version = version
+                self._next_reload = now + self.reload_interval
+            self._next_check = now + self.check_interval
+
+    def invalidate(self):
+        """
+        Force a reload on the next access
+        """
+        with self._lock:
+            self._version = None
+            self._next_check = 0
+
+    def get_banned_ses(self):
+        """
+        Returns a dictionary se => (vo, status) with the banned storages
+        """
+        self._refresh()
+        return self._banned_ses
+
+    def is_dn_banned(self, dn):
+        """
+        Returns True if the dn has been banned
+        """
+        self._refresh()
+        return dn in self._banned_dns
+
+
+ban_index = BanIndex()
+
+
+def configure_ban_index(config):
+    """
+    Set the maximum staleness of the ban list from the configuration
+    """
+    ban_index.check_interval = int(config.get('fts3.BanCheckInterval', 5))
+    ban_index.reload_interval = int(config.get('fts3.BanReloadInterval', 60))
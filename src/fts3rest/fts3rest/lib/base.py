@@ -23,6 +23,7 @@ Provides the BaseController class for subclassing.
 import logging
 import types
 from pylons.controllers import WSGIController
+from sqlalchemy.exc import DBAPIError
 from fts3rest.model.meta import Session
 
 log = logging.getLogger(__name__)
@@ -59,7 +60,16 @@ class BaseController(WSGIController):
         # the request is routed to. This routing information is
         # available in environ['pylons.routes_dict']
         try:
-            response = WSGIController.__call__(self, environ, start_response)
+            try:
+                response = WSGIController.__call__(self, environ, start_response)
+            except DBAPIError, e:
+                # Connections are only checked when they have been idle for a while,
+                # so a read only request may still get a dead one: try once more
+                if not e.connection_invalidated or environ.get('REQUEST_METHOD') not in ('GET', 'HEAD'):
+                    raise
+                log.warning('Lost connection to the database, retrying: %s' % str(e))
+                Session.remove()
+                response = WSGIController.__call__(self, environ, start_response)
             if isinstance(response, types.GeneratorType):
                 response = DestroySessionWhenDone(response)
             else:
@@ -0,0 +1,134 @@
+#   Copyright notice:
+#   Copyright CERN, 2015.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Mass cancellation of transfers and jobs.
+Jobs are canceled in chunks of consecutive job ids, together with their transfers,
+committing after each chunk, so the tables are never locked for long. Since only rows
+still in an active state are selected, an interrupted cancellation resumes where it
+stopped when run again.
+"""
+
+import logging
+from datetime import datetime
+
+from fts3.model import Job, File, JobActiveStates, FileActiveStates
+from fts3.model import DataManagement, DataManagementActiveStates
+from fts3rest.lib.base import Session
+
+log = logging.getLogger(__name__)
+
+
+def iter_chunks(query, pk_column, chunk_size):
+    """
+    Split the rows returned by query in chunks of consecutive primary keys.
+    The first column of the query must be pk_column.
+    Each chunk is read after the previous one has been processed, so the caller can
+    update the rows of each chunk, and commit, before the next one is read.
+    """
+    last = None
+    while True:
+        chunk_query = query
+        if last is not None:
+            chunk_query = chunk_query.filter(pk_column > last)
+        rows = chunk_query.order_by(pk_column).limit(chunk_size).all()
+        if not rows:
+            break
+        yield rows
+        if len(rows) < chunk_size:
+            break
+        last = rows[-1][0]
+
+
+def cancel_active(vo_name=None, reason='Job canceled by the user', chunk_size=1000):
+    """
+    Cancel all the active jobs, together with their transfers and data management operations,
+    optionally only those belonging to vo_name.
+    The jobs are processed in chunks, and the transfers of each chunk are canceled in the same
+    transaction as their jobs, so a job submitted meanwhile is either fully canceled or left alone.
+    Generator: yields the running totals (affected_files, affected_dm, affected_jobs)
+    after each chunk.
+    """
+    now = datetime.utcnow()
+    counts = dict(affected_files=0, affected_dm=0, affected_jobs=0)
+
+    jobs = Session.query(Job.job_id).filter(Job.job_state.in_(JobActiveStates))
+    if vo_name:
+        jobs = jobs.filter(Job.vo_name == vo_name)
+
+    try:
+        for rows in iter_chunks(jobs, Job.job_id, chunk_size):
+            job_ids = [row[0] for row in rows]
+            # FTS3 daemon expects finish_time to be NULL in order to trigger the signal
+            # to fts_url_copy
+            counts['affected_files'] += Session.query(File)\
+                .filter(File.job_id.in_(job_ids)).filter(File.file_state.in_(FileActiveStates))\
+                .update({
+                    'file_state': 'CANCELED', 'reason': reason, 'dest_surl_uuid': None,
+                    'finish_time': None
+                }, synchronize_session=False)
+            # However, for data management operations there is nothing to signal, so
+            # set job_finished
+            counts['affected_dm'] += Session.query(DataManagement)\
+                .filter(DataManagement.job_id.in_(job_ids))\
+                .filter(DataManagement.file_state.in_(DataManagementActiveStates))\
+                .update({
+                    'file_state': 'CANCELED', 'reason': reason,
+                    'job_finished': now, 'finish_time': now
+                }, synchronize_session=False)
+            counts['affected_jobs'] += Session.query(Job).filter(Job.job_id.in_(job_ids))\
+                .update({
+                    'job_state': 'CANCELED', 'reason': reason,
+                    'job_finished': now
+                }, synchronize_session=False)
+            Session.commit()
+            log.debug('Mass cancellation progress: %s' % counts)
+            yield dict(counts)
+    except Exception:
+        Session.rollback()
+        raise
+    finally:
+        Session.expire_all()
+
+
+def cancel_user_jobs(dn, reason, chunk_size=1000):
+    """
+    Cancel all the active jobs that belong to dn, together with their transfers.
+    Generator: yields the list of job ids canceled by each chunk.
+    """
+    now = datetime.utcnow()
+    jobs = Session.query(Job.job_id).filter(
+        Job.job_state.in_(JobActiveStates), Job.user_dn == dn, Job.job_finished == None
+    )
+    try:
+        for rows in iter_chunks(jobs, Job.job_id, chunk_size):
+            job_ids = [row[0] for row in rows]
+            Session.query(File).filter(File.job_id.in_(job_ids)).filter(File.file_state.in_(FileActiveStates))\
+                .update({
+                    'file_state': 'CANCELED', 'reason': reason,
+                    'finish_time': now
+                }, synchronize_session=False)
+            Session.query(Job).filter(Job.job_id.in_(job_ids))\
+                .update({
+                    'job_state': 'CANCELED', 'reason': reason,
+                    'job_finished': now
+                }, synchronize_session=False)
+            Session.commit()
+            yield job_ids
+    except Exception:
+        Session.rollback()
+        raise
+    finally:
+        Session.expire_all()
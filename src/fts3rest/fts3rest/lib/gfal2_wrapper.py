@@ -15,22 +15,33 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import cPickle as pickle
 import errno
+import hashlib
 try:
     import simplejson as json
 except:
     import json
+import logging
 import os
 import signal
+import struct
+import threading
 import urlparse
 from StringIO import StringIO
 
 try:
     import gfal2
     context_type = gfal2.creat_context
+    GError = gfal2.GError
 except:
     context_type = None
 
+    class GError(Exception):
+        pass
+
+log = logging.getLogger(__name__)
+
 
 class Gfal2Error(Exception):
     """
@@ -41,22 +52,413 @@ class Gfal2Error(Exception):
         self.message = message
 
 
+# Yielded by a streamed method to show it is still making progress, without sending an item
+HEARTBEAT = 'fts3rest.gfal2_wrapper.heartbeat'
+
+
+def _setup_token(ctx, token, args):
+    """
+    A IAM token is used for authentication, set it in the context
+    """
+    s_cred = gfal2.cred_new("BEARER", token.split(':')[0])
+    try:
+        if isinstance(args[0], dict):
+            if "surl" in args[0].keys():
+                domains = [urlparse.urlparse(args[0]["surl"]).hostname]
+            else:
+                domains = [urlparse.urlparse(args[0]["old"]).hostname]
+        elif isinstance(args[0], list):
+            domains = set(urlparse.urlparse(surl).hostname for surl in args[0])
+        else:
+            domains = [urlparse.urlparse(args[0]).hostname]
+    except Exception, e:
+        # Will get a 401 from storage
+        domains = [""]
+    for domain in domains:
+        gfal2.cred_set(ctx, domain, s_cred)
+
+
+def _prepare(ctx, token, options, args):
+    if ctx is None:
+        raise RuntimeError('Could not load the gfal2 python module')
+    if token is not None:
+        _setup_token(ctx, token, args)
+    for group, key, value in options:
+        ctx.set_opt_string(group, key, value)
+
+
+def _execute(ctx, token, options, method, args, kwargs):
+    """
+    Run method with the gfal2 context ctx
+    Returns a tuple (exit code, output), where output is the JSON serialized
+    result on success, or the error message otherwise
+    """
+    try:
+        _prepare(ctx, token, options, args)
+        return 0, json.dumps(method(ctx, *args, **kwargs))
+    except GError, e:
+        return e.code, e.message
+    except Gfal2Error, e:
+        return e.errno, e.message
+    except Exception, e:
+        return errno.EIO, e.message
+
+
+def _execute_stream(ctx, token, options, method, args, kwargs):
+    """
+    Run method, which returns an iterable, with the gfal2 context ctx
+    Generates a tuple (exit code, output, final) per item, followed by a final one
+    with the exit code and the error message, if any.
+    Heartbeats are sent without output.
+    """
+    try:
+        _prepare(ctx, token, options, args)
+        for item in method(ctx, *args, **kwargs):
+            if item == HEARTBEAT:
+                yield 0, None, False
+            else:
+                yield 0, json.dumps(item), False
+        yield 0, None, True
+    except GError, e:
+        yield e.code, e.message, True
+    except Gfal2Error, e:
+        yield e.errno, e.message, True
+    except Exception, e:
+        yield errno.EIO, e.message, True
+
+
+def _create_context():
+    if context_type is None:
+        return None
+    return context_type()
+
+
+def _raise_for_status(child_status, output):
+    """
+    Raise the Gfal2Error corresponding to the exit status of a child process
+    """
+    if os.WIFSIGNALED(child_status):
+        child_signal = os.WTERMSIG(child_status)
+        if child_signal == signal.SIGALRM:
+            raise Gfal2Error(errno.ETIMEDOUT, 'Timeout expired')
+        else:
+            raise Gfal2Error(errno.EIO, 'Child process killed by signal %d' % child_signal)
+    child_exit = os.WEXITSTATUS(child_status)
+    if child_exit:
+        raise Gfal2Error(child_exit, output)
+
+
+def _send(fd, message):
+    data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+    data = struct.pack('!I', len(data)) + data
+    while data:
+        written = os.write(fd, data)
+        data = data[written:]
+
+
+def _read_exactly(fd, size):
+    data = ''
+    while len(data) < size:
+        chunk = os.read(fd, size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def _receive(fd):
+    """
+    Returns the next message, or None if the other end has been closed
+    """
+    header = _read_exactly(fd, 4)
+    if header is None:
+        return None
+    data = _read_exactly(fd, struct.unpack('!I', header)[0])
+    if data is None:
+        return None
+    return pickle.loads(data)
+
+
+def _worker_loop(request_fd, response_fd, timeout, max_operations):
+    """
+    Main loop of a pooled worker. The process is bound to the credentials of its first
+    operation, and the gfal2 context is kept between operations. The gfal2 plugins keep
+    per process state (i.e. credential and session caches), so a process is never
+    reused for other credentials.
+    The worker exits after max_operations, or when the pool closes the pipe.
+    For streamed operations, the alarm is reset every time an item is sent, so
+    the timeout bounds the time without progress, not the whole operation.
+    The proxy file is owned by the caller, which keeps it while the operation runs.
+    """
+    ctx = None
+    identity = None
+    for _ in xrange(max_operations):
+        message = _receive(request_fd)
+        if message is None:
+            break
+        new_identity, proxy_path, token, options, method, args, kwargs, stream = message
+        signal.alarm(timeout)
+        if identity is None:
+            if proxy_path is not None:
+                os.environ['X509_USER_CERT'] = proxy_path
+                os.environ['X509_USER_KEY'] = proxy_path
+                os.environ['X509_USER_PROXY'] = proxy_path
+            ctx = _create_context()
+            identity = new_identity
+        elif identity != new_identity:
+            raise RuntimeError('Worker bound to other credentials')
+        if stream:
+            for result in _execute_stream(ctx, token, options, method, args, kwargs):
+                _send(response_fd, result)
+                signal.alarm(timeout)
+        else:
+            _send(response_fd, _execute(ctx, token, options, method, args, kwargs) + (True,))
+        signal.alarm(0)
+
+
+class _Worker(object):
+    """
+    Handle of a pooled worker process, bound to the credentials identified by identity
+    """
+
+    def __init__(self, identity, timeout, max_operations, inherited_fds):
+        request_read, request_write = os.pipe()
+        response_read, response_write = os.pipe()
+        self.pid = os.fork()
+        if self.pid == 0:
+            os.close(request_write)
+            os.close(response_read)
+            for fd in inherited_fds:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+            exit_code = 0
+            try:
+                _worker_loop(request_read, response_write, timeout, max_operations)
+            except Exception:
+                exit_code = errno.EIO
+            os._exit(exit_code)
+        os.close(request_read)
+        os.close(response_write)
+        self.request_fd = request_write
+        self.response_fd = response_read
+        self.max_operations = max_operations
+        self.operations = 0
+        self.identity = identity
+        self.alive = True
+        self.pending = False
+
+    def fds(self):
+        return [self.request_fd, self.response_fd]
+
+    def _submit(self, identity, proxy, token, options, method, args, kwargs, stream):
+        self.pending = True
+        try:
+            _send(self.request_fd, (identity, proxy, token, options, method, args, kwargs, stream))
+        except OSError:
+            pass
+
+    def _next(self):
+        """
+        Returns the next (exit code, output, final) sent by the worker
+        """
+        try:
+            result = _receive(self.response_fd)
+        except OSError:
+            result = None
+        if result is None:
+            # The worker died: timeout, crash, or a bug in gfal2
+            child_status = self.stop()
+            _raise_for_status(child_status, 'Worker process died')
+            raise Gfal2Error(errno.EIO, 'Worker process died')
+        exit_code, output, final = result
+        if final:
+            self.pending = False
+            self.operations += 1
+            if self.operations >= self.max_operations:
+                self.stop()
+            if exit_code:
+                raise Gfal2Error(exit_code, output)
+        return output, final
+
+    def call(self, identity, proxy, token, options, method, args, kwargs):
+        self._submit(identity, proxy, token, options, method, args, kwargs, False)
+        output, final = self._next()
+        return json.loads(output)
+
+    def call_stream(self, identity, proxy, token, options, method, args, kwargs):
+        """
+        Generates the items as they are sent by the worker.
+        If the generator is closed before the end, the worker is killed, since it
+        would still be sending the remaining items.
+        """
+        self._submit(identity, proxy, token, options, method, args, kwargs, True)
+        try:
+            while True:
+                output, final = self._next()
+                if final:
+                    return
+                if output is not None:
+                    yield json.loads(output)
+        finally:
+            if self.alive and self.pending:
+                self.kill()
+
+    def kill(self):
+        """
+        Kill the worker without waiting for the current operation
+        """
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        return self.stop()
+
+    def stop(self):
+        """
+        Close the pipes and wait for the process to finish
+        Returns the exit status of the process
+        """
+        self.alive = False
+        for fd in self.fds():
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        _, child_status = os.waitpid(self.pid, 0)
+        return child_status
+
+
+class Gfal2WorkerPool(object):
+    """
+    Bounded pool of long lived worker processes, each one with a gfal2 context ready to use.
+    Each worker is bound to one set of credentials for its whole life, so an operation is
+    only given to an idle worker with the same credentials. Otherwise, a new worker is
+    spawned, stopping the least recently used idle one if the pool is full.
+    Workers are replaced after max_operations, or when they die.
+    """
+
+    def __init__(self, max_workers=4, max_operations=100, timeout=30):
+        self.max_workers = max_workers
+        self.max_operations = max_operations
+        self.timeout = timeout
+        self._condition = threading.Condition()
+        self._idle = []
+        self._busy = set()
+        self.spawned = 0
+
+    def _acquire(self, identity):
+        with self._condition:
+            while True:
+                for worker in self._idle:
+                    if worker.identity == identity:
+                        self._idle.remove(worker)
+                        self._busy.add(worker)
+                        return worker
+                if len(self._idle) + len(self._busy) >= self.max_workers and self._idle:
+                    # Make room, the idle workers are bound to other credentials
+                    self._idle.pop(0).stop()
+                if len(self._idle) + len(self._busy) < self.max_workers:
+                    inherited_fds = []
+                    for other in self._idle + list(self._busy):
+                        inherited_fds.extend(other.fds())
+                    worker = _Worker(identity, self.timeout, self.max_operations, inherited_fds)
+                    self.spawned += 1
+                    self._busy.add(worker)
+                    return worker
+                self._condition.wait()
+
+    def _release(self, worker):
+        with self._condition:
+            self._busy.discard(worker)
+            if worker.alive:
+                self._idle.append(worker)
+            self._condition.notify()
+
+    def run(self, identity, proxy, token, options, method, args, kwargs):
+        worker = self._acquire(identity)
+        try:
+            return worker.call(identity, proxy, token, options, method, args, kwargs)
+        finally:
+            self._release(worker)
+
+    def stream(self, identity, proxy, token, options, method, args, kwargs):
+        """
+        Generates the items yielded by method, holding the worker until the end
+        """
+        worker = self._acquire(identity)
+        items = worker.call_stream(identity, proxy, token, options, method, args, kwargs)
+        try:
+            for item in items:
+                yield item
+        finally:
+            items.close()
+            self._release(worker)
+
+    def shutdown(self):
+        """
+        Stop the idle workers
+        """
+        with self._condition:
+            idle, self._idle = self._idle, []
+        for worker in idle:
+            worker.stop()
+
+    def stats(self):
+        with self._condition:
+            return dict(
+                idle=len(self._idle), busy=len(self._busy), max_workers=self.max_workers, spawned=self.spawned
+            )
+
+
+gfal2_pool = None
+# Seconds an operation can run, also when the worker pool is disabled
+gfal2_timeout = 30
+
+
+def configure_gfal2_pool(config):
+    """
+    Create the worker pool from the configuration.
+    With fts3.Gfal2Workers set to 0, each operation runs in a new process.
+    """
+    global gfal2_pool, gfal2_timeout
+    max_workers = int(config.get('fts3.Gfal2Workers', 4))
+    gfal2_timeout = int(config.get('fts3.Gfal2Timeout', 30))
+    if gfal2_pool is not None:
+        gfal2_pool.shutdown()
+    if max_workers > 0:
+        gfal2_pool = Gfal2WorkerPool(
+            max_workers=max_workers,
+            max_operations=int(config.get('fts3.Gfal2WorkerMaxOperations', 100)),
+            timeout=gfal2_timeout
+        )
+    else:
+        gfal2_pool = None
+
+
 class Gfal2Wrapper(object):
     """
     Wraps the calls to gfal2 in a separated process.
     This reduces the risks of bugs from gfal2, or bad isolation
     impacting the REST API (i.e FTS-35)
+    If the worker pool is enabled, a pooled process is used, otherwise
+    a new process is forked for each call.
     """
 
-    def __init__(self, cred, method):
+    def __init__(self, cred, method, options=None):
         """
-        Calls method in a new process, with the environment properly set up, and a
-        gfal2 context already initialized
+        Calls method in a separated process, with the environment properly set up, and a
+        gfal2 context already initialized.
+        options is a list of (group, key, value) to set in the context.
         """
         self.cred = cred
         self.method = method
+        self.options = options or []
 
     def __call__(self, *args, **kwargs):
+        if gfal2_pool is not None:
+            return self._pooled(args, kwargs)
         pipe_read, pipe_write = os.pipe()
         pid = os.fork()
         if pid == 0:
@@ -67,6 +469,48 @@ class Gfal2Wrapper(object):
             os.close(pipe_write)
             return self._parent(pid, os.fdopen(pipe_read, 'r'))
 
+    def stream(self, *args, **kwargs):
+        """
+        Calls method, which must return an iterable, in a separated process, and
+        returns a generator of the items, available as soon as they are produced
+        The credentials must be kept until the generator is exhausted or closed.
+        """
+        identity, proxy, token = self._get_credentials()
+        if gfal2_pool is not None:
+            return gfal2_pool.stream(identity, proxy, token, self.options, self.method, args, kwargs)
+        return self._transient_stream(identity, proxy, token, args, kwargs)
+
+    def _transient_stream(self, identity, proxy, token, args, kwargs):
+        worker = _Worker(identity, gfal2_timeout, 1, [])
+        items = worker.call_stream(identity, proxy, token, self.options, self.method, args, kwargs)
+        try:
+            for item in items:
+                yield item
+        finally:
+            items.close()
+            if worker.alive:
+                worker.stop()
+
+    def _get_credentials(self):
+        """
+        Returns a tuple (identity, proxy path, token)
+        The proxy file is passed by path, so the workers do not need to write their own copy,
+        but its content is part of the identity, so a context is never reused for a file
+        that has been rewritten
+        """
+        if isinstance(self.cred, basestring):
+            proxy, token = None, self.cred
+            identity = hashlib.sha256(token).hexdigest()
+        else:
+            proxy, token = self.cred.name, None
+            identity = hashlib.sha256(proxy + open(proxy).read()).hexdigest()
+        identity = hashlib.sha256(identity + json.dumps(self.options)).hexdigest()
+        return identity, proxy, token
+
+    def _pooled(self, args, kwargs):
+        identity, proxy, token = self._get_credentials()
+        return gfal2_pool.run(identity, proxy, token, self.options, self.method, args, kwargs)
+
     def _parent(self, child_pid, pipe):
         child_output = StringIO()
         out = pipe.read()
@@ -74,57 +518,24 @@ class Gfal2Wrapper(object):
             child_output.write(out)
             out = pipe.read()
         child_pid, child_status = os.waitpid(child_pid, os.P_WAIT)
-        if os.WIFSIGNALED(child_status):
-            child_signal = os.WTERMSIG(child_status)
-            if child_signal == signal.SIGALRM:
-                raise Gfal2Error(errno.ETIMEDOUT, 'Timeout expired')
-            else:
-                raise Gfal2Error(errno.EIO, 'Child process killed by signal %d' % child_signal)
-        child_exit = os.WEXITSTATUS(child_status)
-        if child_exit:
-            raise Gfal2Error(child_exit, child_output.getvalue())
+        _raise_for_status(child_status, child_output.getvalue())
         return json.loads(child_output.getvalue())
 
     def _child(self, pipe, args, kwargs):
-        signal.alarm(30)
+        signal.alarm(gfal2_timeout)
 
+        token = None
         if not isinstance(self.cred, basestring):
             os.environ['X509_USER_CERT'] = self.cred.name
             os.environ['X509_USER_KEY'] = self.cred.name
             os.environ['X509_USER_PROXY'] = self.cred.name
+        else:
+            token = self.cred
 
-        exit_code = 0
-        try:
-            if context_type is None:
-                raise RuntimeError('Could not load the gfal2 python module')
-            ctx = context_type()
-
-            if isinstance(self.cred, basestring):
-                # A IAM token is used for authentication, set it in the context
-                s_cred = gfal2.cred_new("BEARER", self.cred.split(':')[0])
-                try:
-                    if isinstance(args[0], dict):
-                        if "surl" in args[0].keys():
-                            domain = urlparse.urlparse(args[0]["surl"]).hostname
-                        else:
-                            domain = urlparse.urlparse(args[0]["old"]).hostname
-                    else:
-                        domain = urlparse.urlparse(args[0]).hostname
-                except Exception, e:
-                    # Will get a 401 from storage
-                    domain = ""
-                gfal2.cred_set(ctx, domain, s_cred)
-
-            result = self.method(ctx, *args, **kwargs)
-            pipe.write(json.dumps(result))
-        except gfal2.GError, e:
-            pipe.write(e.message)
-            exit_code = e.code
-        except Exception, e:
-            pipe.write(e.message)
-            exit_code = errno.EIO
+        exit_code, output = _execute(_create_context(), token, self.options, self.method, args, kwargs)
+        pipe.write(output)
         pipe.close()
         os._exit(exit_code)
 
 
-__all__ = ['Gfal2Error', 'Gfal2Wrapper']
+__all__ = ['Gfal2Error', 'Gfal2Wrapper', 'Gfal2WorkerPool', 'HEARTBEAT', 'configure_gfal2_pool']
@@ -13,7 +13,11 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 import logging
-from sqlalchemy.exc import DisconnectionError
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.exc import DisconnectionError, InvalidRequestError
+from sqlalchemy.pool import QueuePool
 try:
     from MySQLdb.connections import Connection as MySQLConnection
 except ImportError:
@@ -27,21 +31,107 @@ except ImportError:
 
 log = logging.getLogger(__name__)
 
+# Stored in the info of the connection record when it is given back to the pool
+_LAST_USED_KEY = 'fts3.last_used'
 
-def connection_validator(dbapi_con, con_record, con_proxy):
-    exc = None
-    if isinstance(dbapi_con, MySQLConnection):
-        # True will silently reconnect if the connection was lost
-        dbapi_con.ping(True)
-    elif isinstance(dbapi_con, OracleConnection):
+
+class ConnectionValidator(object):
+    """
+    Checks the pooled connections on checkout, but only those that have been idle
+    for longer than idle_threshold seconds, since those are the ones likely to have been
+    dropped by the server or a firewall. For the rest, a lost connection is detected when
+    used, and SQLAlchemy invalidates it.
+    With idle_threshold set to 0, every checkout is checked.
+    Keeps some statistics about the pool too. The invalidations are counted from the pool
+    'invalidate' event, which older versions of SQLAlchemy do not have. In that case,
+    they are reported as None.
+    """
+
+    def __init__(self, idle_threshold=60):
+        self.idle_threshold = idle_threshold
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.pings = 0
+        self.invalidations = 0
+        self.wait_time = 0.0
+
+    def _ping(self, dbapi_con):
+        with self._lock:
+            self.pings += 1
+        exc = None
+        if isinstance(dbapi_con, MySQLConnection):
+            # True will silently reconnect if the connection was lost
+            dbapi_con.ping(True)
+        elif isinstance(dbapi_con, OracleConnection):
+            try:
+                dbapi_con.ping()
+            except DatabaseError, e:
+                exc = DisconnectionError(str(e))
+
+        if exc is not None:
+            log.warning(exc.message)
+            raise exc
+
+    def checkout(self, dbapi_con, con_record, con_proxy):
+        with self._lock:
+            self.checkouts += 1
+        # Not set for a connection that has just been created
+        last_used = con_record.info.get(_LAST_USED_KEY, None)
+        if last_used is not None and time.time() - last_used >= self.idle_threshold:
+            self._ping(dbapi_con)
+
+    def checkin(self, dbapi_con, con_record):
+        if con_record is not None:
+            con_record.info[_LAST_USED_KEY] = time.time()
+
+    def waited(self, seconds):
+        """
+        Account the time spent waiting for a connection from the pool
+        """
+        with self._lock:
+            self.wait_time += seconds
+
+    def invalidate(self, dbapi_con, con_record, exception):
+        """
+        Account a connection invalidated by the pool (i.e. found to be dead)
+        """
+        with self._lock:
+            self.invalidations += 1
+
+    def register(self, engine):
+        event.listen(engine, 'checkout', self.checkout)
+        event.listen(engine, 'checkin', self.checkin)
+        try:
+            event.listen(engine, 'invalidate', self.invalidate)
+        except InvalidRequestError:
+            log.info('The connection pool does not support the invalidate event')
+            self.invalidations = None
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                idle_threshold=self.idle_threshold,
+                checkouts=self.checkouts,
+                pings=self.pings,
+                invalidations=self.invalidations,
+                wait_time=self.wait_time
+            )
+
+
+class MeasuredQueuePool(QueuePool):
+    """
+    QueuePool that accounts the time spent getting a connection
+    """
+
+    def _do_get(self):
+        start = time.time()
         try:
-            dbapi_con.ping()
-        except DatabaseError, e:
-            exc = DisconnectionError(str(e))
+            return QueuePool._do_get(self)
+        finally:
+            connection_validator.waited(time.time() - start)
+
 
-    if exc is not None:
-        log.warning(exc.message)
-        raise exc
+connection_validator = ConnectionValidator()
 
 
 def connection_set_sqlmode(dbapi_con, con_record):
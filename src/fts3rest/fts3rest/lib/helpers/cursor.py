@@ -0,0 +1,85 @@
+#   Copyright notice:
+#   Copyright CERN, 2015.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import base64
+import urllib
+from datetime import datetime
+
+try:
+    import simplejson as json
+except:
+    import json
+import pylons
+
+from fts3rest.lib.http_exceptions import HTTPBadRequest
+
+
+def _parse_datetime(value):
+    for fmt in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError('Invalid datetime %s' % value)
+
+
+def encode_cursor(*values):
+    """
+    Serialize the values of the sorting keys of the last returned row
+    into an opaque token
+    """
+    serialized = list()
+    for value in values:
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        serialized.append(value)
+    return base64.urlsafe_b64encode(json.dumps(serialized))
+
+
+def decode_cursor(cursor, *types):
+    """
+    Deserialize a token generated by encode_cursor, converting each value to
+    the corresponding type
+    Raises HTTPBadRequest if the token is not valid
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        if not isinstance(values, list) or len(values) != len(types):
+            raise ValueError('Unexpected number of values')
+        decoded = list()
+        for value, value_type in zip(values, types):
+            if value_type is datetime:
+                decoded.append(_parse_datetime(value))
+            elif value_type is basestring:
+                if not isinstance(value, basestring):
+                    raise ValueError('Expecting a string')
+                decoded.append(value)
+            else:
+                decoded.append(value_type(value))
+        return decoded
+    except Exception:
+        raise HTTPBadRequest('Invalid cursor')
+
+
+def set_next_link(cursor):
+    """
+    Add a Link header pointing to the next page of the current request
+    """
+    params = [
+        (k, v.encode('utf-8')) for k, v in pylons.request.GET.items() if k != 'cursor'
+    ]
+    params.append(('cursor', cursor))
+    url = pylons.request.path_url + '?' + urllib.urlencode(params)
+    pylons.response.headers['Link'] = '<%s>; rel="next"' % url
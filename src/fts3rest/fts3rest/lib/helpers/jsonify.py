@@ -19,7 +19,9 @@ from datetime import datetime
 from decorator import decorator
 from fts3.model.base import Base
 from pylons.decorators.util import get_pylons
+from sqlalchemy.orm import class_mapper
 from sqlalchemy.orm.query import Query
+from sqlalchemy.types import DateTime
 try:
     import simplejson as json
 except:
@@ -30,30 +32,85 @@ import types
 
 log = logging.getLogger(__name__)
 
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S%z'
+
+
+def _format_datetime(value):
+    return value.strftime(DATETIME_FORMAT)
+
+
+# Mapped class => (set of column attribute names, list of (attribute name, converter))
+_mapped_columns = dict()
+
+
+def _get_mapped_columns(cls):
+    """
+    Returns, for a mapped class, the names of its column attributes, and
+    the converter to apply to each one of them (None if the value can be serialized as is)
+    The result is computed only once per class
+    """
+    info = _mapped_columns.get(cls, None)
+    if info is None:
+        columns = list()
+        for prop in class_mapper(cls).column_attrs:
+            converter = None
+            if isinstance(prop.columns[0].type, DateTime):
+                converter = _format_datetime
+            columns.append((prop.key, converter))
+        info = (frozenset([key for key, converter in columns]), columns)
+        _mapped_columns[cls] = info
+    return info
+
 
 class ClassEncoder(json.JSONEncoder):
 
     def __init__(self, *args, **kwargs):
         super(ClassEncoder, self).__init__(*args, **kwargs)
-        self.visited = []
+        # id => object, so the lookup does not depend on the number of visited objects
+        # Keeping the reference also prevents the id from being reused
+        self.visited = dict()
+
+    def _encode_mapped(self, obj):
+        """
+        Serialize a mapped object using the precomputed list of columns.
+        Other public attributes (i.e. loaded relationships, http_status) are kept too.
+        """
+        self.visited[id(obj)] = obj
+        # Trigger sqlalchemy if needed
+        str(obj)
+        column_names, columns = _get_mapped_columns(obj.__class__)
+        attributes = obj.__dict__
+        values = {}
+        for name, converter in columns:
+            if name in attributes:
+                value = attributes[name]
+                if converter is not None and value is not None:
+                    value = converter(value)
+                values[name] = value
+        for k, v in attributes.iteritems():
+            if k in column_names or k.startswith('_'):
+                continue
+            if isinstance(v, Base):
+                if id(v) in self.visited:
+                    continue
+                self.visited[id(v)] = v
+            values[k] = v
+        return values
 
     def default(self, obj):
         if isinstance(obj, Base):
-            self.visited.append(obj)
-
-        if isinstance(obj, datetime):
-            return obj.strftime('%Y-%m-%dT%H:%M:%S%z')
+            return self._encode_mapped(obj)
+        elif isinstance(obj, datetime):
+            return _format_datetime(obj)
         elif isinstance(obj, set) or isinstance(obj, types.GeneratorType):
             return list(obj)
-        elif isinstance(obj, Base) or hasattr(obj, '__dict__'):
-            # Trigger sqlalchemy if needed
-            str(obj)
+        elif hasattr(obj, '__dict__'):
             values = {}
             for k, v in obj.__dict__.iteritems():
-                if not k.startswith('_') and v not in self.visited:
+                if not k.startswith('_') and id(v) not in self.visited:
                     values[k] = v
                     if isinstance(v, Base):
-                        self.visited.append(v)
+                        self.visited[id(v)] = v
             return values
         else:
             return super(ClassEncoder, self).default(obj)
@@ -79,6 +136,23 @@ def stream_response(data):
     yield ']'
 
 
+def stream_object_response(pairs):
+    """
+    Serialize an iterable of (key, value) as a json-object using a generator, so
+    the object does not need to be built in memory first.
+    If the iterable fails, the closing brace is not sent, so the client can not
+    mistake the partial output for a complete one
+    """
+    comma = False
+    yield '{'
+    for key, value in pairs:
+        if comma:
+            yield ','
+        yield json.dumps(key) + ':' + json.dumps(value, cls=ClassEncoder, indent=None, sort_keys=False)
+        comma = True
+    yield '}'
+
+
 @decorator
 def jsonify(f, *args, **kwargs):
     """
@@ -103,3 +177,17 @@ def jsonify(f, *args, **kwargs):
     else:
         log.debug('Sending directly json response')
         return [json.dumps(data, cls=ClassEncoder, indent=None, sort_keys=False)]
+
+
+@decorator
+def jsonify_lines(f, *args, **kwargs):
+    """
+    Decorates methods in the controllers that return an iterable, and sends
+    each item serialized as JSON in its own line (application/x-ndjson), as
+    soon as it is available
+    """
+    pylons = get_pylons(args)
+    pylons.response.headers['Content-Type'] = 'application/x-ndjson'
+
+    data = f(*args, **kwargs)
+    return (json.dumps(item, cls=ClassEncoder, indent=None, sort_keys=False) + '\n' for item in data)
@@ -13,12 +13,14 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import atexit
 import logging
 import os
 import pylons
-import tempfile
+import threading
 import time
 from dirq.QueueSimple import QueueSimple
+from Queue import Queue, Full
 
 try:
     import simplejson as json
@@ -27,12 +29,113 @@ except:
 
 log = logging.getLogger(__name__)
 
-def submit_state_change(job, transfer, transfer_state):
+# One queue handle per directory, reused by all requests
+_queues = dict()
+_queues_lock = threading.Lock()
+
+
+def _get_queue(path):
     """
-    Writes a state change message to the dirq
+    Returns the dirq for the given path, creating it only the first time
+    """
+    with _queues_lock:
+        queue = _queues.get(path, None)
+        if queue is None:
+            queue = QueueSimple(path=path)
+            _queues[path] = queue
+        return queue
+
+
+def _write_messages(queue, messages):
+    """
+    Add the messages to the dirq. Each one is written to a temporary file
+    inside the queue directory, and renamed into place.
+    """
+    for msg in messages:
+        queue.add(msg)
+
+
+class MessageWriter(threading.Thread):
+    """
+    Writes the messages to disk on the background, so the requests
+    do not have to wait for the file system.
+    If the buffer is full, the messages are written by the caller.
+    Pending messages are flushed when the process exits.
+    """
+
+    def __init__(self, buffer_size):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.buffer = Queue(maxsize=buffer_size)
+
+    def put(self, queue, messages):
+        try:
+            self.buffer.put_nowait((queue, messages))
+        except Full:
+            log.warning("Monitoring message buffer is full, writing synchronously")
+            _write_messages(queue, messages)
+
+    def run(self):
+        while True:
+            item = self.buffer.get()
+            try:
+                if item is None:
+                    break
+                try:
+                    _write_messages(*item)
+                except Exception, e:
+                    log.warning("Failed to write state messages to disk: %s" % str(e))
+            finally:
+                self.buffer.task_done()
+
+    def flush(self):
+        """
+        Wait until all the pending messages have been written
+        """
+        self.buffer.join()
+
+    def stop(self):
+        """
+        Flush the pending messages and stop the thread
+        """
+        self.buffer.put(None)
+        self.join()
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def _get_writer():
+    """
+    Returns the background writer if enabled, None otherwise
+    """
+    global _writer
+    async_enabled = pylons.config.get('fts3.MonitoringAsyncWriter', 'false')
+    if str(async_enabled).lower() != 'true':
+        return None
+    with _writer_lock:
+        if _writer is None:
+            _writer = MessageWriter(int(pylons.config.get('fts3.MonitoringBufferSize', 1000)))
+            _writer.start()
+            atexit.register(_writer.stop)
+        return _writer
+
+
+def monitoring_enabled():
+    """
+    Returns True if the monitoring messages are to be written
     """
     msg_enabled = pylons.config.get('fts3.MonitoringMessaging', False)
-    if not msg_enabled or msg_enabled.lower() == 'false':
+    return bool(msg_enabled) and msg_enabled.lower() != 'false'
+
+
+def submit_state_changes(job, transfers, transfer_state):
+    """
+    Writes a state change message to the dirq for each one of the transfers
+    of the job. All of them go to the same queue, and are built in one pass.
+    """
+    if not monitoring_enabled():
         return
 
     publish_dn = pylons.config.get('fts3.MonitoringPublishDN', False)
@@ -41,31 +144,42 @@ def submit_state_change(job, transfer, transfer_state):
     mon_dir = os.path.join(msg_dir, 'monitoring')
 
     _user_dn = job['user_dn'] if publish_dn else ''
+    endpnt = pylons.config['fts3.Alias']
+    timestamp = time.time()*1000
+
+    messages = list()
+    for transfer in transfers:
+        msg = dict(
+            endpnt=endpnt,
+            user_dn=_user_dn,
+            src_url=transfer['source_surl'],
+            dst_url=transfer['dest_surl'],
+            vo_name=job['vo_name'],
+            source_se=transfer['source_se'],
+            dest_se=transfer['dest_se'],
+            job_id=job['job_id'],
+            file_id=transfer['file_id'],
+            job_state=job['job_state'],
+            file_state=transfer_state,
+            retry_counter=0,
+            retry_max=0,
+            timestamp=timestamp,
+            job_metadata=job['job_metadata'],
+            file_metadata=transfer['file_metadata'],
+        )
+        messages.append("SS " + json.dumps(msg))
+
+    queue = _get_queue(mon_dir)
+    writer = _get_writer()
+    if writer:
+        writer.put(queue, messages)
+    else:
+        _write_messages(queue, messages)
+    log.debug("Sent SUBMITTED state for %s (%d transfers)" % (job['job_id'], len(messages)))
+
 
-    msg = dict(
-        endpnt=pylons.config['fts3.Alias'],
-        user_dn=_user_dn,
-        src_url=transfer['source_surl'],
-        dst_url=transfer['dest_surl'],
-        vo_name=job['vo_name'],
-        source_se=transfer['source_se'],
-        dest_se=transfer['dest_se'],
-        job_id=job['job_id'],
-        file_id=transfer['file_id'],
-        job_state=job['job_state'],
-        file_state=transfer_state,
-        retry_counter=0,
-        retry_max=0,
-        timestamp=time.time()*1000,
-        job_metadata=job['job_metadata'],
-        file_metadata=transfer['file_metadata'],
-    )
-
-    tmpfile = tempfile.NamedTemporaryFile(dir=msg_dir, delete=False)
-    tmpfile.write("SS ")
-    json.dump(msg, tmpfile)
-    tmpfile.close()
-
-    q = QueueSimple(path=mon_dir)
-    q.add_path(tmpfile.name)
-    log.debug("Sent SUBMITTED state for %s %d" % (job['job_id'], transfer['file_id']))
+def submit_state_change(job, transfer, transfer_state):
+    """
+    Writes a state change message to the dirq
+    """
+    submit_state_changes(job, [transfer], transfer_state)
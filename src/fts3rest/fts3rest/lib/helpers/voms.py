@@ -18,11 +18,31 @@
 from datetime import datetime, timedelta
 from subprocess import Popen, PIPE, STDOUT
 from tempfile import NamedTemporaryFile
+from M2Crypto import X509, BIO
 import logging
 import os
 
+from fts3rest.lib.scheduler.Cache import LRUCache
+
 log = logging.getLogger(__name__)
 
+# Extension holding the VOMS attribute certificates
+VOMS_AC_OID = '1.3.6.1.4.1.8005.100.100.5'
+# Attribute holding the FQANs inside the attribute certificate
+VOMS_FQAN_OID = '1.3.6.1.4.1.8005.100.100.4'
+# RFC 3820 proxy certificate information
+PROXY_CERT_INFO_OID = '1.3.6.1.5.5.7.1.14'
+
+_SEQUENCE = 0x30
+_BIT_STRING = 0x03
+_OCTET_STRING = 0x04
+_OID = 0x06
+_GENERALIZED_TIME = 0x18
+_EXTENSIONS = 0xa3
+
+# Chain fingerprints => (fqans verified by voms-proxy-info, until when they can be reused)
+_fqans_cache = LRUCache(max_size=10000, entry_life=3600)
+
 
 class VomsException(Exception):
     """
@@ -32,6 +52,191 @@ class VomsException(Exception):
         super(self, VomsException).__init__(args, kwargs)
 
 
+def _der_children(data):
+    """
+    Split the DER encoded content data into a list of (tag, content)
+    """
+    children = []
+    offset = 0
+    while offset < len(data):
+        tag = ord(data[offset])
+        length = ord(data[offset + 1])
+        offset += 2
+        if length & 0x80:
+            n_bytes = length & 0x7f
+            length = 0
+            for byte in data[offset:offset + n_bytes]:
+                length = (length << 8) | ord(byte)
+            offset += n_bytes
+        if offset + length > len(data):
+            raise ValueError('Truncated DER value')
+        children.append((tag, data[offset:offset + length]))
+        offset += length
+    return children
+
+
+def _der_oid(content):
+    """
+    Decode the content of a DER encoded OBJECT IDENTIFIER
+    """
+    first = ord(content[0])
+    components = [first // 40, first % 40]
+    value = 0
+    for byte in content[1:]:
+        value = (value << 7) | (ord(byte) & 0x7f)
+        if not ord(byte) & 0x80:
+            components.append(value)
+            value = 0
+    return '.'.join(map(str, components))
+
+
+def _der_time(content):
+    """
+    Decode the content of a DER encoded GeneralizedTime
+    """
+    return datetime.strptime(content[:14], '%Y%m%d%H%M%S')
+
+
+def _get_extensions(x509):
+    """
+    Returns a dictionary oid => DER value with the extensions of the certificate
+    """
+    certificate = _der_children(x509.as_der())[0][1]
+    tbs_certificate = _der_children(certificate)[0][1]
+    extensions = dict()
+    for tag, content in _der_children(tbs_certificate):
+        if tag == _EXTENSIONS:
+            for _, extension in _der_children(_der_children(content)[0][1]):
+                fields = _der_children(extension)
+                extensions[_der_oid(fields[0][1])] = fields[-1][1]
+    return extensions
+
+
+def _find_acs(content):
+    """
+    Find the attribute certificates contained in the VOMS extension.
+    An attribute certificate is a sequence of acinfo, signature algorithm and signature.
+    """
+    acs = []
+    for tag, child in _der_children(content):
+        if tag != _SEQUENCE:
+            continue
+        fields = _der_children(child)
+        if len(fields) == 3 and fields[0][0] == _SEQUENCE and fields[2][0] == _BIT_STRING:
+            acs.append(fields[0][1])
+        else:
+            acs.extend(_find_acs(child))
+    return acs
+
+
+def _parse_ac(acinfo):
+    """
+    Get the FQANs and the termination time of an attribute certificate
+    """
+    fqans = []
+    not_after = None
+    fields = _der_children(acinfo)
+    for i, (tag, content) in enumerate(fields):
+        if tag != _SEQUENCE:
+            continue
+        period = _der_children(content)
+        if len(period) == 2 and all(t == _GENERALIZED_TIME for t, _ in period):
+            not_after = _der_time(period[1][1])
+            # The attributes follow the validity period
+            for _, attribute in _der_children(fields[i + 1][1]):
+                attr_type, attr_values = _der_children(attribute)
+                if _der_oid(attr_type[1]) != VOMS_FQAN_OID:
+                    continue
+                for _, ietf_attr in _der_children(attr_values[1]):
+                    for value_tag, values in _der_children(ietf_attr):
+                        if value_tag == _SEQUENCE:
+                            fqans.extend(v for t, v in _der_children(values) if t == _OCTET_STRING)
+            break
+    return fqans, not_after
+
+
+def _parse_voms_extension(x509_list):
+    """
+    Get the FQANs and the AC termination time from the first certificate
+    of the chain carrying a VOMS extension
+    The signature of the attribute certificates is NOT verified, so the FQANs
+    returned by this function must never be used for authorization.
+    """
+    for x509 in x509_list:
+        ac_extension = _get_extensions(x509).get(VOMS_AC_OID)
+        if ac_extension is None:
+            continue
+        fqans = []
+        not_after = None
+        for acinfo in _find_acs(ac_extension):
+            ac_fqans, ac_not_after = _parse_ac(acinfo)
+            fqans.extend(ac_fqans)
+            if ac_not_after and (not_after is None or ac_not_after < not_after):
+                not_after = ac_not_after
+        return fqans, not_after
+    return [], None
+
+
+def _load_chain(pem):
+    """
+    Loads the list of certificates contained in pem
+    """
+    x509_list = []
+    bio = BIO.MemoryBuffer(pem)
+    try:
+        while bio.readable():
+            x509_list.append(X509.load_cert_bio(bio))
+    except X509.X509Error:
+        pass
+    return x509_list
+
+
+def _get_verified_fqans(x509_list, chain_pem):
+    """
+    Get the FQANs with voms-proxy-info, which verifies the attribute certificates against
+    the vomsdir (signature, issuer and validity period).
+    Returns a tuple (fqans, until when the result can be reused). The later is None if
+    the expiration of the attribute certificates can not be known, so it is not reused.
+    """
+    fqans = VomsClient(chain_pem).get_proxy_fqans()
+    valid_until = min(x509.get_not_after().get_datetime().replace(tzinfo=None) for x509 in x509_list)
+    try:
+        # The attribute certificates have just been verified, so their expiration can be trusted
+        _, ac_not_after = _parse_voms_extension(x509_list)
+    except Exception, e:
+        log.warning('Failed to parse the VOMS extension (%s), the FQANs will not be cached' % str(e))
+        return fqans, None
+    if ac_not_after:
+        valid_until = min(valid_until, ac_not_after)
+    return fqans, valid_until
+
+
+def get_proxy_fqans(x509_list, chain_pem):
+    """
+    Get the VOMS FQANs of a proxy.
+    The verified result is cached by the fingerprints of the chain, until the proxy
+    or its attribute certificates expire, so voms-proxy-info only runs once per proxy.
+
+    Args:
+        x509_list: The certificates of the chain, as X509 objects
+        chain_pem: The same chain, PEM encoded
+
+    Raises:
+        VomsException: The attribute certificates could not be verified, or have expired
+    """
+    fingerprint = ':'.join(x509.get_fingerprint('sha256') for x509 in x509_list)
+    fqans, valid_until = _fqans_cache.get(fingerprint, _get_verified_fqans, x509_list, chain_pem)
+    if valid_until is not None and valid_until <= datetime.utcnow():
+        _fqans_cache.invalidate(fingerprint)
+        fqans, valid_until = _fqans_cache.get(fingerprint, _get_verified_fqans, x509_list, chain_pem)
+        if valid_until is not None and valid_until <= datetime.utcnow():
+            _fqans_cache.invalidate(fingerprint)
+            raise VomsException('The proxy or its attribute certificates have expired')
+    if valid_until is None:
+        _fqans_cache.invalidate(fingerprint)
+    return list(fqans)
+
+
 def _check_proxy_validity(proxy_path):
     """
     voms-proxy-init may return != 0 even when the proxy was created
@@ -87,6 +292,25 @@ def _get_proxy_termination_time(proxy_path):
     except Exception, e:
         raise VomsException('Failed to get the termination time of a proxy: ' + str(e))
 
+def _get_termination_time(proxy_path):
+    """
+    Get the termination time of the proxy specified by proxy_path, which is the
+    earliest between the expiration of the certificates and of the attribute certificate.
+    The proxy has just been generated by voms-proxy-init, so it is parsed without
+    verifying it again. voms-proxy-info is only used if the proxy can not be parsed.
+    """
+    try:
+        x509_list = _load_chain(open(proxy_path).read())
+        _, ac_not_after = _parse_voms_extension(x509_list)
+        termination_times = [x509.get_not_after().get_datetime().replace(tzinfo=None) for x509 in x509_list]
+        if ac_not_after:
+            termination_times.append(ac_not_after)
+        return min(termination_times)
+    except Exception, e:
+        log.warning('Failed to parse the proxy (%s), falling back to voms-proxy-info' % str(e))
+        return _get_proxy_termination_time(proxy_path)
+
+
 def _get_proxy_type(proxy_path):
     """
     Get the type of the proxy specified by proxy_path
@@ -138,7 +362,7 @@ class VomsClient(object):
                            Meaning: The user requested a voms to which he/she doesn't belong
         """
         new_proxy = self._voms_proxy_init(voms_list, lifetime)
-        new_termination_time = _get_proxy_termination_time(new_proxy)
+        new_termination_time = _get_termination_time(new_proxy)
 
         new_proxy_pem = open(new_proxy).read()
         os.unlink(new_proxy)
@@ -156,7 +380,7 @@ class VomsClient(object):
                 '--out', new_proxy,
                 '--noregen', '--ignorewarn']
 
-        if _get_proxy_type(self.proxy_path) == 'RFC':
+        if self._is_rfc_proxy():
             args.append('--rfc')
 
         for v in voms_list:
@@ -176,6 +400,17 @@ class VomsClient(object):
 
         return new_proxy
 
+    def _is_rfc_proxy(self):
+        """
+        RFC 3820 proxies carry the ProxyCertInfo extension
+        """
+        try:
+            x509_list = _load_chain(open(self.proxy_path).read())
+            return PROXY_CERT_INFO_OID in _get_extensions(x509_list[0])
+        except Exception, e:
+            log.warning('Failed to parse the proxy (%s), falling back to voms-proxy-info' % str(e))
+            return _get_proxy_type(self.proxy_path) == 'RFC'
+
     def get_proxy_fqans(self):
         """
         Get the proxy fqans
@@ -0,0 +1,142 @@
+#   Copyright notice:
+#   Copyright CERN, 2015.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import threading
+from collections import deque
+
+import M2Crypto.threading
+from M2Crypto import RSA
+
+log = logging.getLogger(__name__)
+
+
+def _mute_callback(*args, **kwargs):
+    """
+    Does nothing. Used as a callback for gen_key
+    """
+    pass
+
+
+def generate_key(key_len):
+    """
+    Generate a new RSA key pair of key_len bits
+    """
+    return RSA.gen_key(key_len, 65537, callback=_mute_callback)
+
+
+class KeyPool(object):
+    """
+    Pool of pre-generated RSA key pairs, one per key length.
+    When a pool goes below low_watermark keys, a background thread fills it
+    up to high_watermark keys. If a pool is empty, the key is generated by the caller.
+    Only the key lengths given by key_lengths, or add_key_length, are pooled, since
+    the requested length comes from the client certificate. Any other length is
+    always generated by the caller.
+    """
+
+    def __init__(self, low_watermark=2, high_watermark=10, key_lengths=(2048,)):
+        self.low_watermark = low_watermark
+        self.high_watermark = high_watermark
+        self._pools = dict()
+        self._condition = threading.Condition()
+        self._thread = None
+        self.hits = 0
+        self.misses = 0
+        for key_len in key_lengths:
+            self.add_key_length(key_len)
+
+    def add_key_length(self, key_len):
+        """
+        Keep a pool of keys of key_len bits
+        """
+        with self._condition:
+            self._pools.setdefault(key_len, deque())
+            self._condition.notify()
+
+    def _needs_refill(self):
+        return [
+            key_len for key_len, pool in self._pools.iteritems() if len(pool) < self.high_watermark
+        ]
+
+    def _fill(self):
+        M2Crypto.threading.init()
+        while True:
+            with self._condition:
+                while not any(len(pool) < self.low_watermark for pool in self._pools.itervalues()):
+                    self._condition.wait()
+                pending = self._needs_refill()
+            for key_len in pending:
+                while len(self._pools[key_len]) < self.high_watermark:
+                    key_pair = generate_key(key_len)
+                    with self._condition:
+                        self._pools[key_len].append(key_pair)
+            log.debug('Key pool filled for %s' % ', '.join(map(str, pending)))
+
+    def start(self):
+        """
+        Start the background thread
+        """
+        with self._condition:
+            if self._thread is not None or self.high_watermark <= 0:
+                return
+            self._thread = threading.Thread(target=self._fill, name='KeyPool')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def get_key(self, key_len):
+        """
+        Returns a RSA key pair of key_len bits, from the pool if possible
+        """
+        key_pair = None
+        with self._condition:
+            pool = self._pools.get(key_len, None)
+            if pool:
+                key_pair = pool.popleft()
+                self.hits += 1
+            else:
+                self.misses += 1
+            if pool is not None and len(pool) < self.low_watermark:
+                self._condition.notify()
+        if key_pair is None:
+            log.debug('Key pool for %d bits empty, generating inline' % key_len)
+            key_pair = generate_key(key_len)
+        return key_pair
+
+    def stats(self):
+        """
+        Return the pool counters
+        """
+        with self._condition:
+            return dict(
+                sizes=dict((key_len, len(pool)) for key_len, pool in self._pools.iteritems()),
+                hits=self.hits,
+                misses=self.misses
+            )
+
+
+key_pool = KeyPool()
+
+
+def configure_key_pool(config):
+    """
+    Set the watermarks and the initial key lengths from the configuration, and start
+    filling the pool. Setting fts3.KeyPoolHighWatermark to 0 disables the pool.
+    """
+    key_pool.low_watermark = int(config.get('fts3.KeyPoolLowWatermark', 2))
+    key_pool.high_watermark = int(config.get('fts3.KeyPoolHighWatermark', 10))
+    for key_len in config.get('fts3.KeyPoolKeyLengths', '2048').split(','):
+        key_pool.add_key_length(int(key_len))
+    key_pool.start()
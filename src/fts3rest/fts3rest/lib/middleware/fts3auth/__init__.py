@@ -15,6 +15,7 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+from authcache import invalidate_auth_cache, auth_cache_stats
 from authorization import *
 from constants import *
 from credentials import *
@@ -0,0 +1,99 @@
+#   Copyright notice:
+#   Copyright CERN, 2015.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Process wide copy of the operations granted by DN in the database, so
+authenticating a request does not need to query the database.
+The whole table is reloaded at most every fts3.AuthCacheTTL seconds, so changes
+done by other processes are picked up within that time.
+Writers in this process must call invalidate_auth_cache to see the change immediately.
+Bans are handled by fts3rest.lib.banning
+"""
+
+import logging
+import threading
+import time
+
+from fts3.model import AuthorizationByDn
+from fts3rest.lib.base import Session
+
+log = logging.getLogger(__name__)
+
+
+class _DnGrants(object):
+    """
+    In memory map dn => operations granted in the database
+    """
+
+    def __init__(self, refresh_interval=60):
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._grants = dict()
+        self._next_refresh = 0
+        self.loads = 0
+
+    def _refresh(self):
+        if time.time() < self._next_refresh:
+            return
+        with self._lock:
+            now = time.time()
+            if now < self._next_refresh:
+                return
+            grants = dict()
+            for dn, operation in Session.query(AuthorizationByDn.dn, AuthorizationByDn.operation):
+                grants.setdefault(dn, []).append(operation)
+            self._grants = dict((dn, tuple(operations)) for dn, operations in grants.iteritems())
+            self._next_refresh = now + self.refresh_interval
+            self.loads += 1
+            log.debug('Loaded the grants of %d DNs' % len(self._grants))
+
+    def get(self, user_dn):
+        self._refresh()
+        return self._grants.get(user_dn, ())
+
+    def invalidate(self):
+        with self._lock:
+            self._next_refresh = 0
+
+    def stats(self):
+        return dict(size=len(self._grants), loads=self.loads, refresh_interval=self.refresh_interval)
+
+
+_dn_grants = _DnGrants()
+
+
+def configure_auth_cache(config):
+    """
+    Set the refresh interval from the configuration
+    """
+    _dn_grants.refresh_interval = int(config.get('fts3.AuthCacheTTL', 60))
+
+
+def get_dn_grants(user_dn):
+    """
+    Operations granted to user_dn in the database
+    """
+    return _dn_grants.get(user_dn)
+
+
+def invalidate_auth_cache():
+    """
+    Force a reload of the grants of all the DNs on the next access
+    """
+    _dn_grants.invalidate()
+
+
+def auth_cache_stats():
+    return _dn_grants.stats()
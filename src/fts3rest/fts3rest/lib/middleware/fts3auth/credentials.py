@@ -15,13 +15,11 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
-import copy
 import hashlib
 import logging
 import re
 
-from fts3.model import AuthorizationByDn
-from fts3rest.lib.base import Session
+from authcache import get_dn_grants
 from methods import Authenticator
 
 log = logging.getLogger(__name__)
@@ -84,6 +82,27 @@ def build_vo_from_dn(user_dn):
     return uname + '@' + '.'.join(reversed(domain))
 
 
+class RolePermissions(object):
+    """
+    Role permissions as configured in the FTS3 config file, compiled once into
+    an immutable table role => ((operation, level), ...)
+    """
+
+    def __init__(self, role_permissions):
+        self._table = dict(
+            (role, tuple(levels.iteritems())) for role, levels in role_permissions.iteritems()
+        )
+
+    def granted_level(self, roles):
+        """
+        Levels granted to public, plus those for the given roles
+        """
+        granted_level = dict(self._table.get('public', ()))
+        for role in roles:
+            granted_level.update(self._table.get(role, ()))
+        return granted_level
+
+
 class InvalidCredentials(Exception):
     """
     Credentials have been provided, but they are invalid
@@ -113,7 +132,8 @@ class UserCredentials(object):
 
         Args:
             env:              Environment (i.e. os.environ)
-            role_permissions: The role permissions as configured in the FTS3 config file
+            role_permissions: The role permissions as configured in the FTS3 config file,
+                              or already compiled into RolePermissions
         """
         # Default
         self.user_dn   = None
@@ -165,20 +185,16 @@ class UserCredentials(object):
 
         granted_level = dict()
 
-        # Public apply to anyone
+        # Public apply to anyone, plus the roles from the proxy
         if role_permissions is not None:
-            if 'public' in role_permissions:
-                granted_level = copy.deepcopy(role_permissions['public'])
-
-            # Roles from the proxy
-            for grant in self.roles:
-                if grant in role_permissions:
-                    granted_level.update(copy.deepcopy(role_permissions[grant]))
+            if not isinstance(role_permissions, RolePermissions):
+                role_permissions = RolePermissions(role_permissions)
+            granted_level = role_permissions.granted_level(self.roles)
 
         # DB Configuration
-        for grant in Session.query(AuthorizationByDn).filter(AuthorizationByDn.dn == self.user_dn).all():
-            log.info('%s granted to "%s" because it is configured in the database' % (grant.operation, self.user_dn))
-            granted_level[grant.operation] = 'all'
+        for operation in get_dn_grants(self.user_dn):
+            log.info('%s granted to "%s" because it is configured in the database' % (operation, self.user_dn))
+            granted_level[operation] = 'all'
 
         return granted_level
 
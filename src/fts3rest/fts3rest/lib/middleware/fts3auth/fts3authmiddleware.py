@@ -17,9 +17,11 @@
 
 import logging
 
+from fts3rest.lib.banning import ban_index, configure_ban_index
 from fts3rest.lib.base import Session
-from fts3.model import BannedDN
-from credentials import UserCredentials, InvalidCredentials
+from fts3rest.lib.oauth2provider import configure_token_cache
+from authcache import configure_auth_cache
+from credentials import RolePermissions, UserCredentials, InvalidCredentials
 from sqlalchemy.exc import DatabaseError
 from urlparse import urlparse
 from webob.exc import HTTPUnauthorized, HTTPForbidden, HTTPError
@@ -37,6 +39,10 @@ class FTS3AuthMiddleware(object):
     def __init__(self, wrap_app, config):
         self.app    = wrap_app
         self.config = config
+        self.role_permissions = RolePermissions(config.get('fts3.Roles', {}))
+        configure_auth_cache(config)
+        configure_token_cache(config)
+        configure_ban_index(config)
 
     def _trusted_origin(self, environ, parsed):
         allow_origin = environ.get('ACCESS_CONTROL_ORIGIN', None)
@@ -57,7 +63,7 @@ class FTS3AuthMiddleware(object):
 
     def _get_credentials(self, environ):
         try:
-            credentials = UserCredentials(environ, self.config['fts3.Roles'], self.config)
+            credentials = UserCredentials(environ, self.role_permissions, self.config)
         except InvalidCredentials, e:
             raise HTTPForbidden('Invalid credentials (%s)' % str(e))
 
@@ -101,5 +107,4 @@ class FTS3AuthMiddleware(object):
         return False
 
     def _is_banned(self, credentials):
-        banned = Session.query(BannedDN).get(credentials.user_dn)
-        return banned is not None
+        return ban_index.is_dn_banned(credentials.user_dn)
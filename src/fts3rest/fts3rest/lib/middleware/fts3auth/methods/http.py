@@ -15,7 +15,11 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import glob
+import os
 import re
+import threading
+import time
 import dateutil.parser
 import logging
 import urllib
@@ -26,14 +30,117 @@ from M2Crypto import X509, EVP
 from m2ext import SSL
 
 from fts3rest.lib.middleware.fts3auth.credentials import InvalidCredentials, build_vo_from_dn, generate_delegation_id, vo_from_fqan
-from fts3rest.lib.helpers.voms import VomsClient
+from fts3rest.lib.helpers.voms import get_proxy_fqans, VomsException
+from fts3rest.lib.scheduler.Cache import LRUCache
 
 CAPATH = "/etc/grid-security/certificates"
 
+log = logging.getLogger(__name__)
+
+
+class _ValidationFailed(Exception):
+    pass
+
+
+class _CAStore(object):
+    """
+    Long lived verification context, reloaded only when the modification time
+    of the CA directory changes (i.e. a CA or a CRL is added, replaced or removed),
+    or when a CRL is modified. fetch-crl overwrites the CRLs in place, which does not
+    change the directory, so their modification times are checked too, at most once
+    every check_interval seconds.
+    Successful validations are cached by certificate fingerprint and expiration
+    until the certificate expires or the CA store is reloaded, so a revoked certificate
+    is rejected at most check_interval seconds after its CRL is updated.
+    The cache key includes the generation of the context used for the validation, so
+    a validation against a context replaced meanwhile is never reused.
+    """
+
+    def __init__(self, max_size=10000, entry_life=3600, check_interval=5):
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._capath = None
+        self._mtime = None
+        self._context = None
+        self._generation = 0
+        self._crl_mtime = None
+        self._next_crl_check = 0
+        self._validated = LRUCache(max_size=max_size, entry_life=entry_life)
+
+    def _get_crl_mtime(self):
+        """
+        Latest modification time of the CRLs. Must be called with the lock held.
+        """
+        now = time.time()
+        if now >= self._next_crl_check or self._capath != CAPATH:
+            mtimes = []
+            for path in glob.glob(os.path.join(CAPATH, '*.r[0-9]*')):
+                try:
+                    mtimes.append(os.stat(path).st_mtime)
+                except OSError:
+                    pass
+            self._crl_mtime = max(mtimes) if mtimes else None
+            self._next_crl_check = now + self.check_interval
+        return self._crl_mtime
+
+    def _get_context(self):
+        """
+        Returns a tuple (context, generation), reloading the CA directory if needed
+        """
+        try:
+            mtime = os.stat(CAPATH).st_mtime
+        except OSError:
+            mtime = None
+        with self._lock:
+            mtime = (mtime, self._get_crl_mtime())
+            if self._context is None or self._capath != CAPATH or self._mtime != mtime:
+                log.debug("Loading the CA directory %s" % CAPATH)
+                context = SSL.Context()
+                context.load_verify_locations(capath=CAPATH)
+                self._validated.clear()
+                self._context = context
+                self._generation += 1
+                self._capath = CAPATH
+                self._mtime = mtime
+            return self._context, self._generation
+
+    def _validate(self, context, x509, not_after):
+        if not context.validate_certificate(x509):
+            raise _ValidationFailed()
+        return not_after
+
+    def validate(self, x509):
+        """
+        Returns True if the certificate is trusted
+        """
+        context, generation = self._get_context()
+        not_after = x509.get_not_after().get_datetime().replace(tzinfo=None)
+        key = (x509.get_fingerprint('sha256'), not_after, generation)
+        try:
+            self._validated.get(key, self._validate, context, x509, not_after)
+        except _ValidationFailed:
+            return False
+        if not_after <= datetime.utcnow():
+            self._validated.invalidate(key)
+            return False
+        return True
+
+    def invalidate(self):
+        """
+        Force a reload of the CA directory
+        """
+        with self._lock:
+            self._context = None
+            self._next_crl_check = 0
+
+
+_ca_store = _CAStore()
+
 
 def set_capath(new_capath):
     global CAPATH
     CAPATH = new_capath
+    _ca_store.invalidate()
 
 
 def do_authentication(credentials, env, config=None):
@@ -44,8 +151,6 @@ def do_authentication(credentials, env, config=None):
     if not 'HTTP_AUTHORIZATION' in env or not env['HTTP_AUTHORIZATION'].lower().startswith('signed-cert'):
         return False
 
-    log = logging.getLogger(__name__)
-
     # Parse Authorization header into key="value" pairs
     cred = dict((k.lower(), v) for k, v in re.findall(r"(\w+)\s*=\s*\"([^\"]+)\"", env['HTTP_AUTHORIZATION']))
 
@@ -107,15 +212,12 @@ def do_authentication(credentials, env, config=None):
         log.info("Signature verification failed")
         raise InvalidCredentials()
 
-    ctx = SSL.Context()
-    ctx.load_verify_locations(capath=CAPATH)
-    print CAPATH
     if proxy:
         log.info("Trying to verify the proxy")
-        if not ctx.validate_certificate(chain):
+        if not _ca_store.validate(chain):
             log.info("Certificate verification failed")
             raise InvalidCredentials("Certificate verification failed")
-    elif not ctx.validate_certificate(x509):
+    elif not _ca_store.validate(x509):
         log.info("Certificate verification failed")
         raise InvalidCredentials("Certificate verification failed")
     credentials.user_dn = certDN
@@ -125,9 +227,11 @@ def do_authentication(credentials, env, config=None):
     if 'SSL_CLIENT_S_DN' in env:
         credentials.dn.append(urllib.unquote_plus(env['SSL_CLIENT_S_DN']))
     if proxy:
-        voms_client = VomsClient(chain_pem)
-        log.info("proxy path: " + voms_client.proxy_path)
-        fqans = voms_client.get_proxy_fqans()
+        try:
+            fqans = get_proxy_fqans([x509, fileCertString], chain_pem)
+        except VomsException, e:
+            log.info(str(e))
+            raise InvalidCredentials("VOMS attributes verification failed")
         for fqan in fqans:
             vo = vo_from_fqan(fqan)
             credentials.voms_cred.append(fqan)
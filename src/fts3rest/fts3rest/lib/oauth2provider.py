@@ -13,9 +13,9 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import hashlib
 import logging
 from datetime import datetime, timedelta
-import json
 import jwt
 import pylons
 from fts3rest.lib.base import Session
@@ -23,7 +23,7 @@ from fts3rest.lib.middleware.fts3auth.constants import VALID_OPERATIONS
 from fts3rest.lib.middleware.fts3auth.credentials import generate_delegation_id
 from fts3rest.lib.oauth2lib.provider import AuthorizationProvider, ResourceAuthorization, ResourceProvider
 from fts3rest.lib.openidconnect import oidc_manager
-from jwcrypto.jwk import JWK
+from fts3rest.lib.scheduler.Cache import LRUCache
 
 
 from fts3.model.credentials import Credential, CredentialCache
@@ -151,6 +151,45 @@ class FTS3OAuth2AuthorizationProvider(AuthorizationProvider):
             Session.commit()
 
 
+class _InvalidToken(Exception):
+    pass
+
+
+class _ValidatedToken(object):
+    """
+    Copy of the credential bound to a validated token, detached from the
+    database session, so it can be reused by later requests
+    """
+
+    def __init__(self, credential, expires):
+        self.dlg_id = credential.dlg_id
+        self.dn = credential.dn
+        self.voms_attrs = credential.voms_attrs
+        self.token = credential.proxy.split(':')[0]
+        self.termination_time = credential.termination_time
+        self.expires = expires
+
+
+# Token hash => _ValidatedToken
+_validated_tokens = LRUCache(max_size=10000, entry_life=300)
+
+
+def configure_token_cache(config):
+    """
+    Set the lifetime of the validated tokens from the configuration
+    """
+    _validated_tokens.entry_life = int(config.get('fts3.TokenCacheTTL', 300))
+
+
+def invalidate_validated_tokens(dlg_id):
+    """
+    Drop the cached tokens bound to the credential dlg_id, so they stop being accepted
+    once it is removed. Removals done by other processes are only seen once the
+    entries expire.
+    """
+    _validated_tokens.invalidate_matching(lambda validated: validated.dlg_id == dlg_id)
+
+
 class FTS3ResourceAuthorization(ResourceAuthorization):
     dlg_id = None
     credentials = None
@@ -185,18 +224,48 @@ class FTS3OAuth2ResourceProvider(ResourceProvider):
         - If there's no credential, Instrospect the token to get additional information (if not done before). Then,
         exchange the access token with a refresh token. Store both tokens in the DB.
 
+        The result is cached, keyed by the token hash, until the token or the credential expire,
+        or fts3.TokenCacheTTL seconds pass, whatever happens first.
+
         :param access_token:
         :param authorization: attribute .is_valid is set to True if validation successful
         """
         authorization.is_valid = False
 
+        token_hash = hashlib.sha256(access_token).hexdigest()
+        try:
+            validated = _validated_tokens.get(token_hash, self._validate_access_token, access_token)
+            if validated.expires <= datetime.utcnow():
+                _validated_tokens.invalidate(token_hash)
+                validated = _validated_tokens.get(token_hash, self._validate_access_token, access_token)
+        except _InvalidToken:
+            return
+        # Even freshly validated, the token, or its credential, may have expired
+        if validated.expires <= datetime.utcnow():
+            log.debug("Access token has expired")
+            return
+
+        authorization.is_oauth = True
+        authorization.token = validated.token
+        authorization.dlg_id = validated.dlg_id
+        authorization.expires_in = validated.termination_time - datetime.utcnow()
+        if authorization.expires_in > timedelta(seconds=0):
+            authorization.credentials = validated
+            authorization.is_valid = True
+
+    def _validate_access_token(self, access_token):
+        """
+        Do the actual validation of the token
+        :return: a _ValidatedToken
+        :raise _InvalidToken: if the token is not valid
+        """
         if self._should_validate_offline():
             valid, credential = self._validate_token_offline(access_token)
         else:
             valid, credential = self._validate_token_online(access_token)
         if not valid:
             log.warning("Access token provided is not valid")
-            return
+            raise _InvalidToken()
 
         # Check if a credential already exists in the DB
         credential_db = Session.query(Credential).filter(Credential.dn == credential['sub']).first()
@@ -204,6 +273,7 @@ class FTS3OAuth2ResourceProvider(ResourceProvider):
             log.debug("credential_db_has_expired")
             Session.delete(credential_db)
             Session.commit()
+            invalidate_validated_tokens(credential_db.dlg_id)
             credential_db = None
 
         if not credential_db:
@@ -213,7 +283,7 @@ class FTS3OAuth2ResourceProvider(ResourceProvider):
                 valid, credential = self._validate_token_online(access_token)
                 if not valid:
                     log.debug("Access token provided is not valid")
-                    return
+                    raise _InvalidToken()
             # Store credential in DB
             log.debug("Store credential in DB")
             dlg_id = generate_delegation_id(credential['sub'], "")
@@ -230,26 +300,16 @@ class FTS3OAuth2ResourceProvider(ResourceProvider):
                 else:
                     refresh_token = oidc_manager.generate_refresh_token(credential['iss'], access_token)
             except Exception:
-                return
+                raise _InvalidToken()
             credential_db = self._save_credential(dlg_id, credential['sub'],
                                                   str(access_token) + ':' + str(refresh_token),
                                                   self._generate_voms_attrs(credential),
                                                   datetime.utcfromtimestamp(credential['exp']))
 
-        authorization.is_oauth = True
-        authorization.token = credential_db.proxy.split(':')[0]
-        authorization.dlg_id = credential_db.dlg_id
-        authorization.expires_in = credential_db.termination_time - datetime.utcnow()
-        if authorization.expires_in > timedelta(seconds=0):
-            authorization.credentials = self._get_credentials(credential_db.dlg_id)
-            if authorization.credentials:
-                authorization.is_valid = True
-
-    def _get_credentials(self, dlg_id):
-        """
-        Get the user credentials bound to the authorization token
-        """
-        return Session.query(Credential).filter(Credential.dlg_id == dlg_id).first()
+        expires = credential_db.termination_time
+        if credential.get('exp'):
+            expires = min(expires, datetime.utcfromtimestamp(credential['exp']))
+        return _ValidatedToken(credential_db, expires)
 
     def _generate_voms_attrs(self, credential):
         attrs = [
@@ -268,20 +328,19 @@ class FTS3OAuth2ResourceProvider(ResourceProvider):
         :return: tuple(valid, credential) or tuple(False, None)
         """
 
-        def decode(key):
-            log.debug('Attempt decoding using key={}'.format(key.export()))
+        def decode(pem):
             try:
                 if 'wlcg' in issuer:
                     audience = 'https://wlcg.cern.ch/jwt/v1/any'
                     credential = jwt.decode(access_token,
-                                            key.export_to_pem(),
+                                            pem,
                                             algorithms=[algorithm],
                                             audience=audience
                                             )
                 else:
                     # We don't check audience for non-WLCG token
                     credential = jwt.decode(access_token,
-                                            key.export_to_pem(),
+                                            pem,
                                             algorithms=[algorithm],
                                             options={'verify_aud': False}
                                             )
@@ -298,13 +357,12 @@ class FTS3OAuth2ResourceProvider(ResourceProvider):
             key_id = unverified_header.get('kid')
             algorithm = unverified_header.get('alg')
             log.debug('issuer={}, key_id={}, alg={}'.format(issuer, key_id, algorithm))
-            # Retrieval of keys
-            keys = oidc_manager.filter_provider_keys(issuer, key_id, algorithm)
-            jwkeys = [JWK.from_json(json.dumps(key.to_dict())) for key in keys]
+            # Retrieval of keys, already PEM encoded
+            pems = oidc_manager.filter_provider_pems(issuer, key_id, algorithm)
 
             # Find the first key which decodes the token
-            for jwkey in jwkeys:
-                credential = decode(jwkey)
+            for pem in pems:
+                credential = decode(pem)
                 if credential is not None:
                     log.debug('offline_response::: {}'.format(credential))
                     break
@@ -1,7 +1,9 @@
+import json
 import logging
 from datetime import datetime
 
 import jwt
+from jwcrypto.jwk import JWK
 from oic import rndstr
 from oic.extension.message import TokenIntrospectionRequest, TokenIntrospectionResponse
 from oic.oic import Client, Grant, Token
@@ -9,9 +11,15 @@ from oic.oic.message import AccessTokenResponse, Message, RegistrationResponse
 from oic.utils import time_util
 from oic.utils.authn.client import CLIENT_AUTHN_METHOD
 
+from fts3rest.lib.scheduler.Cache import LRUCache
+
 log = logging.getLogger(__name__)
 
 
+def _export_to_pem(serialized):
+    return JWK.from_json(serialized).export_to_pem()
+
+
 class OIDCmanager:
     """
     Class that interfaces with PyOIDC
@@ -23,6 +31,8 @@ class OIDCmanager:
     def __init__(self):
         self.clients = {}
         self.config = None
+        # Serialized JWK => PEM, bounded so keys rotated by the providers do not pile up
+        self._pem_cache = LRUCache(max_size=1000, entry_life=86400)
 
     def setup(self, config):
         self.config = config
@@ -79,6 +89,20 @@ class OIDCmanager:
             return keys
         return filtered_keys
 
+    def filter_provider_pems(self, issuer, kid=None, alg=None):
+        """
+        Same as filter_provider_keys, but the keys are returned PEM encoded.
+        The conversion is done only once per key, so it is only repeated when
+        the provider publishes new keys.
+        :return: list of PEM encoded keys
+        :raise ValueError: client could not be retrieved
+        """
+        pems = []
+        for key in self.filter_provider_keys(issuer, kid, alg):
+            serialized = json.dumps(key.to_dict(), sort_keys=True)
+            pems.append(self._pem_cache.get(serialized, _export_to_pem, serialized))
+        return pems
+
     def introspect(self, issuer, access_token):
         """
         Make a Token Introspection request
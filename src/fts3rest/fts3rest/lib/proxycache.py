@@ -0,0 +1,142 @@
+#   Copyright notice:
+#   Copyright CERN, 2015.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import atexit
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from datetime import datetime
+
+log = logging.getLogger(__name__)
+
+
+class ProxyFile(object):
+    """
+    A delegated proxy written to disk. name is the path of the file.
+    """
+
+    def __init__(self, dlg_id, termination_time, name):
+        self.dlg_id = dlg_id
+        self.termination_time = termination_time
+        self.name = name
+        self.refs = 0
+        self.stale = False
+
+
+class ProxyFileCache(object):
+    """
+    Keeps the delegated proxies written to disk, one file per (dlg_id, termination_time),
+    so they are written once and reused by the following requests.
+    Files are reference counted: a file replaced by a newer credential, or expired, is only
+    removed once nobody uses it anymore.
+    """
+
+    def __init__(self, base_directory=None):
+        self.base_directory = base_directory
+        self._directory = None
+        self._owner = None
+        self._files = dict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.writes = 0
+
+    def _get_directory(self):
+        # Each process has its own directory, removed when it exits
+        if self._directory is None or self._owner != os.getpid():
+            self._files = dict()
+            self._owner = os.getpid()
+            self._directory = tempfile.mkdtemp(prefix='fts3rest-proxies-', dir=self.base_directory)
+            atexit.register(self._cleanup, self._owner, self._directory)
+        return self._directory
+
+    @staticmethod
+    def _cleanup(owner, directory):
+        if os.getpid() == owner:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def _write(self, dlg_id, termination_time, proxy):
+        fd, path = tempfile.mkstemp(suffix='.pem', prefix='proxy-', dir=self._get_directory())
+        try:
+            os.write(fd, proxy)
+        finally:
+            os.close(fd)
+        self.writes += 1
+        return ProxyFile(dlg_id, termination_time, path)
+
+    def _discard(self, proxy_file):
+        proxy_file.stale = True
+        if proxy_file.refs == 0:
+            try:
+                os.unlink(proxy_file.name)
+            except OSError, e:
+                log.warning('Could not remove %s: %s' % (proxy_file.name, str(e)))
+
+    def _purge_expired(self):
+        now = datetime.utcnow()
+        for dlg_id, proxy_file in self._files.items():
+            if proxy_file.termination_time <= now:
+                del self._files[dlg_id]
+                self._discard(proxy_file)
+
+    def acquire(self, dlg_id, termination_time, proxy):
+        """
+        Returns the ProxyFile with the proxy of dlg_id, writing it if there is none for
+        termination_time. It must be given back with release.
+        """
+        with self._lock:
+            self._get_directory()
+            self._purge_expired()
+            proxy_file = self._files.get(dlg_id)
+            if proxy_file is not None and proxy_file.termination_time == termination_time:
+                self.hits += 1
+            else:
+                if proxy_file is not None:
+                    self._discard(proxy_file)
+                proxy_file = self._write(dlg_id, termination_time, proxy)
+                self._files[dlg_id] = proxy_file
+            proxy_file.refs += 1
+            return proxy_file
+
+    def release(self, proxy_file):
+        """
+        Give back a file obtained with acquire
+        """
+        with self._lock:
+            proxy_file.refs -= 1
+            if proxy_file.stale:
+                self._discard(proxy_file)
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                files=len(self._files),
+                in_use=sum(1 for f in self._files.itervalues() if f.refs > 0),
+                hits=self.hits,
+                writes=self.writes
+            )
+
+
+proxy_cache = ProxyFileCache()
+
+
+def configure_proxy_cache(config):
+    """
+    Set the directory where the proxies are written. By default, /dev/shm if available,
+    so they never reach the disk.
+    """
+    default = '/dev/shm' if os.access('/dev/shm', os.W_OK) else None
+    proxy_cache.base_directory = config.get('fts3.ProxyCacheDirectory', default)
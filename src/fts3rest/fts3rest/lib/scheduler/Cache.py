@@ -1,129 +1,235 @@
 import threading
-import hashlib
 import logging
+import time
 
-from datetime import datetime
+from collections import OrderedDict
 
 log = logging.getLogger(__name__)
-threadLocal = threading.local()
 
-class ThreadLocalCache:
+
+class LRUCache(object):
     """
-    ThreadLocalCache class provides an in memory cache for each thread
+    Bounded, thread safe, cache with a per-entry time to live and
+    least-recently-used eviction.
+
+    Concurrent misses for the same key are collapsed: only one thread
+    calls the loader, the rest wait for its result (single-flight).
     """
-    initialized = False
 
-    # Run cache clean_cleanup after every 5 mins (1800 secs)
-    cache_refresh_time = 1800
+    def __init__(self, max_size=10000, entry_life=300):
+        self.max_size = max_size
+        self.entry_life = entry_life
 
-    # Expire cache entry after 5 mins (300 secs)
-    cache_entry_life = 300
+        self._lock = threading.Lock()
+        # key -> (value, expiration timestamp)
+        self._entries = OrderedDict()
+        # key -> threading.Event set when the loading thread is done
+        self._loading = dict()
 
-    def __init__(self, queue_provider):
-        self.queue_provider = queue_provider
-        if getattr(threadLocal, 'initialized', None) is None:
-            ThreadLocalCache.init_cache()
-            threadLocal.initialized = True
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
-    @staticmethod
-    def init_cache():
+    def _evict(self):
         """
-        Maintain a separate cache for submitted, success, throughput etc 
+        Drop entries from the least recently used side until there is room.
+        Must be called with the lock held.
         """
-        threadLocal.creation_time = datetime.utcnow() 
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
 
-        threadLocal.submitted_dict = {}
-        threadLocal.success_dict = {}
-        threadLocal.throughput_dict = {}
-        threadLocal.per_file_throughput_dict = {}
-        threadLocal.pending_data_dict = {}
+    def get(self, key, loader, *args):
+        """
+        Return the value cached for key. If it is not there, or it expired,
+        loader(*args) is called to get a fresh one.
+        """
+        return self.get_many([key], lambda missing: {key: loader(*args)})[key]
 
-    @staticmethod
-    def get_seconds_elapsed(time_diff):
-        seconds = (time_diff.days * 86400) + time_diff.seconds
-        return seconds
+    def get_many(self, keys, loader):
+        """
+        Return a dictionary key => value for all the given keys.
+        Those not cached, or expired, are resolved calling once loader(missing),
+        which must return a dictionary with a value for each of the missing keys.
+        Keys being already loaded by another thread are waited for instead.
+        """
+        result = dict()
+        pending = list(keys)
+
+        while pending:
+            claimed = list()
+            waiting = list()
+
+            with self._lock:
+                now = time.time()
+                event = threading.Event()
+                for key in pending:
+                    if key in result or key in claimed:
+                        continue
+                    entry = self._entries.pop(key, None)
+                    if entry is not None and entry[1] > now:
+                        # Re-insert so it becomes the most recently used
+                        self._entries[key] = entry
+                        self.hits += 1
+                        result[key] = entry[0]
+                    elif key in self._loading:
+                        waiting.append((key, self._loading[key]))
+                    else:
+                        self._loading[key] = event
+                        self.misses += 1
+                        claimed.append(key)
+
+            if claimed:
+                try:
+                    values = loader(claimed)
+                    with self._lock:
+                        expiration = time.time() + self.entry_life
+                        for key in claimed:
+                            self._entries[key] = (values[key], expiration)
+                            result[key] = values[key]
+                        self._evict()
+                finally:
+                    with self._lock:
+                        for key in claimed:
+                            del self._loading[key]
+                    event.set()
+
+            # Somebody else is loading these keys, wait and retry
+            for key, other in waiting:
+                other.wait()
+            pending = [key for key, other in waiting]
+
+        return result
+
+    def invalidate(self, *keys):
+        """
+        Drop the entries for the given keys, if present
+        """
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
 
-    @staticmethod
-    def check_expiry(t, entry_life):
-        secs = ThreadLocalCache.get_seconds_elapsed(datetime.utcnow() - t)
-        return True if secs > entry_life else False
+    def invalidate_matching(self, predicate):
+        """
+        Drop the entries whose value satisfies predicate
+        """
+        with self._lock:
+            for key, entry in self._entries.items():
+                if predicate(entry[0]):
+                    del self._entries[key]
 
-    @staticmethod
-    def get_key(*args):
-        key = 0
-        for x in args:
-            key += hash(x)
-        return key
+    def clear(self):
+        """
+        Drop all entries
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Return the cache counters
+        """
+        with self._lock:
+            return dict(
+                size=len(self._entries),
+                max_size=self.max_size,
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions
+            )
+
+
+class SharedCache:
+    """
+    SharedCache class provides an in memory cache shared by all threads
+    of the process. Keys are the tuple (metric, arguments...), so different
+    links never collide.
+    """
+
+    # Maximum number of entries kept
+    cache_max_size = 10000
+
+    # Expire cache entry after 5 mins (300 secs)
+    cache_entry_life = 300
+
+    cache = LRUCache(cache_max_size, cache_entry_life)
+
+    def __init__(self, queue_provider):
+        self.queue_provider = queue_provider
 
     @staticmethod
     def cache_cleanup():
-        threadLocal.creation_time = datetime.utcnow()
-
-        # Get dictionaries from threadLocal
-        dict_list = []
-        for attr in dir(threadLocal):
-            if attr.endswith("_dict"):
-                dict_list.append(getattr(threadLocal, attr, None))
+        SharedCache.cache.clear()
 
-        # Remove expired entries from cache
-        for _dict in dict_list:
-            for key in _dict.keys():
-                if ThreadLocalCache.check_expiry(_dict[key][1],
-                                                 ThreadLocalCache.cache_entry_life):
-                    del _dict[key]
+    @staticmethod
+    def cache_stats():
+        return SharedCache.cache.stats()
 
     @staticmethod
-    def cache_wrapper(dict_name, func, *args):
+    def cache_wrapper(metric, func, *args):
         """
         cache_wrapper gets info from cache, in case the cache entry is expired
         or not present in cache, FTS db is queried to update the cache.
-        All expired entries from cache are eventually removed after the 
-        cache_refresh_time expires 
-        """
-        val = []
-        thread_dict = getattr(threadLocal, dict_name, None)
-        key = ThreadLocalCache.get_key(*args)
-
-        if ThreadLocalCache.check_expiry(threadLocal.creation_time,
-                                         ThreadLocalCache.cache_refresh_time):
-            ThreadLocalCache.cache_cleanup()
-
-        if key not in thread_dict:
-            val.append(func(*args))
-            val.append(datetime.utcnow())
-            thread_dict[key] = val
-        else:
-            val = thread_dict[key]
-            if ThreadLocalCache.check_expiry(val[1],
-                                             ThreadLocalCache.cache_entry_life):
-                val = []
-                val.append(func(*args))
-                val.append(datetime.utcnow())
-                thread_dict[key] = val
-        return val[0]
+        """
+        return SharedCache.cache.get((metric,) + args, func, *args)
 
+    @staticmethod
+    def _metric_key(metric, src, dst, vo, user_activity):
+        """
+        Build the cache key of a metric, with only the arguments it depends on
+        """
+        if metric == 'submitted':
+            return (metric, src, dst, vo)
+        elif metric == 'pending_data':
+            return (metric, src, dst, vo, user_activity)
+        return (metric, src, dst)
+
+    def get_link_metrics(self, sources, dst, vo, user_activity, metrics):
+        """
+        Batch version of the getters. Only the links missing from the cache
+        are queried, and all of them at once.
+        """
+        keys = dict()
+        for src in sources:
+            for metric in metrics:
+                keys[(src, metric)] = SharedCache._metric_key(metric, src, dst, vo, user_activity)
+
+        def _loader(missing):
+            missing_sources = set(key[1] for key in missing)
+            missing_metrics = set(key[0] for key in missing)
+            values = self.queue_provider.get_link_metrics(
+                list(missing_sources), dst, vo, user_activity, missing_metrics
+            )
+            return dict((key, values[key[1]][key[0]]) for key in missing)
+
+        cached = SharedCache.cache.get_many(keys.values(), _loader)
+
+        result = dict()
+        for (src, metric), key in keys.iteritems():
+            result.setdefault(src, dict())[metric] = cached[key]
+        return result
 
     def get_submitted(self, src, dst, vo):
-        return ThreadLocalCache.cache_wrapper('submitted_dict',
-                                              self.queue_provider.get_submitted,
-                                              src, dst, vo)
+        return SharedCache.cache_wrapper('submitted',
+                                         self.queue_provider.get_submitted,
+                                         src, dst, vo)
 
     def get_success_rate(self, src, dst):
-        return ThreadLocalCache.cache_wrapper('success_dict',
-                                              self.queue_provider.get_success_rate,
-                                              src, dst)
+        return SharedCache.cache_wrapper('success',
+                                         self.queue_provider.get_success_rate,
+                                         src, dst)
 
     def get_throughput(self, src, dst):
-        return ThreadLocalCache.cache_wrapper('throughput_dict',
-                                              self.queue_provider.get_throughput,
-                                              src, dst)
+        return SharedCache.cache_wrapper('throughput',
+                                         self.queue_provider.get_throughput,
+                                         src, dst)
 
     def get_per_file_throughput(self, src, dst):
-        return ThreadLocalCache.cache_wrapper('per_file_throughput_dict',
-                                              self.queue_provider.get_per_file_throughput,
-                                              src, dst)
+        return SharedCache.cache_wrapper('per_file_throughput',
+                                         self.queue_provider.get_per_file_throughput,
+                                         src, dst)
 
     def get_pending_data(self, src, dst, vo, user_activity):
-        return ThreadLocalCache.cache_wrapper('pending_data_dict',
-                                              self.queue_provider.get_pending_data,
-                                              src, dst, vo, user_activity)
+        return SharedCache.cache_wrapper('pending_data',
+                                         self.queue_provider.get_pending_data,
+                                         src, dst, vo, user_activity)
@@ -14,6 +14,12 @@ from datetime import timedelta
 
 log = logging.getLogger(__name__)
 
+# Metrics that can be requested to get_link_metrics
+LINK_METRICS = ('submitted', 'success', 'throughput', 'per_file_throughput', 'pending_data')
+
+# These come all from the same aggregation over t_optimizer_evolution
+OPTIMIZER_METRICS = ('success', 'throughput', 'per_file_throughput')
+
 
 class Database:
     """
@@ -39,60 +45,20 @@ class Database:
         """
         Returns the success rate for a given src, dst pair in the last hour
         """
-        sum = 0
-        arr = self.session.query(OptimizerEvolution.success)\
-                          .filter(OptimizerEvolution.source_se == src)\
-                          .filter(OptimizerEvolution.dest_se == dst)\
-                          .filter(OptimizerEvolution.datetime >= 
-                                  (datetime.utcnow() - timedelta(hours=1)))
-        size = 0
-        for x in arr:
-            sum += x[0]
-            size += 1
-        return 100 if (sum == 0) else (sum / size)
+        return self._get_optimizer_many([src], dst).get(src, (100, 0, 0))[0]
 
     def get_throughput(self, src, dst):
         """
         Returns the throughput infomation in the last hour for a src, dst pair.
         """
-        total_throughput = 0
-        size = 0
-
-        for tp, active in self.session.query\
-            (OptimizerEvolution.throughput, OptimizerEvolution.active)\
-            .filter(OptimizerEvolution.source_se == src)\
-            .filter(OptimizerEvolution.dest_se == dst)\
-            .filter(OptimizerEvolution.datetime >=
-                    (datetime.utcnow() - timedelta(hours=1))):
-            total_throughput += tp * active
-            size += 1
-
-        if size == 0:
-            return 0
-        else:
-            return (total_throughput/size)
+        return self._get_optimizer_many([src], dst).get(src, (100, 0, 0))[1]
 
     def get_per_file_throughput(self, src, dst):
         """
         Returns the per file throughput info in the last hour for a given src
         dst pair
         """
-        throughput = 0
-        size = 0
-
-        for per_file_throughput in self.session.query\
-            (OptimizerEvolution.throughput)\
-            .filter(OptimizerEvolution.source_se == src)\
-            .filter(OptimizerEvolution.dest_se == dst)\
-            .filter(OptimizerEvolution.datetime >=
-                    (datetime.utcnow() - timedelta(hours=1))):
-            throughput += per_file_throughput[0]
-            size += 1
-
-        if size == 0:
-            return 0
-        else:
-            return (throughput/size)
+        return self._get_optimizer_many([src], dst).get(src, (100, 0, 0))[2]
 
     def get_pending_data(self, src, dst, vo, user_activity):
         """
@@ -100,25 +66,102 @@ class Database:
         Pending data is aggregated from all activities with priorities >=
         to the user_activity's priority. Only Atlas mentions the ActivityShare.
         """
+        return self._get_pending_data_many([src], dst, vo, user_activity).get(src, 0)
+
+    def _get_submitted_many(self, sources, dst, vo):
+        """
+        Returns the number of submitted files for each src in sources
+        towards dst, for a given vo.
+        """
+        submitted = dict()
+        for src, count in self.session.query(File.source_se, func.count(File.file_id))\
+                                      .filter(File.vo_name == vo)\
+                                      .filter(File.file_state == 'SUBMITTED')\
+                                      .filter(File.dest_se == dst)\
+                                      .filter(File.source_se.in_(sources))\
+                                      .group_by(File.source_se):
+            submitted[src] = count
+        return submitted
+
+    def _get_optimizer_many(self, sources, dst):
+        """
+        Returns a dictionary src => (success rate, throughput, per file throughput)
+        for the last hour, for each src in sources.
+        The aggregation is done by the database, so only one row per source
+        is transferred regardless of how many evolution entries there are.
+        """
+        metrics = dict()
+        for src, success, throughput, file_throughput, size in self.session.query(
+                OptimizerEvolution.source_se,
+                func.sum(OptimizerEvolution.success),
+                func.sum(OptimizerEvolution.throughput * OptimizerEvolution.active),
+                func.sum(OptimizerEvolution.throughput),
+                func.count())\
+                .filter(OptimizerEvolution.source_se.in_(sources))\
+                .filter(OptimizerEvolution.dest_se == dst)\
+                .filter(OptimizerEvolution.datetime >=
+                        (datetime.utcnow() - timedelta(hours=1)))\
+                .group_by(OptimizerEvolution.source_se):
+            success = float(success or 0)
+            metrics[src] = (
+                100 if (success == 0) else (success / size),
+                float(throughput or 0) / size,
+                float(file_throughput or 0) / size
+            )
+        return metrics
+
+    def _get_pending_data_many(self, sources, dst, vo, user_activity):
+        """
+        Returns the pending data in the queue for each src in sources towards
+        dst, with the same activity semantics as get_pending_data.
+        All the selected activities are aggregated at once with an IN (...) clause.
+        """
+        query = self.session.query(File.source_se, func.sum(File.user_filesize))\
+                            .filter(File.source_se.in_(sources))\
+                            .filter(File.dest_se == dst)\
+                            .filter(File.vo_name == vo)\
+                            .filter(File.file_state == 'SUBMITTED')\
+                            .group_by(File.source_se)
+
         share = self.session.query(ActivityShare).get(vo)
-        total_pending_data = 0
-        if share is None:
-            for data in self.session.query(File.user_filesize)\
-                                    .filter(File.source_se == src)\
-                                    .filter(File.dest_se == dst)\
-                                    .filter(File.vo_name == vo)\
-                                    .filter(File.file_state == 'SUBMITTED'):
-                total_pending_data += data[0]
-        else:
+        if share is not None:
             activities = json.loads(share.activity_share)
-            for key in activities.keys():
-                if activities.get(key) >= activities.get(user_activity):
-                    for data in self.session.query(File.user_filesize)\
-                        .filter(File.source_se == src)\
-                        .filter(File.dest_se == dst)\
-                        .filter(File.vo_name == vo)\
-                        .filter(File.activity == key)\
-                            .filter(File.file_state == 'SUBMITTED'):
-                        total_pending_data += data[0]
-
-        return total_pending_data
+            selected = [key for key in activities.keys()
+                        if activities.get(key) >= activities.get(user_activity)]
+            if not selected:
+                return dict()
+            query = query.filter(File.activity.in_(selected))
+
+        pending = dict()
+        for src, total in query:
+            pending[src] = int(total or 0)
+        return pending
+
+    def get_link_metrics(self, sources, dst, vo, user_activity, metrics=LINK_METRICS):
+        """
+        Returns a dictionary src => {metric: value} with the requested metrics
+        for every src in sources towards dst.
+        All sources are resolved at once, with one aggregated query per kind of metric.
+        """
+        unique_sources = list(set(sources))
+        result = dict([(src, dict()) for src in unique_sources])
+
+        if 'submitted' in metrics:
+            submitted = self._get_submitted_many(unique_sources, dst, vo)
+            for src in unique_sources:
+                result[src]['submitted'] = submitted.get(src, 0)
+
+        if any(metric in metrics for metric in OPTIMIZER_METRICS):
+            optimizer = self._get_optimizer_many(unique_sources, dst)
+            for src in unique_sources:
+                success, throughput, file_throughput = optimizer.get(src, (100, 0, 0))
+                result[src]['success'] = success
+                result[src]['throughput'] = throughput
+                result[src]['per_file_throughput'] = file_throughput
+
+        if 'pending_data' in metrics:
+            pending = self._get_pending_data_many(unique_sources, dst, vo, user_activity)
+            for src in unique_sources:
+                result[src]['pending_data'] = pending.get(src, 0)
+
+        return result
@@ -21,7 +21,7 @@ class Scheduler:
 
         Using a caching implementation with scheduler:
         queue_provider = Database(Session)
-        cache_provider = ThreadLocalCache(queue_provider)
+        cache_provider = SharedCache(queue_provider)
         s = Scheduler (cache_provider)
 
         Using a direct database implementation with scheduler:
@@ -41,9 +41,11 @@ class Scheduler:
         Ranks the source sites based on the number of pending files
         in the queue
         """
+        metrics = self.cls.get_link_metrics(sources, dst, vo, None,
+                                            ['submitted'])
         ranks = []
         for src in sources:
-            ranks.append((src, self.cls.get_submitted(src, dst, vo)))
+            ranks.append((src, metrics[src]['submitted']))
         return sorted(ranks, key=operator.itemgetter(1))
 
     def rank_success_rate(self, sources, dst):
@@ -51,9 +53,11 @@ class Scheduler:
         Ranks the source sites based on the success rate of the transfers
         in the last 1 hour
         """
+        metrics = self.cls.get_link_metrics(sources, dst, None, None,
+                                            ['success'])
         ranks = []
         for src in sources:
-            ranks.append((src, self.cls.get_success_rate(src, dst)))
+            ranks.append((src, metrics[src]['success']))
         return sorted(ranks, key=operator.itemgetter(1), reverse=True)
 
     def rank_throughput(self, sources, dst):
@@ -61,9 +65,11 @@ class Scheduler:
         Ranks the source sites based on the total throughput rate between 
         a source destination pair in the last 1 hour
         """
+        metrics = self.cls.get_link_metrics(sources, dst, None, None,
+                                            ['throughput'])
         ranks = []
         for src in sources:
-            throughput = self.cls.get_throughput(src, dst)
+            throughput = metrics[src]['throughput']
             if throughput == 0:
                 return Scheduler.select_source(src, throughput)
             ranks.append((src, throughput))
@@ -74,9 +80,11 @@ class Scheduler:
         Ranks the source sites based on the per file throughput rate between 
         a source destination pair in the last 1 hour
         """
+        metrics = self.cls.get_link_metrics(sources, dst, None, None,
+                                            ['per_file_throughput'])
         ranks = []
         for src in sources:
-            per_file_throughput = self.cls.get_per_file_throughput(src, dst)
+            per_file_throughput = metrics[src]['per_file_throughput']
             if per_file_throughput == 0:
                 return Scheduler.select_source(src, per_file_throughput)
             ranks.append((src, per_file_throughput))
@@ -89,10 +97,11 @@ class Scheduler:
         amount of data from all activites with priorities >= to the 
         user_activities's priority
         """
+        metrics = self.cls.get_link_metrics(sources, dst, vo, user_activity,
+                                            ['pending_data'])
         ranks = []
         for src in sources:
-            ranks.append((src, self.cls.get_pending_data(src, dst, vo,
-                                                         user_activity)))
+            ranks.append((src, metrics[src]['pending_data']))
         return sorted(ranks, key=operator.itemgetter(1))
 
     def rank_waiting_time(self, sources, dst, vo, user_activity):
@@ -100,11 +109,12 @@ class Scheduler:
         Ranks the source sites based on the waiting time for the incoming 
         job in the queue
         """
+        metrics = self.cls.get_link_metrics(sources, dst, vo, user_activity,
+                                            ['pending_data', 'throughput'])
         ranks = []
         for src in sources:
-            pending_data = self.cls.get_pending_data(src, dst, vo,
-                                                     user_activity)
-            throughput = self.cls.get_throughput(src, dst)
+            pending_data = metrics[src]['pending_data']
+            throughput = metrics[src]['throughput']
             if throughput == 0:
                 return Scheduler.select_source(src, throughput)
             waiting_time = pending_data / throughput
@@ -117,15 +127,17 @@ class Scheduler:
         be resent. Rank based on the waiting time plus the time for resending 
         failed data
         """
+        metrics = self.cls.get_link_metrics(sources, dst, vo, user_activity,
+                                            ['pending_data', 'throughput',
+                                             'success'])
         ranks = []
         for src in sources:
-            pending_data = self.cls.get_pending_data(src, dst, vo,
-                                                     user_activity)
-            throughput = self.cls.get_throughput(src, dst)
+            pending_data = metrics[src]['pending_data']
+            throughput = metrics[src]['throughput']
             if throughput == 0:
                 return Scheduler.select_source(src, throughput)
             waiting_time = pending_data / throughput
-            failure_rate = 100 - self.cls.get_success_rate(src, dst)
+            failure_rate = 100 - metrics[src]['success']
             error = failure_rate * waiting_time / 100
             wait_time_with_error = waiting_time + error
             ranks.append((src, wait_time_with_error))
@@ -137,18 +149,20 @@ class Scheduler:
         Ranks the source sites based on the waiting time with error plus the
         time required to transfer the file
         """
+        metrics = self.cls.get_link_metrics(sources, dst, vo, user_activity,
+                                            ['pending_data', 'throughput',
+                                             'success', 'per_file_throughput'])
         ranks = []
         for src in sources:
-            pending_data = self.cls.get_pending_data(src, dst, vo,
-                                                     user_activity)
-            throughput = self.cls.get_throughput(src, dst)
+            pending_data = metrics[src]['pending_data']
+            throughput = metrics[src]['throughput']
             if throughput == 0:
                 return Scheduler.select_source(src, throughput)
             waiting_time = pending_data / throughput
-            failure_rate = 100 - self.cls.get_success_rate(src, dst)
+            failure_rate = 100 - metrics[src]['success']
             error = failure_rate * waiting_time / 100
             wait_time_with_error = waiting_time + error
-            file_throughput = self.cls.get_per_file_throughput(src, dst)
+            file_throughput = metrics[src]['per_file_throughput']
             file_transfer_time = (user_file_size/1024/1024) / file_throughput
             finish_time = wait_time_with_error + file_transfer_time
             ranks.append((src, finish_time))
@@ -39,6 +39,7 @@ from pylons import url, config
 from routes.util import URLGenerator
 from webtest import TestApp, TestRequest
 
+from fts3rest.lib.banning import ban_index
 from fts3rest.lib.middleware import fts3auth
 from fts3rest.lib.base import Session
 from fts3.model import Credential, CredentialCache, DataManagement
@@ -265,6 +266,10 @@ class TestController(TestCase):
         Session.query(ServerConfig).delete()
         Session.commit()
 
+        # Tests may modify the authorization and ban tables directly
+        fts3auth.invalidate_auth_cache()
+        ban_index.invalidate()
+
         # Delete messages
         if 'fts3.MessagingDirectory' in config:
             try:
@@ -14,11 +14,16 @@
 #   limitations under the License.
 
 import json
+import mock
 import urllib
 from datetime import datetime, timedelta
 
+from pylons import config
+
 from fts3.model import BannedDN, BannedSE, Job, File
+from fts3rest.controllers import banning
 from fts3rest.lib.base import Session
+from fts3rest.lib.cancellation import iter_chunks
 from fts3rest.tests import TestController
 from insert_job import insert_job
 
@@ -75,6 +80,27 @@ class TestBanning(TestController):
         banned = self.app.get(url='/ban/dn', status=200).json
         self.assertNotIn('/DC=cern/CN=someone', [b['dn'] for b in banned])
 
+    def test_ban_dn_cached(self):
+        """
+        Banning and unbanning must be effective immediately, even if the
+        user authorization is cached
+        """
+        self.setup_gridsite_environment(dn='/DC=cern/CN=someone')
+        self.app.get(url='/whoami', status=200)
+        self.app.get(url='/whoami', status=200)
+
+        self.setup_gridsite_environment()
+        self.app.post(url='/ban/dn', params={'user_dn': '/DC=cern/CN=someone'}, status=200)
+
+        self.setup_gridsite_environment(dn='/DC=cern/CN=someone')
+        self.app.get(url='/whoami', status=403)
+
+        self.setup_gridsite_environment()
+        self.app.delete(url='/ban/dn?user_dn=%s' % urllib.quote('/DC=cern/CN=someone'), status=204)
+
+        self.setup_gridsite_environment(dn='/DC=cern/CN=someone')
+        self.app.get(url='/whoami', status=200)
+
     def test_ban_dn_submission(self):
         """
         If a DN is banned, submissions from this user must not be accepted
@@ -262,6 +288,98 @@ class TestBanning(TestController):
             else:
                 self.assertEqual('SUBMITTED', f.file_state)
 
+    def test_ban_se_cancel_chunked(self):
+        """
+        Ban a SE with more queued files than fit in one chunk
+        """
+        chunk_size = config.get('fts3.BanChunkSize')
+        config['fts3.BanChunkSize'] = 2
+        try:
+            jobs = list()
+            for i in range(5):
+                jobs.append(insert_job('testvo', 'gsiftp://source', 'gsiftp://destination%d' % i, 'SUBMITTED'))
+            canceled_ids = self.app.post(
+                url="/ban/se",
+                params={'storage': 'gsiftp://source'},
+                status=200
+            ).json
+        finally:
+            if chunk_size is None:
+                del config['fts3.BanChunkSize']
+            else:
+                config['fts3.BanChunkSize'] = chunk_size
+
+        self.assertEqual(sorted(jobs), sorted(canceled_ids))
+        for job_id in jobs:
+            self.assertEqual('CANCELED', Session.query(Job).get(job_id).job_state)
+            for f in Session.query(File).filter(File.job_id == job_id):
+                self.assertEqual('CANCELED', f.file_state)
+
+    def test_ban_se_cancel_interrupted(self):
+        """
+        If the ban is interrupted, the jobs of the chunks already done are finished
+        """
+        jobs = list()
+        for i in range(5):
+            jobs.append(insert_job('testvo', 'gsiftp://source', 'gsiftp://destination%d' % i, 'SUBMITTED'))
+
+        def first_chunk(*args, **kwargs):
+            yield iter_chunks(*args, **kwargs).next()
+            raise RuntimeError('Interrupted')
+
+        chunk_size = config.get('fts3.BanChunkSize')
+        config['fts3.BanChunkSize'] = 2
+        try:
+            with mock.patch.object(banning, 'iter_chunks', side_effect=first_chunk):
+                self.assertRaises(RuntimeError, banning._cancel_transfers, storage='gsiftp://source')
+        finally:
+            if chunk_size is None:
+                del config['fts3.BanChunkSize']
+            else:
+                config['fts3.BanChunkSize'] = chunk_size
+
+        Session.expire_all()
+        canceled = 0
+        for job_id in jobs:
+            job = Session.query(Job).get(job_id)
+            files = Session.query(File).filter(File.job_id == job_id).all()
+            if all(f.file_state == 'CANCELED' for f in files):
+                self.assertEqual('CANCELED', job.job_state)
+                canceled += 1
+            else:
+                self.assertEqual('SUBMITTED', job.job_state)
+        self.assertEqual(2, canceled)
+
+    def test_ban_se_alternative(self):
+        """
+        Ban a SE used by a multiple replica job. The next replica must be enabled.
+        """
+        job_id = insert_job(
+            'testvo',
+            multiple=[
+                ('gsiftp://source', 'gsiftp://destination'),
+                ('gsiftp://other', 'gsiftp://destination'),
+                ('gsiftp://another', 'gsiftp://destination')
+            ]
+        )
+        files = Session.query(File).filter(File.job_id == job_id).order_by(File.file_id).all()
+        for f in files:
+            f.file_index = 0
+            if f.source_se != 'gsiftp://source':
+                f.file_state = 'NOT_USED'
+            Session.merge(f)
+        Session.commit()
+
+        self.app.post(url="/ban/se", params={'storage': 'gsiftp://source'}, status=200)
+
+        states = dict(
+            (f.source_se, f.file_state) for f in Session.query(File).filter(File.job_id == job_id)
+        )
+        self.assertEqual('CANCELED', states['gsiftp://source'])
+        self.assertEqual('SUBMITTED', states['gsiftp://other'])
+        self.assertEqual('NOT_USED', states['gsiftp://another'])
+        self.assertEqual('SUBMITTED', Session.query(Job).get(job_id).job_state)
+
     def test_ban_se_cancel_vo(self):
         """
         Cancel a SE that has files queued, make sure they are canceled (with VO)
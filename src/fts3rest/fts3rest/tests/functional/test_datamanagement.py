@@ -13,10 +13,70 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import collections
+import errno
+import json
+import mock
+import stat
+import threading
+import time
 
+from fts3rest.controllers import datamanagement
+from fts3rest.lib import gfal2_wrapper
+from fts3rest.lib.gfal2_wrapper import GError, Gfal2WorkerPool
 from fts3rest.tests import TestController
 
 
+class _FakeStat(object):
+    st_mode = stat.S_IFREG | 0644
+    st_nlink = 1
+    st_size = 10
+    st_atime = st_mtime = st_ctime = 0
+
+
+class _FakeEntry(object):
+    def __init__(self, d_name):
+        self.d_name = d_name
+
+
+class _FakeDir(object):
+    """
+    Directory with the entries file0 to file9, and the subdirectory dir
+    """
+
+    def __init__(self):
+        self.entries = ['file%d' % i for i in range(5)] + ['dir'] + ['file%d' % i for i in range(5, 10)]
+
+    def readpp(self):
+        if not self.entries:
+            return None, None
+        d_name = self.entries.pop(0)
+        st_stat = _FakeStat()
+        if d_name == 'dir':
+            st_stat.st_mode = stat.S_IFDIR | 0755
+        return _FakeEntry(d_name), st_stat
+
+
+class _FakeContext(object):
+    """
+    Replaces the gfal2 context for the batch and listing tests
+    """
+
+    def _check(self, surl):
+        if 'missing' in surl:
+            error = GError('No such file')
+            error.code = errno.ENOENT
+            raise error
+
+    def stat(self, surl):
+        self._check(surl)
+        return _FakeStat()
+
+    def opendir(self, surl):
+        self._check(surl)
+        return _FakeDir()
+
+
 class TestDatamanagement(TestController):
     """
     Tests for user and storage banning
@@ -151,3 +211,147 @@ class TestDatamanagement(TestController):
             },
             status=400
         )
+
+    def test_batch_stat(self):
+        """
+        Stat a list of files, and get one JSON line per file
+        """
+        self.setup_gridsite_environment()
+        self.push_delegation()
+        surls = ['mock://destination.es/file%d' % i for i in range(5)] + ['mock://source.es/missing']
+        with mock.patch.object(gfal2_wrapper, 'context_type', _FakeContext):
+            with mock.patch.object(gfal2_wrapper, 'gfal2_pool', Gfal2WorkerPool(max_workers=1)) as pool:
+                response = self.app.post(
+                    url="/dm/batch/stat",
+                    content_type='application/json',
+                    params=json.dumps({'surls': surls}),
+                    status=200
+                )
+                pool.shutdown()
+
+        self.assertEqual('application/x-ndjson', response.content_type)
+        entries = dict((entry['surl'], entry) for entry in map(json.loads, response.body.splitlines()))
+        self.assertEqual(set(surls), set(entries.keys()))
+        self.assertEqual(10, entries['mock://destination.es/file0']['result']['size'])
+        self.assertEqual(errno.ENOENT, entries['mock://source.es/missing']['error']['code'])
+
+    def _list(self, params, status=200, headers=None):
+        with mock.patch.object(gfal2_wrapper, 'context_type', _FakeContext):
+            with mock.patch.object(gfal2_wrapper, 'gfal2_pool', Gfal2WorkerPool(max_workers=1)) as pool:
+                response = self.app.get(url="/dm/list", params=params, headers=headers or {}, status=status)
+                pool.shutdown()
+        return response
+
+    def test_list_stream(self):
+        """
+        The listing is sent as a JSON object, or as one line per entry
+        """
+        self.setup_gridsite_environment()
+        self.push_delegation()
+        listing = self._list({'surl': 'mock://destination.es/dir'}).json
+        self.assertEqual(11, len(listing))
+        self.assertIn('dir/', listing)
+        self.assertEqual(10, listing['file0']['size'])
+
+        response = self._list({'surl': 'mock://destination.es/dir'}, headers={'Accept': 'application/x-ndjson'})
+        self.assertEqual('application/x-ndjson', response.content_type)
+        entries = map(json.loads, response.body.splitlines())
+        self.assertEqual(11, len(entries))
+        self.assertEqual('file0', entries[0]['name'])
+        self.assertEqual('dir/', entries[5]['name'])
+
+    def test_list_pages(self):
+        """
+        Get the listing in pages, passing the last entry as marker
+        """
+        self.setup_gridsite_environment()
+        self.push_delegation()
+        names = []
+        marker = None
+        while True:
+            params = {'surl': 'mock://destination.es/dir', 'limit': 4}
+            if marker:
+                params['marker'] = marker
+            response = self._list(params, headers={'Accept': 'application/x-ndjson'})
+            page = [entry['name'] for entry in map(json.loads, response.body.splitlines())]
+            if not page:
+                break
+            self.assertLessEqual(len(page), 4)
+            names.extend(page)
+            marker = page[-1]
+        self.assertEqual(11, len(names))
+        self.assertEqual(11, len(set(names)))
+
+    def test_list_errors(self):
+        """
+        Errors opening the directory, or invalid parameters, get their status code
+        """
+        self.setup_gridsite_environment()
+        self.push_delegation()
+        self._list({'surl': 'mock://destination.es/missing'}, status=404)
+        self._list({'surl': 'mock://destination.es/dir', 'limit': 'abc'}, status=400)
+        self._list({'surl': 'mock://destination.es/dir', 'limit': 0}, status=400)
+        self._list({'surl': 'mock://destination.es/dir', 'marker': 'removed'}, status=400)
+
+    def test_list_heartbeat(self):
+        """
+        Skipping up to the marker sends heartbeats, which are not part of the listing
+        """
+        entries = datamanagement._iter_list_impl(_FakeContext(), 'mock://destination.es/dir', marker='file2')
+        with mock.patch.object(datamanagement, '_LIST_HEARTBEAT', 1):
+            entries = list(entries)
+        self.assertEqual(2, entries.count(gfal2_wrapper.HEARTBEAT))
+
+        self.setup_gridsite_environment()
+        self.push_delegation()
+        with mock.patch.object(datamanagement, '_LIST_HEARTBEAT', 1):
+            response = self._list(
+                {'surl': 'mock://destination.es/dir', 'marker': 'file2'}, headers={'Accept': 'application/x-ndjson'}
+            )
+        names = [entry['name'] for entry in map(json.loads, response.body.splitlines())]
+        self.assertEqual(8, len(names))
+        self.assertEqual('file3', names[0])
+
+    def test_batch_no_head_of_line_blocking(self):
+        """
+        A busy storage must not hold the slots other storages could use
+        """
+        lock = threading.Lock()
+        running = collections.Counter()
+        peak = collections.Counter()
+        finished = list()
+
+        def operation(context, surl):
+            storage = datamanagement._get_storage(surl)
+            with lock:
+                running[storage] += 1
+                peak[storage] = max(peak[storage], running[storage])
+            time.sleep(0.2 if storage == 'mock://slow.es' else 0)
+            with lock:
+                running[storage] -= 1
+                finished.append(storage)
+            return surl
+
+        surls = ['mock://slow.es/file%d' % i for i in range(6)] + ['mock://fast.es/file%d' % i for i in range(10)]
+        results = list(datamanagement._batch_impl(None, surls, operation, 6, 2))
+
+        self.assertEqual(set(surls), set(entry['result'] for entry in results))
+        self.assertEqual(2, peak['mock://slow.es'])
+        self.assertEqual(2, peak['mock://fast.es'])
+        # The fast storage is done before the slow one
+        self.assertEqual(['mock://fast.es'] * 10, finished[:10])
+
+    def test_batch_malformed(self):
+        """
+        Batch requests with an invalid list of SURLs
+        """
+        self.setup_gridsite_environment()
+        self.push_delegation()
+        for surls in ([], 'mock://destination.es/file', ['file:///etc/passwd'], [None]):
+            self.app.post(
+                url="/dm/batch/stat",
+                content_type='application/json',
+                params=json.dumps({'surls': surls}),
+                status=400
+            )
+        self.app.post(url="/dm/batch/unlink", content_type='application/json', params='[]', status=400)
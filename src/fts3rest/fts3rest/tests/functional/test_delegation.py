@@ -71,6 +71,7 @@ class TestDelegation(TestController):
         proxy = self.get_x509_proxy(request.body)
 
         Session.delete(Session.query(CredentialCache).get((creds.delegation_id, creds.user_dn)))
+        Session.commit()
 
         self.app.put(url="/delegation/%s/credential" % creds.delegation_id,
                      params=proxy,
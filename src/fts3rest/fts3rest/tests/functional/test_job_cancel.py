@@ -19,6 +19,7 @@ import json
 
 from fts3rest.tests import TestController
 from fts3rest.lib.base import Session
+from fts3rest.lib.cancellation import cancel_active
 from fts3.model import Job, File, JobActiveStates, Credential, FileActiveStates, FileTerminalStates
 from datetime import datetime, timedelta
 import pylons
@@ -532,3 +533,38 @@ class TestJobCancel(TestController):
         self.assertEqual(response['affected_files'], len(FileActiveStates) * 8)
         self.assertEqual(response['affected_dm'], 0)
         self.assertEqual(response['affected_jobs'], len(FileActiveStates))
+
+    def test_cancel_all_chunked(self):
+        """
+        Cancel all files, with more jobs than fit in a chunk
+        """
+        job_ids = self._prepare_and_test_created_jobs_to_cancel(files_per_job=8)
+        self._become_root()
+        pylons.config['fts3.CancelChunkSize'] = 5
+        try:
+            response = self.app.delete(url="/jobs/all", status=200).json
+        finally:
+            del pylons.config['fts3.CancelChunkSize']
+        self._test_canceled_jobs(job_ids)
+        self.assertEqual(response['affected_files'], len(FileActiveStates) * 8)
+        self.assertEqual(response['affected_dm'], 0)
+        self.assertEqual(response['affected_jobs'], len(FileActiveStates))
+
+    def test_cancel_all_resume(self):
+        """
+        An interrupted mass cancellation must resume where it stopped
+        """
+        job_ids = self._prepare_and_test_created_jobs_to_cancel(files_per_job=8)
+
+        progress = cancel_active(chunk_size=5)
+        first = progress.next()
+        self.assertEqual(5, first['affected_jobs'])
+        self.assertEqual(5 * 8, first['affected_files'])
+        progress.close()
+
+        counts = None
+        for counts in cancel_active(chunk_size=5):
+            pass
+        self._test_canceled_jobs(job_ids)
+        self.assertEqual(counts['affected_files'], (len(FileActiveStates) - 5) * 8)
+        self.assertEqual(counts['affected_jobs'], len(FileActiveStates) - 5)
@@ -17,6 +17,7 @@
 
 import json
 from datetime import datetime, timedelta
+from sqlalchemy import event
 
 from fts3.model import FileRetryLog, Job, File
 from fts3rest.lib.base import Session
@@ -114,6 +115,99 @@ class TestJobListing(TestController):
         job_list = self.app.get(url="/jobs", status=200).json
         self.assertTrue(job_id in map(lambda j: j['job_id'], job_list))
 
+    def test_list_with_fields(self):
+        """
+        List active jobs, retrieving only some fields
+        """
+        self.setup_gridsite_environment()
+        self.push_delegation()
+
+        job_id = self._submit()
+
+        job_list = self.app.get(url="/jobs?fields=job_id,job_state,submit_time", status=200).json
+        job = filter(lambda j: j['job_id'] == job_id, job_list)[0]
+        self.assertEqual(set(['job_id', 'job_state', 'submit_time']), set(job.keys()))
+        self.assertEqual('SUBMITTED', job['job_state'])
+
+        job_list = self.app.get(url="/jobs?fields=job_id,vo_name&limit=10", status=200).json
+        job = filter(lambda j: j['job_id'] == job_id, job_list)[0]
+        self.assertEqual(set(['job_id', 'vo_name']), set(job.keys()))
+
+    def test_list_with_unknown_fields(self):
+        """
+        Asking for fields that do not exist must fail before querying
+        """
+        self.setup_gridsite_environment()
+        self.push_delegation()
+
+        self.app.get(url="/jobs?fields=job_id,not_a_field", status=400)
+        self.app.get(url="/jobs?fields=job_id,files", status=400)
+
+    def _follow_link(self, response):
+        link = response.headers.get('Link', None)
+        if link is None:
+            return None
+        self.assertTrue(link.endswith('>; rel="next"'))
+        url = link[1:link.index('>')]
+        return url[url.index('/', url.index('//') + 2):]
+
+    def test_list_cursor(self):
+        """
+        Walk the job list in pages, following the Link header
+        """
+        self.setup_gridsite_environment()
+        self.push_delegation()
+
+        job_ids = [self._submit(dest_surl='root://dest.ch/cursor%d' % i, random_url=False) for i in range(5)]
+
+        seen = list()
+        pages = 0
+        url = "/jobs?limit=2&fields=job_id"
+        while url:
+            response = self.app.get(url=url, status=200)
+            self.assertLessEqual(len(response.json), 2)
+            for job in response.json:
+                self.assertEqual(['job_id'], job.keys())
+            seen.extend([j['job_id'] for j in response.json])
+            pages += 1
+            url = self._follow_link(response)
+
+        self.assertGreaterEqual(pages, 3)
+        self.assertEqual(len(seen), len(set(seen)))
+        for job_id in job_ids:
+            self.assertIn(job_id, seen)
+
+    def test_list_bad_cursor(self):
+        """
+        Cursors not generated by the server must be rejected
+        """
+        self.setup_gridsite_environment()
+        self.push_delegation()
+
+        self.app.get(url="/jobs?limit=2&cursor=garbage", status=400)
+        self.app.get(url="/files?limit=2&cursor=garbage", status=400)
+
+    def test_list_files_cursor(self):
+        """
+        Walk the file list in pages, following the Link header
+        """
+        self.setup_gridsite_environment()
+        self.push_delegation()
+
+        job_ids = [self._submit(dest_surl='root://dest.ch/cursor%d' % i, random_url=False) for i in range(3)]
+
+        seen = list()
+        url = "/files?limit=1"
+        while url:
+            response = self.app.get(url=url, status=200)
+            self.assertLessEqual(len(response.json), 1)
+            seen.extend([f['file_id'] for f in response.json])
+            url = self._follow_link(response)
+
+        self.assertEqual(sorted(seen), seen)
+        self.assertEqual(len(seen), len(set(seen)))
+        self.assertGreaterEqual(len(seen), len(job_ids))
+
     def test_list_with_dlg_id(self):
         """
         List active jobs with the right delegation id
@@ -418,6 +512,16 @@ class TestJobListing(TestController):
 
         self.assertEqual('root://source.es/file', f['source_surl'])
 
+    def test_get_files_in_job_unknown_field(self):
+        """
+        Asking for file fields that do not exist must fail
+        """
+        self.setup_gridsite_environment()
+        self.push_delegation()
+        job_id = self._submit()
+
+        self.app.get(url="/jobs/%s?files=source_surl,not_a_field" % job_id, status=400)
+
     def test_get_multiple_jobs(self):
         """
         Query multiple jobs at once
@@ -452,6 +556,38 @@ class TestJobListing(TestController):
 
         self.assertEqual(N_JOBS, matches)
 
+    def test_get_multiple_jobs_query_count(self):
+        """
+        Querying multiple jobs with their files must not run a query per job
+        """
+        self.setup_gridsite_environment()
+        self.push_delegation()
+
+        job_ids = [self._submit(dest_surl='root://dest.ch/count%d' % i, random_url=False) for i in range(5)]
+
+        statements = list()
+
+        def _count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        engine = Session.get_bind()
+        event.listen(engine, 'before_cursor_execute', _count)
+        try:
+            job_list = self.app.get(
+                url="/jobs/%s?files=source_surl,file_state" % ','.join(job_ids),
+                status=200
+            ).json
+        finally:
+            event.remove(engine, 'before_cursor_execute', _count)
+
+        self.assertEqual(job_ids, [j['job_id'] for j in job_list])
+        for job in job_list:
+            self.assertEqual(1, len(job['files']))
+            self.assertEqual(set(['source_surl', 'file_state']), set(job['files'][0].keys()))
+
+        self.assertEqual(1, len(filter(lambda s: 'FROM t_job ' in s, statements)))
+        self.assertEqual(1, len(filter(lambda s: 'FROM t_file ' in s, statements)))
+
     def test_get_multiple_jobs_one_missing(self):
         """
         Same as test_get_multiple_jobs, but push one missing job
@@ -537,6 +673,26 @@ class TestJobListing(TestController):
         self.assertEqual({'label': '?'},               jobs[2]['files'][0]['file_metadata'])
         self.assertEqual(jobs[3]['job_id'], jobs[3]['files'][0]['job_id'])
         self.assertEqual({'key': 5},               jobs[3]['files'][0]['file_metadata'])
+
+    def test_get_repeated_with_files(self):
+        """
+        A job requested more than once gets one entry, with its files, per request
+        """
+        self.setup_gridsite_environment()
+        self.push_delegation()
+
+        job1 = self._submit()
+        job2 = self._submit()
+
+        jobs = self.app.get(
+            url="/jobs/%s?files=job_id,file_state" % ','.join([job1, job2, job1]),
+            status=200).json
+
+        self.assertEqual([job1, job2, job1], [job['job_id'] for job in jobs])
+        for job in jobs:
+            self.assertEqual(1, len(job['files']))
+            self.assertEqual(job['job_id'], job['files'][0]['job_id'])
+
     def test_query_something_running(self):
         """
         Query if there are any active or submitted files for a given destination surl
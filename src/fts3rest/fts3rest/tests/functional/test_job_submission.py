@@ -17,13 +17,17 @@
 
 import json
 import mock
+import os
 import socket
 import time
+from dirq.QueueSimple import QueueSimple
 from nose.plugins.skip import SkipTest
+from pylons import config
 from sqlalchemy.orm import scoped_session, sessionmaker
 
 from fts3rest.tests import TestController
 from fts3rest.lib.base import Session
+from fts3rest.lib.helpers import msgbus
 from fts3.model import File, Job
 import random
 
@@ -105,6 +109,180 @@ class TestJobSubmission(TestController):
 
         return str(job_id)
 
+    def test_submit_bulk(self):
+        """
+        Submit several valid jobs at once
+        """
+        self.setup_gridsite_environment()
+        self.push_delegation()
+        jobs = list()
+        for i in range(3):
+            jobs.append({
+                'files': [{
+                    'sources': ['root://source.es/file'],
+                    'destinations': ['root://dest.ch/file%d_%d' % (i, random.randint(0, 1000))],
+                    'selection_strategy': 'orderly',
+                    'checksum': 'adler32:1234',
+                    'filesize': 1024,
+                    'metadata': {'mykey': 'myvalue'},
+                }],
+                'params': {'overwrite': True, 'verify_checksum': True}
+            })
+
+        responses = self.app.post(
+            url="/jobs/bulk",
+            content_type='application/json',
+            params=json.dumps({'jobs': jobs}),
+            status=200
+        ).json
+
+        self.assertEqual(3, len(responses))
+        for response in responses:
+            self.assertEqual('200 Ok', response['http_status'])
+            self._validate_submitted(Session.query(Job).get(response['job_id']))
+
+    def test_submit_bulk_partial(self):
+        """
+        Submit several jobs at once, when one of them is invalid.
+        The valid ones must go through, and the reply must be a multistatus
+        """
+        self.setup_gridsite_environment()
+        self.push_delegation()
+        valid = {
+            'files': [{
+                'sources': ['root://source.es/file'],
+                'destinations': ['root://dest.ch/file' + str(random.randint(0, 1000))],
+            }]
+        }
+        invalid = {
+            'files': [{
+                'sources': ['/etc/passwd'],
+                'destinations': ['root://dest.ch/file' + str(random.randint(0, 1000))],
+            }]
+        }
+        responses = self.app.post(
+            url="/jobs/bulk",
+            content_type='application/json',
+            params=json.dumps({'jobs': [valid, invalid]}),
+            status=207
+        ).json
+
+        self.assertEqual(2, len(responses))
+        self.assertEqual('200 Ok', responses[0]['http_status'])
+        self.assertIsNotNone(Session.query(Job).get(responses[0]['job_id']))
+        self.assertEqual('400 Bad Request', responses[1]['http_status'])
+        self.assertIsNone(responses[1]['job_id'])
+
+    def test_submit_bulk_duplicated(self):
+        """
+        Submit two jobs with the same deterministic id in the same request.
+        Only the first one must be accepted
+        """
+        self.setup_gridsite_environment()
+        self.push_delegation()
+        jobs = list()
+        for i in range(2):
+            jobs.append({
+                'files': [{
+                    'sources': ['root://source.es/file'],
+                    'destinations': ['root://dest.ch/file%d_%d' % (i, random.randint(0, 1000))],
+                }],
+                'params': {'id_generator': 'deterministic', 'sid': 'bulk-duplicated'}
+            })
+        responses = self.app.post(
+            url="/jobs/bulk",
+            content_type='application/json',
+            params=json.dumps({'jobs': jobs}),
+            status=207
+        ).json
+
+        self.assertEqual('200 Ok', responses[0]['http_status'])
+        self.assertEqual('409 Conflict', responses[1]['http_status'])
+        self.assertEqual(1, len(Session.query(Job).get(responses[0]['job_id']).files))
+
+    def test_submit_bulk_empty(self):
+        """
+        Submit an empty list of jobs
+        """
+        self.setup_gridsite_environment()
+        self.push_delegation()
+        self.app.post(
+            url="/jobs/bulk",
+            content_type='application/json',
+            params=json.dumps({'jobs': []}),
+            status=400
+        )
+
+    def _submit_and_get_messages(self, nfiles, extra_config):
+        """
+        Submit a job with monitoring messages enabled, and return the
+        job id and the messages written
+        """
+        job = {
+            'files': [{
+                'sources': ['root://source.es/file'],
+                'destinations': ['root://dest.ch/file%d_%d' % (i, random.randint(0, 1000))],
+            } for i in range(nfiles)]
+        }
+
+        if not os.path.exists(config['fts3.MessagingDirectory']):
+            os.makedirs(config['fts3.MessagingDirectory'])
+        extra_config['fts3.MonitoringMessaging'] = 'true'
+        config.update(extra_config)
+        try:
+            job_id = self.app.post(
+                url="/jobs",
+                content_type='application/json',
+                params=json.dumps(job),
+                status=200
+            ).json['job_id']
+            writer = msgbus._get_writer()
+            if writer:
+                writer.flush()
+        finally:
+            for key in extra_config.keys():
+                del config[key]
+
+        queue = QueueSimple(path=os.path.join(config['fts3.MessagingDirectory'], 'monitoring'))
+        messages = list()
+        for name in queue:
+            if queue.lock(name):
+                messages.append(json.loads(queue.get(name)[3:]))
+                queue.remove(name)
+        return job_id, messages
+
+    def _validate_messages(self, job_id, messages):
+        files = Session.query(File).filter(File.job_id == job_id).all()
+        self.assertEqual(len(files), len(messages))
+        expected = dict([(f.file_id, f.dest_surl) for f in files])
+        received = dict([(m['file_id'], m['dst_url']) for m in messages])
+        self.assertEqual(expected, received)
+        for m in messages:
+            self.assertEqual(job_id, m['job_id'])
+            self.assertEqual('SUBMITTED', m['file_state'])
+
+    def test_submit_messages(self):
+        """
+        Submit a job with monitoring messages enabled, and make sure
+        there is one message per transfer, with the right file id
+        """
+        self.setup_gridsite_environment()
+        self.push_delegation()
+        job_id, messages = self._submit_and_get_messages(5, {})
+        self.assertEqual(5, len(messages))
+        self._validate_messages(job_id, messages)
+
+    def test_submit_messages_async(self):
+        """
+        Same as test_submit_messages, but the messages are written by
+        the background writer
+        """
+        self.setup_gridsite_environment()
+        self.push_delegation()
+        job_id, messages = self._submit_and_get_messages(5, {'fts3.MonitoringAsyncWriter': 'true'})
+        self.assertEqual(5, len(messages))
+        self._validate_messages(job_id, messages)
+
     def test_submit_no_reuse(self):
         """
         Submit a valid job no reuse
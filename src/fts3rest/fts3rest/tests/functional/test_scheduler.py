@@ -21,7 +21,8 @@ import logging
 
 from fts3rest.tests import TestController
 from fts3rest.lib.base import Session
-from fts3rest.lib.scheduler.Cache import ThreadLocalCache
+from fts3rest.lib.scheduler.Cache import SharedCache
+from fts3rest.lib.scheduler.db import Database
 from fts3.model import Job, File, OptimizerEvolution, ActivityShare
 import random
 
@@ -36,6 +37,8 @@ class TestScheduler(TestController):
     def setUp(self):
         Session.query(OptimizerEvolution).delete()
         Session.commit()
+        # The cache is shared by the whole process, do not carry values between tests
+        SharedCache.cache_cleanup()
 
     def tearDown(self):
         Session.query(Job).delete()
@@ -213,7 +216,7 @@ class TestScheduler(TestController):
         self.validate(job_id)
 
         # Trigger a cache expiration
-        ThreadLocalCache.cache_cleanup()
+        SharedCache.cache_cleanup()
 
         job_id = self.submit_job("queue")
         self.validate(job_id)
@@ -306,6 +309,63 @@ class TestScheduler(TestController):
         job_id = self.submit_job("duration")
         self.validate(job_id)
 
+    def test_link_metrics_batch(self):
+        """
+        The batched metrics must match those obtained link by link
+        """
+        self.setup_gridsite_environment()
+        self.push_delegation()
+        TestScheduler.fill_activities()
+        TestScheduler.fill_optimizer()
+        TestScheduler.fill_file_queue(self)
+
+        db = Database(Session)
+        sources = ['http://site01.es', 'http://site02.ch', 'http://site03.fr', 'http://site04.it']
+        metrics = db.get_link_metrics(sources, 'http://dest.ch', 'testvo', 'default')
+
+        self.assertEqual(set(sources), set(metrics.keys()))
+        for src in sources:
+            self.assertEqual(db.get_submitted(src, 'http://dest.ch', 'testvo'), metrics[src]['submitted'])
+            self.assertEqual(db.get_success_rate(src, 'http://dest.ch'), metrics[src]['success'])
+            self.assertEqual(db.get_throughput(src, 'http://dest.ch'), metrics[src]['throughput'])
+            self.assertEqual(
+                db.get_per_file_throughput(src, 'http://dest.ch'), metrics[src]['per_file_throughput']
+            )
+            self.assertEqual(
+                db.get_pending_data(src, 'http://dest.ch', 'testvo', 'default'), metrics[src]['pending_data']
+            )
+
+        cached = SharedCache(db).get_link_metrics(
+            sources, 'http://dest.ch', 'testvo', 'default', ['submitted', 'throughput']
+        )
+        for src in sources:
+            self.assertEqual(metrics[src]['submitted'], cached[src]['submitted'])
+            self.assertEqual(metrics[src]['throughput'], cached[src]['throughput'])
+
+    def test_optimizer_aggregation(self):
+        """
+        Several optimizer entries in the last hour must be averaged,
+        and older ones ignored
+        """
+        now = datetime.datetime.utcnow()
+        for minutes, success, active, throughput in [(1, 80, 2, 10), (2, 100, 4, 20), (120, 0, 100, 1000)]:
+            Session.add(OptimizerEvolution(
+                datetime=now - datetime.timedelta(minutes=minutes),
+                source_se='http://site01.es',
+                dest_se='http://dest.ch',
+                success=success,
+                active=active,
+                throughput=throughput
+            ))
+        Session.commit()
+
+        db = Database(Session)
+        self.assertEqual(90, db.get_success_rate('http://site01.es', 'http://dest.ch'))
+        self.assertEqual(50, db.get_throughput('http://site01.es', 'http://dest.ch'))
+        self.assertEqual(15, db.get_per_file_throughput('http://site01.es', 'http://dest.ch'))
+        self.assertEqual(100, db.get_success_rate('http://site02.ch', 'http://dest.ch'))
+        self.assertEqual(0, db.get_throughput('http://site02.ch', 'http://dest.ch'))
+
     def test_invalid_strategy(self):
         """
         Test a random strategy name, which must fail
@@ -54,6 +54,7 @@ class TestAuthorization(unittest.TestCase):
 
     def tearDown(self):
         Session.query(AuthorizationByDn).delete()
+        fts3auth.invalidate_auth_cache()
 
     def test_authorized_base(self):
         """
@@ -136,6 +137,7 @@ class TestAuthorization(unittest.TestCase):
         authz = AuthorizationByDn(dn=TestAuthorization.DN, operation=fts3auth.CONFIG)
         Session.merge(authz)
         Session.commit()
+        fts3auth.invalidate_auth_cache()
 
         # Force reload of creds
         self.creds = fts3auth.UserCredentials(env, TestAuthorization.ROLES)
@@ -162,3 +164,14 @@ class TestAuthorization(unittest.TestCase):
         self.assertTrue(fts3auth.authorized(fts3auth.CONFIG, env=env))
         self.assertTrue(fts3auth.authorized(fts3auth.DELEGATION, env=env))
         self.assertTrue(fts3auth.authorized(fts3auth.TRANSFER, env=env, resource_vo='atlas'))
+
+    def test_db_grants_in_memory(self):
+        """
+        The grants configured in the database are loaded once, and not per user
+        """
+        fts3auth.invalidate_auth_cache()
+        loads = fts3auth.auth_cache_stats()['loads']
+        for i in range(5):
+            env = dict(GRST_CRED_AURI_0='dn:/DC=ch/DC=cern/CN=User %d' % i)
+            fts3auth.UserCredentials(env, TestAuthorization.ROLES)
+        self.assertEqual(loads + 1, fts3auth.auth_cache_stats()['loads'])
@@ -0,0 +1,102 @@
+#   Copyright notice:
+#   Copyright CERN, 2015.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+from datetime import datetime, timedelta
+
+from fts3.model import BannedDN, BannedSE
+from fts3rest.lib.banning import BanIndex
+from fts3rest.lib.base import Session
+
+
+class TestBanIndex(unittest.TestCase):
+    """
+    Test the in memory list of bans
+    """
+
+    def setUp(self):
+        Session.query(BannedDN).delete()
+        Session.query(BannedSE).delete()
+        Session.commit()
+
+    def tearDown(self):
+        self.setUp()
+
+    def _ban_dn(self, dn, addition_time=None):
+        Session.merge(BannedDN(dn=dn, addition_time=addition_time or datetime.utcnow()))
+        Session.commit()
+
+    def test_reload_on_change(self):
+        """
+        Changes done by someone else must be seen once the check interval expires
+        """
+        index = BanIndex(check_interval=0)
+        self.assertFalse(index.is_dn_banned('/DC=cern/CN=someone'))
+
+        self._ban_dn('/DC=cern/CN=someone')
+        self.assertTrue(index.is_dn_banned('/DC=cern/CN=someone'))
+
+        Session.merge(BannedSE(se='gsiftp://nowhere', vo='*', status='CANCEL', addition_time=datetime.utcnow()))
+        Session.commit()
+        self.assertEqual({'gsiftp://nowhere': ('*', 'CANCEL')}, index.get_banned_ses())
+
+        Session.query(BannedDN).delete()
+        Session.commit()
+        self.assertFalse(index.is_dn_banned('/DC=cern/CN=someone'))
+
+    def test_replaced_ban(self):
+        """
+        Removing a ban and adding another must be detected, even if the count does not change
+        """
+        index = BanIndex(check_interval=0)
+        self._ban_dn('/DC=cern/CN=someone', datetime.utcnow() - timedelta(minutes=5))
+        self.assertTrue(index.is_dn_banned('/DC=cern/CN=someone'))
+
+        Session.query(BannedDN).delete()
+        self._ban_dn('/DC=cern/CN=other')
+        self.assertFalse(index.is_dn_banned('/DC=cern/CN=someone'))
+        self.assertTrue(index.is_dn_banned('/DC=cern/CN=other'))
+
+    def test_updated_in_place(self):
+        """
+        A ban updated in place keeps the count and addition time, so it is only seen
+        once the reload interval expires
+        """
+        addition_time = datetime.utcnow()
+        Session.merge(BannedSE(se='gsiftp://nowhere', vo='*', status='WAIT', addition_time=addition_time))
+        Session.commit()
+
+        stale = BanIndex(check_interval=0, reload_interval=3600)
+        fresh = BanIndex(check_interval=0, reload_interval=0)
+        self.assertEqual({'gsiftp://nowhere': ('*', 'WAIT')}, stale.get_banned_ses())
+        self.assertEqual({'gsiftp://nowhere': ('*', 'WAIT')}, fresh.get_banned_ses())
+
+        Session.merge(BannedSE(se='gsiftp://nowhere', vo='*', status='CANCEL', addition_time=addition_time))
+        Session.commit()
+        self.assertEqual({'gsiftp://nowhere': ('*', 'WAIT')}, stale.get_banned_ses())
+        self.assertEqual({'gsiftp://nowhere': ('*', 'CANCEL')}, fresh.get_banned_ses())
+
+    def test_check_interval(self):
+        """
+        Within the check interval, the database is not queried, unless invalidated
+        """
+        index = BanIndex(check_interval=3600)
+        self.assertFalse(index.is_dn_banned('/DC=cern/CN=someone'))
+
+        self._ban_dn('/DC=cern/CN=someone')
+        self.assertFalse(index.is_dn_banned('/DC=cern/CN=someone'))
+
+        index.invalidate()
+        self.assertTrue(index.is_dn_banned('/DC=cern/CN=someone'))
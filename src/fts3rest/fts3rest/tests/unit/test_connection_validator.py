@@ -0,0 +1,82 @@
+#   Copyright notice:
+#   Copyright CERN, 2015.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import time
+import unittest
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
+
+from fts3rest.lib.helpers.connection_validator import ConnectionValidator, _LAST_USED_KEY
+
+
+class _FakeRecord(object):
+    def __init__(self):
+        self.info = dict()
+
+
+class TestConnectionValidator(unittest.TestCase):
+    """
+    Test that only the connections idle for a while are checked
+    """
+
+    def setUp(self):
+        self.validator = ConnectionValidator(idle_threshold=60)
+        self.record = _FakeRecord()
+
+    def test_new_connection(self):
+        """
+        A connection that has just been created is not checked
+        """
+        self.validator.checkout(object(), self.record, None)
+        self.assertEqual(1, self.validator.stats()['checkouts'])
+        self.assertEqual(0, self.validator.stats()['pings'])
+
+    def test_recently_used(self):
+        """
+        A connection given back recently is not checked
+        """
+        self.validator.checkin(object(), self.record)
+        self.validator.checkout(object(), self.record, None)
+        self.assertEqual(0, self.validator.stats()['pings'])
+
+    def test_idle(self):
+        """
+        A connection idle for longer than the threshold is checked
+        """
+        self.validator.checkin(object(), self.record)
+        self.record.info[_LAST_USED_KEY] -= 61
+        self.validator.checkout(object(), self.record, None)
+        self.assertEqual(1, self.validator.stats()['pings'])
+
+    def test_always(self):
+        """
+        With a threshold of 0, every checkout of a used connection is checked
+        """
+        self.validator.idle_threshold = 0
+        self.record.info[_LAST_USED_KEY] = time.time()
+        self.validator.checkout(object(), self.record, None)
+        self.validator.checkout(object(), self.record, None)
+        self.assertEqual(2, self.validator.stats()['pings'])
+
+    def test_invalidated(self):
+        """
+        The connections invalidated by the pool are counted once
+        """
+        engine = create_engine('sqlite://', poolclass=QueuePool)
+        self.validator.register(engine)
+        connection = engine.connect()
+        connection.invalidate()
+        connection.close()
+        self.assertEqual(1, self.validator.stats()['invalidations'])
@@ -102,3 +102,21 @@ class TestUserCredentials(unittest.TestCase):
         self.assertEqual(fts3auth.ALL,     creds.get_granted_level_for(fts3auth.CONFIG))
         self.assertEqual(fts3auth.VO,      creds.get_granted_level_for(fts3auth.TRANSFER))
         self.assertEqual(fts3auth.PRIVATE, creds.get_granted_level_for(fts3auth.DELEGATION))
+
+    def test_compiled_roles(self):
+        """
+        Compiled role permissions must grant the same levels, and must not
+        be modified by the granted levels of a user
+        """
+        env = {}
+        env['GRST_CRED_AURI_0'] = 'dn:' + TestUserCredentials.DN
+        env['GRST_CRED_AURI_1'] = 'fqan:' + TestUserCredentials.FQANS[3]
+
+        compiled = fts3auth.RolePermissions(TestUserCredentials.ROLES)
+        creds = fts3auth.UserCredentials(env, compiled)
+        self.assertEqual(fts3auth.ALL,     creds.get_granted_level_for(fts3auth.CONFIG))
+        self.assertEqual(fts3auth.VO,      creds.get_granted_level_for(fts3auth.TRANSFER))
+
+        creds.level['transfer'] = 'all'
+        creds = fts3auth.UserCredentials(env, compiled)
+        self.assertEqual(fts3auth.VO,      creds.get_granted_level_for(fts3auth.TRANSFER))
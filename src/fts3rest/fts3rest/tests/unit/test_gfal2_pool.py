@@ -0,0 +1,206 @@
+#   Copyright notice:
+#   Copyright CERN, 2015.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import errno
+import mock
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from fts3rest.lib import gfal2_wrapper
+from fts3rest.lib.gfal2_wrapper import Gfal2Error, Gfal2WorkerPool
+
+
+class _FakeContext(object):
+    """
+    Stands for a gfal2 context, remembering the environment it was created with
+    """
+    created = 0
+
+    def __init__(self):
+        _FakeContext.created += 1
+        self.id = _FakeContext.created
+        self.proxy = os.environ.get('X509_USER_PROXY')
+        self.options = dict()
+
+    def set_opt_string(self, group, key, value):
+        self.options[(group, key)] = value
+
+
+def _echo(context, value):
+    return value
+
+
+def _describe(context):
+    return dict(pid=os.getpid(), context=context.id, proxy=open(context.proxy).read(), options=context.options.keys())
+
+
+def _fail(context):
+    raise Exception('Failed')
+
+
+def _hang(context):
+    time.sleep(10)
+
+
+def _count(context, n, fail_at=None):
+    for i in xrange(n):
+        if i == fail_at:
+            raise Exception('Failed at %d' % i)
+        yield i
+
+
+class TestGfal2WorkerPool(unittest.TestCase):
+    """
+    Test the pool of processes used for the gfal2 operations
+    """
+
+    def setUp(self):
+        self.patcher = mock.patch.object(gfal2_wrapper, 'context_type', _FakeContext)
+        self.patcher.start()
+        self.pool = Gfal2WorkerPool(max_workers=2, max_operations=3, timeout=1)
+        self.directory = tempfile.mkdtemp()
+        for proxy in ('proxy-1', 'proxy-2', 'proxy-3'):
+            open(os.path.join(self.directory, proxy), 'w').write(proxy)
+
+    def tearDown(self):
+        self.pool.shutdown()
+        self.patcher.stop()
+        shutil.rmtree(self.directory)
+
+    def _run(self, method, args=(), proxy='proxy-1', options=None):
+        return self.pool.run(proxy, os.path.join(self.directory, proxy), None, options or [], method, args, {})
+
+    def _stream(self, method, args=()):
+        proxy = os.path.join(self.directory, 'proxy-1')
+        return self.pool.stream('proxy-1', proxy, None, [], method, args, {})
+
+    def test_result(self):
+        """
+        The result is sent back to the caller
+        """
+        self.assertEqual({'a': [1, 2]}, self._run(_echo, ({'a': [1, 2]},)))
+
+    def test_error(self):
+        """
+        An exception within the worker is reported as EIO, and the worker is kept
+        """
+        try:
+            self._run(_fail)
+            self.fail('Expected an error')
+        except Gfal2Error, e:
+            self.assertEqual(errno.EIO, e.errno)
+        self.assertEqual(1, self.pool.stats()['idle'])
+
+    def test_timeout(self):
+        """
+        A worker that hangs is killed, and the next operation gets a new one
+        """
+        try:
+            self._run(_hang)
+            self.fail('Expected a timeout')
+        except Gfal2Error, e:
+            self.assertEqual(errno.ETIMEDOUT, e.errno)
+        self.assertEqual(0, self.pool.stats()['idle'])
+        self.assertEqual(42, self._run(_echo, (42,)))
+
+    def test_context_reused(self):
+        """
+        The worker and its context are reused for the same credentials, and a different
+        process is used when they change
+        """
+        first = self._run(_describe)
+        second = self._run(_describe)
+        self.assertEqual(first['pid'], second['pid'])
+        self.assertEqual(first['context'], second['context'])
+        self.assertEqual('proxy-1', second['proxy'])
+
+        other = self._run(_describe, proxy='proxy-2', options=[('DROPBOX', 'APP_KEY', 'key')])
+        self.assertNotEqual(first['pid'], other['pid'])
+        self.assertEqual('proxy-2', other['proxy'])
+        self.assertEqual([['DROPBOX', 'APP_KEY']], other['options'])
+
+    def test_full_pool(self):
+        """
+        With the pool full, an idle worker bound to other credentials is replaced
+        """
+        first = self._run(_describe, proxy='proxy-1')
+        second = self._run(_describe, proxy='proxy-2')
+        third = self._run(_describe, proxy='proxy-3')
+        self.assertEqual(3, len(set([first['pid'], second['pid'], third['pid']])))
+        self.assertEqual(2, self.pool.stats()['idle'])
+        self.assertEqual(3, self.pool.stats()['spawned'])
+        # The least recently used one was stopped
+        self.assertEqual(second['pid'], self._run(_describe, proxy='proxy-2')['pid'])
+        self.assertNotEqual(first['pid'], self._run(_describe, proxy='proxy-1')['pid'])
+
+    def test_recycle(self):
+        """
+        Workers are replaced after max_operations
+        """
+        pids = [self._run(_describe)['pid'] for _ in range(4)]
+        self.assertEqual(1, len(set(pids[:3])))
+        self.assertNotEqual(pids[0], pids[3])
+        self.assertEqual(2, self.pool.stats()['spawned'])
+
+    def test_stream(self):
+        """
+        Items are received one by one, and the worker is kept afterwards
+        """
+        items = self._stream(_count, (5,))
+        self.assertEqual([0, 1, 2, 3, 4], list(items))
+        self.assertEqual(1, self.pool.stats()['idle'])
+
+    def test_stream_error(self):
+        """
+        An error in the middle of the stream is raised after the items sent before it
+        """
+        received = []
+        try:
+            for item in self._stream(_count, (5, 2)):
+                received.append(item)
+            self.fail('Expected an error')
+        except Gfal2Error, e:
+            self.assertEqual(errno.EIO, e.errno)
+        self.assertEqual([0, 1], received)
+        self.assertEqual(1, self.pool.stats()['idle'])
+
+    def test_stream_closed(self):
+        """
+        If the consumer stops early, the worker is discarded
+        """
+        items = self._stream(_count, (1000,))
+        self.assertEqual(0, items.next())
+        items.close()
+        self.assertEqual(0, self.pool.stats()['idle'])
+        self.assertEqual(0, self.pool.stats()['busy'])
+        self.assertEqual(42, self._run(_echo, (42,)))
+
+    def test_transient_timeout(self):
+        """
+        Without the pool, the configured timeout still applies
+        """
+        proxy = open(os.path.join(self.directory, 'proxy-1'))
+        with mock.patch.multiple(gfal2_wrapper, gfal2_pool=None, gfal2_timeout=1):
+            start = time.time()
+            self.assertRaises(Gfal2Error, gfal2_wrapper.Gfal2Wrapper(proxy, _hang))
+            try:
+                list(gfal2_wrapper.Gfal2Wrapper(proxy, _hang).stream())
+                self.fail('Expected a timeout')
+            except Gfal2Error, e:
+                self.assertEqual(errno.ETIMEDOUT, e.errno)
+            self.assertLess(time.time() - start, 5)
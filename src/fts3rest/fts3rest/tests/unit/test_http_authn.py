@@ -17,13 +17,14 @@
 
 import M2Crypto
 import hashlib
+import mock
 import os
 import time
 import unittest
 from base64 import b64encode
 from datetime import datetime, timedelta
 
-from fts3rest.lib.middleware.fts3auth.methods.http import do_authentication, set_capath
+from fts3rest.lib.middleware.fts3auth.methods.http import do_authentication, set_capath, _ca_store
 from fts3rest.lib.middleware.fts3auth import UserCredentials, InvalidCredentials
 
 
@@ -168,4 +169,63 @@ class TestHttpAuthn(unittest.TestCase):
         self.assertRaises(
             InvalidCredentials,
             do_authentication, self.creds, dict(HTTP_AUTHORIZATION=self._get_auth_header())
-        )
\ No newline at end of file
+        )
+
+    def test_http_validation_cached(self):
+        """
+        The second time, the validation result is reused
+        """
+        hits = _ca_store._validated.stats()['hits']
+        self.assertTrue(do_authentication(self.creds, dict(HTTP_AUTHORIZATION=self._get_auth_header())))
+        self.assertTrue(do_authentication(self.creds, dict(HTTP_AUTHORIZATION=self._get_auth_header())))
+        self.assertEqual(hits + 1, _ca_store._validated.stats()['hits'])
+
+    def test_http_crl_updated(self):
+        """
+        When a CRL is overwritten in place, the cached validations are discarded,
+        even if the CA directory does not change
+        """
+        # Not the hash of the test CA, so it is never read
+        crl_path = os.path.join('/tmp', '00000000.r0')
+        open(crl_path, 'w').close()
+        check_interval = _ca_store.check_interval
+        _ca_store.check_interval = 0
+        try:
+            self.assertTrue(do_authentication(self.creds, dict(HTTP_AUTHORIZATION=self._get_auth_header())))
+            misses = _ca_store._validated.stats()['misses']
+            mtime = os.stat(crl_path).st_mtime + 10
+            os.utime(crl_path, (mtime, mtime))
+            self.assertTrue(do_authentication(self.creds, dict(HTTP_AUTHORIZATION=self._get_auth_header())))
+            self.assertEqual(misses + 1, _ca_store._validated.stats()['misses'])
+        finally:
+            _ca_store.check_interval = check_interval
+            os.unlink(crl_path)
+
+    def test_http_reloaded_while_validating(self):
+        """
+        A validation done against a context that has been replaced meanwhile is not reused
+        """
+        get_context = _ca_store._get_context
+
+        def reloaded_meanwhile():
+            previous = get_context()
+            _ca_store.invalidate()
+            get_context()
+            return previous
+
+        with mock.patch.object(_ca_store, '_get_context', side_effect=reloaded_meanwhile):
+            self.assertTrue(do_authentication(self.creds, dict(HTTP_AUTHORIZATION=self._get_auth_header())))
+        misses = _ca_store._validated.stats()['misses']
+        self.assertTrue(do_authentication(self.creds, dict(HTTP_AUTHORIZATION=self._get_auth_header())))
+        self.assertEqual(misses + 1, _ca_store._validated.stats()['misses'])
+
+    def test_http_ca_removed(self):
+        """
+        When the CA directory changes, the cached validations are discarded
+        """
+        self.assertTrue(do_authentication(self.creds, dict(HTTP_AUTHORIZATION=self._get_auth_header())))
+        os.unlink(self.ca_path)
+        self.assertRaises(
+            InvalidCredentials,
+            do_authentication, self.creds, dict(HTTP_AUTHORIZATION=self._get_auth_header())
+        )
@@ -0,0 +1,116 @@
+#   Copyright notice:
+#   Copyright CERN, 2015.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import json
+import mock
+import sys
+import time
+import unittest
+from datetime import datetime
+
+from fts3.model import Job, File
+from fts3rest.lib.helpers.jsonify import to_json
+
+
+# The package exports the jsonify decorator under the same name as the module
+jsonify = sys.modules['fts3rest.lib.helpers.jsonify']
+
+
+def _build_file(i):
+    return File(
+        file_id=i,
+        job_id='1234-5678',
+        file_state='SUBMITTED',
+        source_surl='root://source.es/file%d' % i,
+        dest_surl='root://dest.ch/file%d' % i,
+        start_time=datetime(2015, 10, 1, 12, 30, 15),
+        user_filesize=1024,
+        file_metadata={'index': i}
+    )
+
+
+def _build_job(nfiles):
+    job = Job(
+        job_id='1234-5678',
+        job_state='SUBMITTED',
+        user_dn='/DC=ch/DC=cern/CN=Test User',
+        vo_name='testvo',
+        submit_time=datetime(2015, 10, 1, 12, 30, 15),
+        job_metadata={'key': 'value'}
+    )
+    for i in range(nfiles):
+        job.files.append(_build_file(i))
+    return job
+
+
+class TestJsonify(unittest.TestCase):
+    """
+    Serialization of the model into JSON
+    """
+
+    def test_mapped_object(self):
+        job = _build_job(2)
+        setattr(job, 'http_status', '200 Ok')
+        serialized = json.loads(to_json(job))
+
+        self.assertEqual('1234-5678', serialized['job_id'])
+        self.assertEqual('2015-10-01T12:30:15', serialized['submit_time'])
+        self.assertEqual({'key': 'value'}, serialized['job_metadata'])
+        self.assertEqual('200 Ok', serialized['http_status'])
+        # Unloaded attributes are not serialized
+        self.assertNotIn('reason', serialized)
+
+        self.assertEqual(2, len(serialized['files']))
+        for i, f in enumerate(serialized['files']):
+            self.assertEqual(i, f['file_id'])
+            self.assertEqual('2015-10-01T12:30:15', f['start_time'])
+            self.assertEqual({'index': i}, f['file_metadata'])
+            # The back reference to the job must not be followed
+            self.assertNotIn('job', f)
+
+    def test_columns_computed_once(self):
+        """
+        The columns of a mapped class are introspected only once, not once per object
+        """
+        files = [_build_file(i) for i in range(100)]
+        with mock.patch.dict(jsonify._mapped_columns, clear=True):
+            with mock.patch.object(jsonify, 'class_mapper', wraps=jsonify.class_mapper) as class_mapper:
+                serialized = json.loads(to_json(files, indent=None))
+        self.assertEqual(100, len(serialized))
+        self.assertEqual(1, class_mapper.call_count)
+
+    def test_visited_lookup_scales(self):
+        """
+        Looking up the visited objects must not depend on how many there are, or the
+        serialization of a large response becomes quadratic.
+        The best of several runs is compared, with a generous margin, so the load of the machine
+        does not make it fail: with a linear lookup, it would take around 4 times longer.
+        """
+        def best_lookup_time(nfiles):
+            encoder = jsonify.ClassEncoder(indent=None)
+            encoder.encode([_build_file(i) for i in range(nfiles)])
+            self.assertEqual(nfiles, len(encoder.visited))
+            missing = id(encoder)
+            times = []
+            for _ in range(5):
+                start = time.time()
+                for _ in xrange(20000):
+                    missing in encoder.visited
+                times.append(time.time() - start)
+            return min(times)
+
+        small = best_lookup_time(1000)
+        large = best_lookup_time(4000)
+        self.assertLess(large, small * 2.5)
@@ -0,0 +1,72 @@
+#   Copyright notice:
+#   Copyright CERN, 2015.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import time
+import unittest
+
+from fts3rest.lib.keypool import KeyPool
+
+
+class TestKeyPool(unittest.TestCase):
+    """
+    Test the pool of pre-generated keys
+    """
+
+    def _wait_for(self, pool, key_len, size):
+        for _ in range(100):
+            if pool.stats()['sizes'].get(key_len) >= size:
+                return
+            time.sleep(0.1)
+        self.fail('The pool has not been filled')
+
+    def test_pooled_key(self):
+        """
+        Keys are taken from the pool, and the pool is refilled in the background
+        """
+        pool = KeyPool(low_watermark=1, high_watermark=2, key_lengths=(512,))
+        pool.start()
+        self._wait_for(pool, 512, 2)
+
+        key_pair = pool.get_key(512)
+        self.assertEqual(512, len(key_pair))
+        key_pair = pool.get_key(512)
+        self.assertEqual(512, len(key_pair))
+        self.assertEqual(2, pool.stats()['hits'])
+        self.assertEqual(0, pool.stats()['misses'])
+
+        self._wait_for(pool, 512, 2)
+
+    def test_not_configured_key_length(self):
+        """
+        A key length not configured is generated inline, and never pooled
+        """
+        pool = KeyPool(low_watermark=1, high_watermark=1, key_lengths=())
+        pool.start()
+
+        key_pair = pool.get_key(1024)
+        self.assertEqual(1024, len(key_pair))
+        self.assertEqual(1, pool.stats()['misses'])
+        self.assertNotIn(1024, pool.stats()['sizes'])
+
+    def test_disabled(self):
+        """
+        With a high watermark of 0, keys are always generated inline
+        """
+        pool = KeyPool(low_watermark=0, high_watermark=0)
+        pool.start()
+        key_pair = pool.get_key(512)
+        self.assertEqual(512, len(key_pair))
+        self.assertEqual(1, pool.stats()['misses'])
+        self.assertNotIn(512, pool.stats()['sizes'])
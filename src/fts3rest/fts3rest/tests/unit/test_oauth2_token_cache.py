@@ -0,0 +1,128 @@
+#   Copyright notice:
+#   Copyright CERN, 2015.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import calendar
+import mock
+import unittest
+from datetime import datetime, timedelta
+
+from fts3.model import Credential
+from fts3rest.lib import oauth2provider
+from fts3rest.lib.base import Session
+from fts3rest.lib.oauth2provider import FTS3OAuth2ResourceProvider
+
+
+class TestOAuth2TokenCache(unittest.TestCase):
+    """
+    Test the cache of validated access tokens
+    """
+
+    DN = 'token-cache-subject'
+
+    def setUp(self):
+        oauth2provider._validated_tokens.clear()
+        Session.query(Credential).filter(Credential.dn == self.DN).delete()
+        cred = Credential()
+        cred.dlg_id = '1234abcd'
+        cred.dn = self.DN
+        cred.proxy = 'access:refresh'
+        cred.voms_attrs = None
+        cred.termination_time = datetime.utcnow() + timedelta(hours=1)
+        Session.merge(cred)
+        Session.commit()
+        self.provider = FTS3OAuth2ResourceProvider(dict(), {'fts3.ValidateAccessTokenOffline': 'true'})
+
+    def tearDown(self):
+        Session.query(Credential).filter(Credential.dn == self.DN).delete()
+        Session.commit()
+        oauth2provider._validated_tokens.clear()
+
+    def _claims(self, exp):
+        return {'sub': self.DN, 'iss': 'https://issuer.example.com/', 'exp': calendar.timegm(exp.utctimetuple())}
+
+    def test_validated_once(self):
+        """
+        The second request with the same token must not validate it again
+        """
+        claims = self._claims(datetime.utcnow() + timedelta(minutes=30))
+        with mock.patch.object(FTS3OAuth2ResourceProvider, '_validate_token_offline',
+                               return_value=(True, claims)) as validate:
+            for _ in range(3):
+                auth = self.provider.authorization_class()
+                self.provider.validate_access_token('the-token', auth)
+                self.assertTrue(auth.is_valid)
+                self.assertEqual('1234abcd', auth.dlg_id)
+                self.assertEqual(self.DN, auth.credentials.dn)
+                self.assertEqual('access', auth.token)
+            self.assertEqual(1, validate.call_count)
+
+    def test_invalid_not_cached(self):
+        """
+        Invalid tokens are validated each time
+        """
+        with mock.patch.object(FTS3OAuth2ResourceProvider, '_validate_token_offline',
+                               return_value=(False, None)) as validate:
+            for _ in range(2):
+                auth = self.provider.authorization_class()
+                self.provider.validate_access_token('bad-token', auth)
+                self.assertFalse(auth.is_valid)
+            self.assertEqual(2, validate.call_count)
+
+    def test_expired_token(self):
+        """
+        Once the token expires, the cached entry is discarded
+        """
+        claims = self._claims(datetime.utcnow() - timedelta(minutes=1))
+        with mock.patch.object(FTS3OAuth2ResourceProvider, '_validate_token_offline',
+                               return_value=(True, claims)) as validate:
+            for _ in range(2):
+                auth = self.provider.authorization_class()
+                self.provider.validate_access_token('expired-token', auth)
+                self.assertFalse(auth.is_valid)
+            self.assertEqual(3, validate.call_count)
+
+    def test_credential_removed(self):
+        """
+        Once the credential is removed, the cached tokens bound to it are discarded
+        """
+        claims = self._claims(datetime.utcnow() + timedelta(minutes=30))
+        with mock.patch.object(FTS3OAuth2ResourceProvider, '_validate_token_offline',
+                               return_value=(True, claims)) as validate:
+            auth = self.provider.authorization_class()
+            self.provider.validate_access_token('the-token', auth)
+            self.assertTrue(auth.is_valid)
+
+            oauth2provider.invalidate_validated_tokens('1234abcd')
+            auth = self.provider.authorization_class()
+            self.provider.validate_access_token('the-token', auth)
+            self.assertEqual(2, validate.call_count)
+
+    def test_configured_ttl(self):
+        """
+        The lifetime of the cached tokens comes from the configuration, not from each request
+        """
+        entry_life = oauth2provider._validated_tokens.entry_life
+        try:
+            oauth2provider.configure_token_cache({'fts3.TokenCacheTTL': '10'})
+            self.assertEqual(10, oauth2provider._validated_tokens.entry_life)
+            claims = self._claims(datetime.utcnow() + timedelta(minutes=30))
+            with mock.patch.object(FTS3OAuth2ResourceProvider, '_validate_token_offline', return_value=(True, claims)):
+                provider = FTS3OAuth2ResourceProvider(dict(), {
+                    'fts3.ValidateAccessTokenOffline': 'true', 'fts3.TokenCacheTTL': '600'
+                })
+                provider.validate_access_token('the-token', provider.authorization_class())
+            self.assertEqual(10, oauth2provider._validated_tokens.entry_life)
+        finally:
+            oauth2provider._validated_tokens.entry_life = entry_life
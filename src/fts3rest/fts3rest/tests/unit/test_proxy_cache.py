@@ -0,0 +1,75 @@
+#   Copyright notice:
+#   Copyright CERN, 2015.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import shutil
+import stat
+import unittest
+from datetime import datetime, timedelta
+
+from fts3rest.lib.proxycache import ProxyFileCache
+
+
+class TestProxyFileCache(unittest.TestCase):
+    """
+    Test the cache of delegated proxies written to disk
+    """
+
+    def setUp(self):
+        self.cache = ProxyFileCache()
+        self.expiration = datetime.utcnow() + timedelta(hours=1)
+
+    def tearDown(self):
+        if self.cache._directory:
+            shutil.rmtree(self.cache._directory)
+
+    def test_reused(self):
+        """
+        The file is written once, and only readable by the owner
+        """
+        first = self.cache.acquire('dlg1', self.expiration, 'PROXY')
+        self.cache.release(first)
+        second = self.cache.acquire('dlg1', self.expiration, 'PROXY')
+        self.assertEqual(first.name, second.name)
+        self.assertEqual('PROXY', open(second.name).read())
+        self.assertEqual(0600, stat.S_IMODE(os.stat(second.name).st_mode))
+        self.assertEqual(1, self.cache.stats()['writes'])
+        self.assertEqual(1, self.cache.stats()['hits'])
+
+    def test_renewed(self):
+        """
+        A new credential gets a new file, and the old one is removed once released
+        """
+        old = self.cache.acquire('dlg1', self.expiration, 'OLD')
+        new = self.cache.acquire('dlg1', self.expiration + timedelta(hours=1), 'NEW')
+        self.assertNotEqual(old.name, new.name)
+        self.assertEqual('NEW', open(new.name).read())
+        # Still in use
+        self.assertEqual('OLD', open(old.name).read())
+        self.cache.release(old)
+        self.assertFalse(os.path.exists(old.name))
+        self.assertTrue(os.path.exists(new.name))
+
+    def test_expired(self):
+        """
+        Expired credentials are removed when not in use
+        """
+        expired = self.cache.acquire('dlg1', datetime.utcnow() - timedelta(seconds=1), 'PROXY')
+        self.cache.release(expired)
+        other = self.cache.acquire('dlg2', self.expiration, 'OTHER')
+        self.assertFalse(os.path.exists(expired.name))
+        self.assertEqual(1, self.cache.stats()['files'])
+        self.assertEqual(1, self.cache.stats()['in_use'])
+        self.cache.release(other)
@@ -0,0 +1,109 @@
+#   Copyright notice:
+#   Copyright CERN, 2015.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import threading
+import time
+import unittest
+
+from fts3rest.lib.scheduler.Cache import LRUCache
+
+
+class TestLRUCache(unittest.TestCase):
+    """
+    Test the process wide cache used by the scheduler
+    """
+
+    def setUp(self):
+        self.calls = []
+
+    def _loader(self, *args):
+        self.calls.append(args)
+        return len(self.calls)
+
+    def test_hit(self):
+        cache = LRUCache(10, 300)
+        self.assertEqual(1, cache.get(('submitted', 'a', 'b'), self._loader, 'a', 'b'))
+        self.assertEqual(1, cache.get(('submitted', 'a', 'b'), self._loader, 'a', 'b'))
+        self.assertEqual(1, len(self.calls))
+        stats = cache.stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+
+    def test_no_collision(self):
+        """
+        Keys built from the same elements in different order must not collide
+        """
+        cache = LRUCache(10, 300)
+        cache.get(('submitted', 'a', 'b'), self._loader, 'a', 'b')
+        cache.get(('submitted', 'b', 'a'), self._loader, 'b', 'a')
+        self.assertEqual(2, len(self.calls))
+
+    def test_expiration(self):
+        cache = LRUCache(10, 0)
+        cache.get('key', self._loader)
+        time.sleep(0.01)
+        cache.get('key', self._loader)
+        self.assertEqual(2, len(self.calls))
+
+    def test_lru_eviction(self):
+        cache = LRUCache(2, 300)
+        cache.get('a', self._loader)
+        cache.get('b', self._loader)
+        # Touch 'a' so 'b' becomes the least recently used
+        cache.get('a', self._loader)
+        cache.get('c', self._loader)
+        self.assertEqual(1, cache.stats()['evictions'])
+        cache.get('a', self._loader)
+        self.assertEqual(3, len(self.calls))
+        cache.get('b', self._loader)
+        self.assertEqual(4, len(self.calls))
+
+    def test_single_flight(self):
+        """
+        Concurrent misses on the same key must call the loader only once
+        """
+        cache = LRUCache(10, 300)
+        release = threading.Event()
+
+        def slow_loader():
+            release.wait()
+            return self._loader()
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(cache.get('key', slow_loader)))
+            for _ in range(5)
+        ]
+        for t in threads:
+            t.start()
+        time.sleep(0.1)
+        release.set()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(1, len(self.calls))
+        self.assertEqual([1] * 5, results)
+
+    def test_loader_failure(self):
+        """
+        A failing loader must not leave waiters blocked, nor cache anything
+        """
+        cache = LRUCache(10, 300)
+
+        def failing_loader():
+            raise RuntimeError('DB is down')
+
+        self.assertRaises(RuntimeError, cache.get, 'key', failing_loader)
+        self.assertEqual(1, cache.get('key', self._loader))
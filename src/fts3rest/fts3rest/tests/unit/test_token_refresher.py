@@ -0,0 +1,104 @@
+#   Copyright notice:
+#   Copyright CERN, 2018
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import jwt
+import mock
+import unittest
+from datetime import datetime, timedelta
+from sqlalchemy.exc import OperationalError
+
+from fts3.model import Credential
+from fts3rest.lib.IAMTokenRefresher import IAMTokenRefresher
+from fts3rest.lib.base import Session
+from fts3rest.lib.openidconnect import oidc_manager
+
+
+def _refresh(token):
+    if token.dn == 'broken':
+        raise Exception('Refresh failed')
+    token.proxy = 'new-access:new-refresh'
+    token.termination_time = datetime.utcnow() + timedelta(hours=1)
+    return token
+
+
+class TestTokenRefresher(unittest.TestCase):
+    """
+    Test the refresh of the access tokens
+    """
+
+    def setUp(self):
+        Session.query(Credential).delete()
+        access_token = jwt.encode({'iss': 'https://issuer.example.com/'}, 'secret')
+        now = datetime.utcnow()
+        for i, (dn, expires) in enumerate([
+            ('soon-1', now + timedelta(minutes=5)),
+            ('soon-2', now + timedelta(minutes=10)),
+            ('broken', now + timedelta(minutes=10)),
+            ('later', now + timedelta(days=1)),
+        ]):
+            cred = Credential()
+            cred.dlg_id = 'dlg%d' % i
+            cred.dn = dn
+            cred.proxy = access_token + ':refresh'
+            cred.termination_time = expires
+            Session.merge(cred)
+        Session.commit()
+        self.refresher = IAMTokenRefresher('test-refresher', {
+            'fts3.TokenRefreshDaemonIntervalInSeconds': 600,
+            'fts3.TokenRefreshBatchSize': 2,
+            'fts3.TokenRefreshRetryBackoff': 0,
+        })
+
+    def tearDown(self):
+        Session.query(Credential).delete()
+        Session.commit()
+
+    def test_refresh_cycle(self):
+        """
+        Only tokens within the horizon are refreshed, and a failure does not stop the others
+        """
+        with mock.patch.object(oidc_manager, 'refresh_access_token', side_effect=_refresh) as refresh:
+            self.refresher.refresh_tokens()
+            # The broken one is retried
+            self.assertEqual(2 + 1 + self.refresher.max_retries, refresh.call_count)
+
+        proxies = dict((c.dn, c.proxy) for c in Session.query(Credential))
+        self.assertEqual('new-access:new-refresh', proxies['soon-1'])
+        self.assertEqual('new-access:new-refresh', proxies['soon-2'])
+        self.assertNotEqual('new-access:new-refresh', proxies['broken'])
+        self.assertNotEqual('new-access:new-refresh', proxies['later'])
+
+        stats = self.refresher.stats()
+        self.assertEqual(1, stats['cycles'])
+        self.assertEqual(3, stats['backlog'])
+        self.assertEqual(2, stats['refreshed'])
+        self.assertEqual(1, stats['failed'])
+        self.assertIsNotNone(stats['last_cycle_duration'])
+
+    def test_database_error(self):
+        """
+        A database error ends the cycle, but the next one still runs
+        """
+        error = OperationalError('SELECT', {}, Exception('Lost connection'))
+        with mock.patch.object(self.refresher, '_get_batches', side_effect=error):
+            self.refresher.refresh_tokens()
+        self.assertEqual(1, self.refresher.stats()['errors'])
+
+        with mock.patch.object(oidc_manager, 'refresh_access_token', side_effect=_refresh):
+            self.refresher.refresh_tokens()
+        stats = self.refresher.stats()
+        self.assertEqual(2, stats['cycles'])
+        self.assertEqual(1, stats['errors'])
+        self.assertEqual(2, stats['refreshed'])
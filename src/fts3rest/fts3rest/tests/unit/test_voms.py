@@ -0,0 +1,176 @@
+#   Copyright notice:
+#   Copyright CERN, 2015.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import binascii
+import mock
+import time
+import unittest
+from datetime import datetime, timedelta
+from M2Crypto import ASN1, EVP, RSA, X509
+
+from fts3rest.lib.helpers import voms
+
+
+def _tlv(tag, content):
+    length = len(content)
+    if length < 0x80:
+        encoded_length = chr(length)
+    else:
+        encoded_length = ''
+        while length:
+            encoded_length = chr(length & 0xff) + encoded_length
+            length >>= 8
+        encoded_length = chr(0x80 | len(encoded_length)) + encoded_length
+    return chr(tag) + encoded_length + content
+
+
+def _oid(dotted):
+    components = map(int, dotted.split('.'))
+    encoded = chr(components[0] * 40 + components[1])
+    for component in components[2:]:
+        chunk = chr(component & 0x7f)
+        component >>= 7
+        while component:
+            chunk = chr(0x80 | (component & 0x7f)) + chunk
+            component >>= 7
+        encoded += chunk
+    return _tlv(0x06, encoded)
+
+
+def _build_ac(fqans, not_after):
+    """
+    Build a minimal VOMS attribute certificate
+    """
+    algorithm = _tlv(0x30, _oid('1.2.840.113549.1.1.5'))
+    validity = _tlv(0x30, ''.join([
+        _tlv(0x18, (not_after - timedelta(hours=12)).strftime('%Y%m%d%H%M%SZ')),
+        _tlv(0x18, not_after.strftime('%Y%m%d%H%M%SZ')),
+    ]))
+    ietf_attr = _tlv(0x30, ''.join([
+        _tlv(0xa0, _tlv(0x86, 'dteam://voms.cern.ch:15004')),
+        _tlv(0x30, ''.join(_tlv(0x04, fqan) for fqan in fqans)),
+    ]))
+    attributes = _tlv(0x30, _tlv(0x30, _oid(voms.VOMS_FQAN_OID) + _tlv(0x31, ietf_attr)))
+    acinfo = _tlv(0x30, ''.join([
+        _tlv(0x02, '\x01'), _tlv(0x30, ''), _tlv(0xa0, ''), algorithm, _tlv(0x02, '\x2a'),
+        validity, attributes
+    ]))
+    ac = _tlv(0x30, acinfo + algorithm + _tlv(0x03, '\x00signature'))
+    return _tlv(0x30, _tlv(0x30, ac))
+
+
+def _build_proxy(ac=None, not_after=None):
+    key = EVP.PKey()
+    key.assign_rsa(RSA.gen_key(512, 65537, callback=lambda *args: None))
+    name = X509.X509_Name()
+    name.add_entry_by_txt('CN', 0x1000, 'proxy', -1, -1, 0)
+
+    x509 = X509.X509()
+    x509.set_version(2)
+    x509.set_serial_number(int(time.time()))
+    x509.set_subject(name)
+    x509.set_issuer(name)
+    x509.set_pubkey(key)
+    asn1_not_before = ASN1.ASN1_UTCTIME()
+    asn1_not_before.set_time(int(time.time()))
+    asn1_not_after = ASN1.ASN1_UTCTIME()
+    asn1_not_after.set_datetime(not_after or datetime.utcnow() + timedelta(hours=12))
+    x509.set_not_before(asn1_not_before)
+    x509.set_not_after(asn1_not_after)
+    if ac:
+        x509.add_ext(X509.new_extension(voms.VOMS_AC_OID, 'DER:' + binascii.hexlify(ac)))
+    x509.sign(key, 'sha256')
+    return x509
+
+
+class TestVomsParsing(unittest.TestCase):
+    """
+    Test the in process parsing of the VOMS attributes, and the cache of the verified ones
+    """
+
+    def setUp(self):
+        voms._fqans_cache.clear()
+
+    def test_fqans(self):
+        """
+        Get the FQANs and the AC termination time
+        """
+        ac_not_after = datetime.utcnow().replace(microsecond=0) + timedelta(hours=1)
+        fqans = ['/dteam/Role=NULL/Capability=NULL', '/dteam/cern/Role=NULL/Capability=NULL']
+        proxy = _build_proxy(_build_ac(fqans, ac_not_after))
+
+        parsed_fqans, parsed_not_after = voms._parse_voms_extension([proxy])
+        self.assertEqual(fqans, parsed_fqans)
+        self.assertEqual(ac_not_after, parsed_not_after)
+
+    def test_no_voms(self):
+        """
+        A proxy without VOMS extensions has no FQANs
+        """
+        self.assertEqual(([], None), voms._parse_voms_extension([_build_proxy()]))
+
+    def test_cached(self):
+        """
+        The FQANs verified by voms-proxy-info are reused for the same proxy
+        """
+        proxy = _build_proxy(_build_ac(['/dteam'], datetime.utcnow() + timedelta(hours=1)))
+        with mock.patch.object(voms, '_get_proxy_fqans', return_value=['/dteam']) as verify:
+            self.assertEqual(['/dteam'], voms.get_proxy_fqans([proxy], proxy.as_pem()))
+            self.assertEqual(['/dteam'], voms.get_proxy_fqans([proxy], proxy.as_pem()))
+            self.assertEqual(1, verify.call_count)
+
+    def test_forged(self):
+        """
+        An attribute certificate that voms-proxy-info rejects (i.e. not signed by a trusted
+        VOMS server) must be rejected, even if it can be parsed, and never cached
+        """
+        proxy = _build_proxy(_build_ac(['/dteam/Role=lcgadmin'], datetime.utcnow() + timedelta(hours=1)))
+        rejected = voms.VomsException('Cannot verify AC signature!')
+        with mock.patch.object(voms, '_get_proxy_fqans', side_effect=rejected) as verify:
+            for _ in range(2):
+                self.assertRaises(voms.VomsException, voms.get_proxy_fqans, [proxy], proxy.as_pem())
+            self.assertEqual(2, verify.call_count)
+
+    def test_expired(self):
+        """
+        Once the attribute certificate expires, the cached FQANs are not used anymore
+        """
+        proxy = _build_proxy(_build_ac(['/dteam'], datetime.utcnow() - timedelta(minutes=1)))
+        with mock.patch.object(voms, '_get_proxy_fqans', return_value=['/dteam']):
+            self.assertRaises(voms.VomsException, voms.get_proxy_fqans, [proxy], proxy.as_pem())
+        self.assertEqual(0, voms._fqans_cache.stats()['size'])
+
+    def test_not_parsable(self):
+        """
+        If the expiration of the attribute certificates is not known, the FQANs are not cached
+        """
+        proxy = _build_proxy(_build_ac(['/dteam'], datetime.utcnow() + timedelta(hours=1)))
+        with mock.patch.object(voms, '_parse_voms_extension', side_effect=ValueError('Broken')):
+            with mock.patch.object(voms, '_get_proxy_fqans', return_value=['/dteam']) as verify:
+                self.assertEqual(['/dteam'], voms.get_proxy_fqans([proxy], proxy.as_pem()))
+                self.assertEqual(['/dteam'], voms.get_proxy_fqans([proxy], proxy.as_pem()))
+                self.assertEqual(2, verify.call_count)
+
+    def test_termination_time(self):
+        """
+        The termination time is the earliest between the certificate and the AC expiration
+        """
+        now = datetime.utcnow().replace(microsecond=0)
+        proxy = _build_proxy(_build_ac(['/dteam'], now + timedelta(hours=1)), not_after=now + timedelta(hours=2))
+        client = voms.VomsClient(proxy.as_pem())
+        self.assertEqual(now + timedelta(hours=1), voms._get_termination_time(client.proxy_path))
+        proxy = _build_proxy(_build_ac(['/dteam'], now + timedelta(hours=3)), not_after=now + timedelta(hours=2))
+        client = voms.VomsClient(proxy.as_pem())
+        self.assertEqual(now + timedelta(hours=2), voms._get_termination_time(client.proxy_path))